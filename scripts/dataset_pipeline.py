@@ -0,0 +1,303 @@
+"""
+تبدیل و پاک‌سازی جریانی dataset چت‌ها (جایگزین converted_dataset.py + cleaned_dataset.py بدون بارگذاری کل فایل).
+
+    python scripts/dataset_pipeline.py datasets/dataset.json -o datasets/cleaned_dataset.jsonl \\
+        --converted-out datasets/converted_dataset.jsonl --workers 4
+
+ورودی:
+  - dataset.json: {"chat_id": [{"sender", "text"}, ...], ...}  → جفت پیام‌های متوالی از دو فرستندهٔ متفاوت
+  - converted_dataset.json (آرایه) یا .jsonl: جفت‌های {"instruction", "input", "output"} که فقط پاک‌سازی می‌شوند
+فایل با JSONDecoder.raw_decode تکه‌تکه خوانده می‌شود و خروجی خط‌به‌خط (JSONL) نوشته می‌شود.
+با --near-dup جفت‌های تقریباً تکراری هم با MinHash/LSH حذف می‌شوند (near_dedup.py؛ امضاها در workerها ساخته می‌شوند).
+گزارش (تعداد، زمان، throughput و بیشینهٔ حافظه) در پایان به صورت JSON روی stderr چاپ می‌شود.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import re
+import resource
+import sys
+import time
+from collections import deque
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from near_dedup import MinHasher, NearDuplicateIndex
+
+_WS_RE = re.compile(r"\s+")
+_URL_RE = re.compile(r"https?://\S+|www\.\S+")
+_STRIP_RE = re.compile(r"[^\w\s\u0600-\u06FF]")
+
+_decoder = json.JSONDecoder()
+
+
+# ---------- streaming JSON ----------
+class _Reader:
+    """بافر متنی روی فایل؛ فقط بخشی که هنوز parse نشده در حافظه می‌ماند."""
+    def __init__(self, f, chunk_size: int):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+
+    def fill(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_ws(self) -> str:
+        """اولین کاراکتر غیر فاصله (بدون مصرف آن)؛ '' در پایان فایل"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        ch = self.skip_ws()
+        if not ch or ch not in chars:
+            raise ValueError(f"expected one of {chars!r} at offset {self.pos}, got {ch!r}")
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.skip_ws()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # مقدار هنوز کامل در بافر نیست
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.buf) and not isinstance(obj, (str, list, dict)):
+                # عدد/literal ممکن است در مرز تکه بریده شده باشد
+                if self.fill():
+                    continue
+            self.pos = end
+            return obj
+
+
+def iter_json(path: str, chunk_size: int = 1 << 16) -> Iterator:
+    """
+    عناصر سطح اول یک فایل JSON بدون بارگذاری کل آن:
+    آرایه → هر عنصر ؛ شیء → (key, value) ؛ .jsonl → هر خط
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        r = _Reader(f, chunk_size)
+        opening = r.expect("[{")
+        closing = "]" if opening == "[" else "}"
+        if r.skip_ws() == closing:
+            return
+        while True:
+            if opening == "{":
+                key = r.value()
+                r.expect(":")
+                yield key, r.value()
+            else:
+                yield r.value()
+            if r.expect("," + closing) == closing:
+                return
+
+
+# ---------- convert / clean ----------
+def convert_chat(messages: list[dict]) -> Iterator[dict]:
+    """جفت (پیام، پاسخ) برای هر دو پیام متوالی از دو فرستندهٔ متفاوت."""
+    for q, a in zip(messages, messages[1:]):
+        if q["sender"] != a["sender"]:
+            yield {"instruction": q["text"].strip(), "input": "", "output": a["text"].strip()}
+
+
+def clean_text(text: str) -> str:
+    text = _WS_RE.sub(" ", text).strip()
+    text = _URL_RE.sub("", text)
+    return _STRIP_RE.sub("", text)
+
+
+def clean_pair(pair: dict) -> dict | None:
+    """همان قواعد cleaned_dataset.py ؛ None اگر سؤال یا پاسخ خیلی کوتاه باشد."""
+    q = clean_text(pair["instruction"])
+    a = clean_text(pair["output"])
+    if len(q) < 3 or len(a) < 3:
+        return None
+    if len(q.split()) < 2 or len(a.split()) < 2:
+        return None
+    return {"instruction": q, "input": "", "output": a}
+
+
+def fingerprint(pair: dict) -> bytes:
+    """۱۶ بایت به جای نگه داشتن کل متن (q, a) در set"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pair["instruction"].encode("utf-8"))
+    h.update(b"\x00")
+    h.update(pair["output"].encode("utf-8"))
+    return h.digest()
+
+
+def process_batch(batch: list, hasher: MinHasher | None = None) -> list[tuple]:
+    """
+    batch: لیست چت‌ها (لیست پیام) یا جفت‌های آماده (dict)
+    خروجی: (جفت تبدیل‌شده، جفت پاک‌شده یا None، امضای MinHash یا None) به همان ترتیب
+    """
+    out = []
+    for item in batch:
+        pairs = [item] if isinstance(item, dict) else convert_chat(item)
+        for pair in pairs:
+            cleaned = clean_pair(pair)
+            sig = hasher.pair_signature(cleaned) if hasher is not None and cleaned is not None else None
+            out.append((pair, cleaned, sig))
+    return out
+
+
+# ---------- driver ----------
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bounded_imap(pool, fn, batches: Iterable[list], window: int) -> Iterator:
+    """مثل pool.imap ولی حداکثر window دسته در صف؛ imap کل ورودی را جلوتر می‌خواند و حافظه را پر می‌کند."""
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(fn, (batch,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _items(path: str) -> Iterator:
+    """چت‌ها (لیست پیام) از dataset.json یا جفت‌ها از فایل‌های تبدیل‌شده"""
+    for item in iter_json(path):
+        yield item[1] if isinstance(item, tuple) else item
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss در لینوکس کیلوبایت و در macOS بایت است
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "main": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "workers": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def run(
+    input_path: str,
+    output_path: str,
+    converted_path: str | None = None,
+    workers: int = 1,
+    batch_size: int = 256,
+    dedup: bool = True,
+    near_dup: float | None = None,
+    num_perm: int = 64,
+    capacity: int = 1_000_000,
+) -> dict:
+    stats = {"items": 0, "pairs": 0, "kept": 0, "dropped_short": 0, "dropped_duplicate": 0, "dropped_near_duplicate": 0}
+    seen: set[bytes] = set()
+    hasher = MinHasher(num_perm) if near_dup else None
+    index = NearDuplicateIndex(near_dup, num_perm, capacity) if near_dup else None
+    fn = partial(process_batch, hasher=hasher)
+    t0 = time.perf_counter()
+
+    def counted(items):
+        for item in items:
+            stats["items"] += 1
+            yield item
+
+    batches = _batches(counted(_items(input_path)), batch_size)
+    pool = mp.get_context("spawn").Pool(workers) if workers > 1 else None
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    if converted_path:
+        Path(converted_path).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        results = _bounded_imap(pool, fn, batches, workers * 4) if pool else map(fn, batches)
+        with ExitStack() as files:
+            out = files.enter_context(open(output_path, "w", encoding="utf-8"))
+            conv = files.enter_context(open(converted_path, "w", encoding="utf-8")) if converted_path else None
+            for result in results:
+                for pair, cleaned, sig in result:
+                    stats["pairs"] += 1
+                    if conv is not None:
+                        conv.write(json.dumps(pair, ensure_ascii=False) + "\n")
+                    if cleaned is None:
+                        stats["dropped_short"] += 1
+                        continue
+                    if dedup:
+                        fp = fingerprint(cleaned)
+                        if fp in seen:
+                            stats["dropped_duplicate"] += 1
+                            continue
+                        seen.add(fp)
+                    if index is not None and index.check_add(sig) is not None:
+                        stats["dropped_near_duplicate"] += 1
+                        continue
+                    out.write(json.dumps(cleaned, ensure_ascii=False) + "\n")
+                    stats["kept"] += 1
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    seconds = time.perf_counter() - t0
+    report = {
+        **stats,
+        "workers": workers,
+        "seconds": round(seconds, 3),
+        "pairs_per_second": round(stats["pairs"] / seconds, 1) if seconds else None,
+        "input_mb_per_second": round(Path(input_path).stat().st_size / 1e6 / seconds, 2) if seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if index is not None:
+        report["near_duplicates"] = index.cluster_stats()
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("input", help="dataset.json (chats) or converted pairs (.json array / .jsonl)")
+    ap.add_argument("-o", "--output", required=True, help="cleaned pairs (JSONL)")
+    ap.add_argument("--converted-out", default=None, help="also write the uncleaned pairs (JSONL)")
+    ap.add_argument("--workers", type=int, default=1, help="processes for convert/clean; 1 = in-process")
+    ap.add_argument("--batch-size", type=int, default=256, help="chats (or pairs) per worker task")
+    ap.add_argument("--no-dedup", action="store_true", help="keep exact duplicate pairs")
+    ap.add_argument("--near-dup", type=float, default=None, metavar="THRESHOLD",
+                    help="also drop near-duplicates above this estimated Jaccard similarity (e.g. 0.8)")
+    ap.add_argument("--num-perm", type=int, default=64, help="MinHash permutations for --near-dup")
+    ap.add_argument("--capacity", type=int, default=1_000_000, help="max unique pairs in the near-dup index (caps memory; tables grow with the input)")
+    args = ap.parse_args()
+
+    report = run(
+        args.input,
+        args.output,
+        converted_path=args.converted_out,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        dedup=not args.no_dedup,
+        near_dup=args.near_dup,
+        num_perm=args.num_perm,
+        capacity=args.capacity,
+    )
+    print(json.dumps(report, indent=2, ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
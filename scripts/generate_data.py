@@ -1,57 +1,366 @@
-import uuid
+"""
+تولید هم‌زمان دادهٔ مصنوعی مذاکرهٔ خرید (خریدار/فروشنده) با LLM ، با checkpoint و حذف تکراری‌ها.
+
+    python scripts/generate_data.py --per-topic 50 --concurrency 8 --rps 3
+    python scripts/generate_data.py --backend ollama --model llama3.1 --topics-file topics.txt
+    python scripts/generate_data.py --backend openai --base-url http://localhost:11435/v1   # stub یا Ollama
+
+- backend: openai (هر API سازگار با /chat/completions ؛ کلید از OPENAI_API_KEY) یا ollama (کلاینت مشترک webapp)
+- موضوع‌ها بین --concurrency worker پخش می‌شوند؛ --rps سقف درخواست در ثانیه است و خطاهای 429/5xx/شبکه
+  با backoff دوباره امتحان می‌شوند.
+- خروجی با یک فایل باز و بافر نوشته می‌شود؛ پیشرفت هر موضوع در <output>.progress.json کنار آن ثبت می‌شود
+  و اجرای دوباره فقط باقی‌ماندهٔ هر موضوع را می‌سازد. نمونه‌های تکراری (نسبت به کل خروجی موجود) دور ریخته می‌شوند.
+گزارش (تعداد، خطاها، زمان و throughput) در پایان به صورت JSON روی stderr چاپ می‌شود.
+"""
+import argparse
+import asyncio
 import json
 import os
-import openai
-from datetime import datetime
+import random
+import sys
+import time
+from pathlib import Path
+
+import httpx
 
-OPENAI_API_KEY = "api"  
-openai.api_key = OPENAI_API_KEY
+from dataset_pipeline import fingerprint
 
 SAVE_PATH = "dataset/final_dataset.jsonl"
+DEFAULT_TOPICS = ["خرید دوچرخه", "خرید گوشی موبایل", "اجارهٔ آپارتمان", "خرید لپ‌تاپ دست دوم", "خرید مبل"]
+BUYER = "خریدار:"
+SELLER = "فروشنده:"
 
-def generate_negotiation_example(topic="خرید دوچرخه"):
-    prompt = f"""
+
+def build_prompt(topic: str) -> str:
+    return f"""
 
 موضوع: {topic}
 
-خریدار: سلام، هنوز {topic} موجوده؟
-فروشنده:"""
+{BUYER} سلام، هنوز {topic} موجوده؟
+{SELLER}"""
 
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7,
-        max_tokens=512
-    )
 
-    conversation = response['choices'][0]['message']['content'].strip()
+def parse_example(conversation: str) -> dict | None:
+    """دو خط آخر گفت‌وگو → {instruction: حرف خریدار، output: جواب فروشنده}"""
     lines = [line.strip() for line in conversation.split("\n") if line.strip()]
-
     if len(lines) < 2:
-        return None  
+        return None
+    instruction = lines[-2].split(BUYER)[-1].strip()
+    output = lines[-1].split(SELLER)[-1].strip()
+    if not instruction or not output:
+        return None
+    return {"instruction": instruction, "input": "", "output": output}
+
+
+# ---------- backends ----------
+class OpenAIBackend:
+    """هر سرور با POST {base_url}/chat/completions (OpenAI، vLLM، Ollama /v1 ، ...)"""
+    def __init__(self, model: str, base_url: str, api_key: str | None, timeout: float = 120, max_connections: int = 16):
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.model = model
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            headers=headers,
+            timeout=httpx.Timeout(timeout, connect=10),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def complete(self, prompt: str, temperature: float, max_tokens: int) -> str:
+        r = await self.client.post("/chat/completions", json={
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        })
+        r.raise_for_status()
+        return r.json()["choices"][0]["message"]["content"].strip()
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+class OllamaBackend:
+    """Ollama محلی از طریق همان کلاینت pool‌شدهٔ backend وب‌اپ (keep_alive و timeoutهای LLM_*)"""
+    def __init__(self, model: str | None, base_url: str | None):
+        sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "webapp" / "backendcode"))
+        from app.llm import LLM_KEEP_ALIVE, LLM_MODEL, OLLAMA_BASE_URL, get_ollama_client
+
+        self.model = model or LLM_MODEL
+        self.keep_alive = LLM_KEEP_ALIVE
+        self.client = get_ollama_client(base_url or OLLAMA_BASE_URL)
+
+    async def complete(self, prompt: str, temperature: float, max_tokens: int) -> str:
+        data = await self.client.achat({
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "options": {"temperature": temperature, "num_predict": max_tokens},
+            "keep_alive": self.keep_alive,
+        })
+        return data.get("message", {}).get("content", "").strip()
+
+    async def aclose(self) -> None:
+        pass
+
+
+def make_backend(name: str, model: str | None, base_url: str | None, api_key: str | None, concurrency: int):
+    if name == "ollama":
+        return OllamaBackend(model, base_url)
+    return OpenAIBackend(
+        model or "gpt-4",
+        base_url or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+        api_key or os.getenv("OPENAI_API_KEY"),
+        max_connections=concurrency,
+    )
+
+
+# ---------- rate limit / retry ----------
+class RateLimiter:
+    """token bucket: به طور میانگین rate درخواست در ثانیه با حداکثر burst درخواست پشت سر هم"""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-    instruction_line = lines[-2] if "خریدار:" in lines[-2] else "خریدار: " + lines[-2]
-    output_line = lines[-1] if "فروشنده:" in lines[-1] else "فروشنده: " + lines[-1]
 
-    instruction = instruction_line.split("خریدار:")[-1].strip()
-    output = output_line.split("فروشنده:")[-1].strip()
+def _retry_after(e: httpx.HTTPError) -> float | None:
+    """None اگر خطا ارزش تکرار ندارد (مثلاً 400/401)، وگرنه ثانیهٔ پیشنهادی سرور یا 0"""
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        if status != 429 and status < 500:
+            return None
+        try:
+            return float(e.response.headers.get("Retry-After", 0))
+        except ValueError:
+            return 0.0
+    return 0.0
 
+
+# ---------- output ----------
+class CheckpointWriter:
+    """
+    تنها نویسندهٔ خروجی: یک فایل باز با بافر؛ هر flush_every نمونه flush می‌شود و بلافاصله بعد از آن
+    پیشرفت موضوع‌ها (kept/attempts) به صورت اتمیک در progress_path نوشته می‌شود.
+    """
+    def __init__(self, path: Path, flush_every: int = 20):
+        self.path = path
+        self.progress_path = path.with_name(path.name + ".progress.json")
+        self.flush_every = flush_every
+        self.seen: set[bytes] = set()
+        self.progress: dict[str, dict] = {}
+        self._load()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(path, "a", encoding="utf-8")
+        self._unflushed = 0
+
+    def _load(self) -> None:
+        if self.path.exists():
+            valid_bytes = 0
+            with open(self.path, "rb") as f:
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break         # خط ناقص آخر بعد از کرش؛ حذف می‌شود تا append بعدی خراب نشود
+                    valid_bytes += len(raw)
+                    try:
+                        self.seen.add(fingerprint(json.loads(raw)))
+                    except (ValueError, KeyError):
+                        continue
+            if valid_bytes != self.path.stat().st_size:
+                with open(self.path, "r+b") as f:
+                    f.truncate(valid_bytes)
+        if self.progress_path.exists():
+            self.progress = json.loads(self.progress_path.read_text(encoding="utf-8"))
+
+    def topic(self, topic: str) -> dict:
+        return self.progress.setdefault(topic, {"kept": 0, "attempts": 0})
+
+    def add(self, topic: str, sample: dict) -> bool:
+        """False اگر نمونه تکراری باشد"""
+        fp = fingerprint(sample)
+        if fp in self.seen:
+            return False
+        self.seen.add(fp)
+        self._f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+        self.topic(topic)["kept"] += 1
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+        return True
+
+    def flush(self) -> None:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unflushed = 0
+        tmp = self.progress_path.with_name(self.progress_path.name + ".tmp")
+        tmp.write_text(json.dumps(self.progress, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, self.progress_path)
+
+    def close(self) -> None:
+        self.flush()
+        self._f.close()
+
+
+# ---------- driver ----------
+class Generator:
+    def __init__(
+        self,
+        backend,
+        writer: CheckpointWriter,
+        concurrency: int = 8,
+        rps: float = 0,
+        retries: int = 4,
+        temperature: float = 0.7,
+        max_tokens: int = 512,
+    ):
+        self.backend = backend
+        self.writer = writer
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rps, burst=max(1, concurrency // 2))
+        self.retries = retries
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.stats = {"requests": 0, "kept": 0, "duplicates": 0, "unparsable": 0, "retries": 0, "errors": 0}
+
+    async def _complete(self, prompt: str) -> str:
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire()
+            self.stats["requests"] += 1
+            try:
+                return await self.backend.complete(prompt, self.temperature, self.max_tokens)
+            except httpx.HTTPError as e:
+                wait = _retry_after(e)
+                if wait is None or attempt == self.retries:
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(max(wait, 2 ** attempt) * random.uniform(0.8, 1.2))
+
+    async def _generate_one(self, topic: str) -> bool:
+        progress = self.writer.topic(topic)
+        progress["attempts"] += 1
+        try:
+            conversation = await self._complete(build_prompt(topic))
+        except (httpx.HTTPError, ValueError, KeyError, IndexError) as e:
+            # پاسخ HTTP ناموفق یا بدنهٔ بدشکل (JSON نامعتبر، choices خالی)؛ worker نباید بمیرد
+            self.stats["errors"] += 1
+            print(f" Error generating for {topic!r}: {e}", file=sys.stderr)
+            return False
+        sample = parse_example(conversation)
+        if sample is None:
+            self.stats["unparsable"] += 1
+            return False
+        if not self.writer.add(topic, sample):
+            self.stats["duplicates"] += 1
+            return False
+        self.stats["kept"] += 1
+        return True
+
+    async def run(self, topics: list[str], per_topic: int, attempts_factor: int = 3) -> None:
+        """
+        یک توکن برای هر نمونهٔ باقی‌مانده، موضوع‌ها یک در میان (تا همهٔ موضوع‌ها هم‌زمان پیش بروند).
+        توکن ناموفق دوباره در صف می‌رود تا تلاش‌های این اجرا برای آن موضوع به remaining * attempts_factor برسد.
+        """
+        queue: asyncio.Queue[str] = asyncio.Queue()
+        remaining = {t: max(0, per_topic - self.writer.topic(t)["kept"]) for t in topics}
+        budget = {t: n * attempts_factor for t, n in remaining.items()}
+        for i in range(max(remaining.values(), default=0)):
+            for t in topics:
+                if i < remaining[t]:
+                    queue.put_nowait(t)
+
+        async def worker():
+            while True:
+                topic = await queue.get()
+                try:
+                    budget[topic] -= 1
+                    if not await self._generate_one(topic) and budget[topic] > 0:
+                        queue.put_nowait(topic)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            await queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def load_topics(args) -> list[str]:
+    topics = list(args.topic or [])
+    if args.topics_file:
+        with open(args.topics_file, "r", encoding="utf-8") as f:
+            topics += [line.strip() for line in f if line.strip()]
+    return list(dict.fromkeys(topics or DEFAULT_TOPICS))
+
+
+async def _main(args) -> dict:
+    topics = load_topics(args)
+    backend = make_backend(args.backend, args.model, args.base_url, args.api_key, args.concurrency)
+    writer = CheckpointWriter(Path(args.output), flush_every=args.flush_every)
+    resumed = sum(writer.topic(t)["kept"] for t in topics)
+    gen = Generator(
+        backend,
+        writer,
+        concurrency=args.concurrency,
+        rps=args.rps,
+        retries=args.retries,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+    )
+    t0 = time.perf_counter()
+    try:
+        await gen.run(topics, args.per_topic, attempts_factor=args.attempts_factor)
+    finally:
+        writer.close()
+        await backend.aclose()
+    seconds = time.perf_counter() - t0
     return {
-        "instruction": instruction,
-        "input": "",
-        "output": output
+        "topics": len(topics),
+        "resumed": resumed,
+        **gen.stats,
+        "seconds": round(seconds, 3),
+        "samples_per_second": round(gen.stats["kept"] / seconds, 2) if seconds else None,
+        "per_topic": {t: writer.topic(t) for t in topics},
     }
 
-def save_to_jsonl(data, path):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(data, ensure_ascii=False) + "\n")
 
-def generate_batch(n=10):
-    for _ in range(n):
-        sample = generate_negotiation_example()
-        if sample:
-            save_to_jsonl(sample, SAVE_PATH)
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-o", "--output", default=SAVE_PATH)
+    ap.add_argument("--backend", choices=["openai", "ollama"], default="openai")
+    ap.add_argument("--model", default=None, help="default: gpt-4 (openai) or LLM_MODEL (ollama)")
+    ap.add_argument("--base-url", default=None, help="default: OPENAI_BASE_URL / OLLAMA_BASE_URL")
+    ap.add_argument("--api-key", default=None, help="default: OPENAI_API_KEY")
+    ap.add_argument("--topic", action="append", help="may be repeated")
+    ap.add_argument("--topics-file", default=None, help="one topic per line")
+    ap.add_argument("--per-topic", type=int, default=10, help="samples to keep per topic (counting earlier runs)")
+    ap.add_argument("--attempts-factor", type=int, default=3, help="give up on a topic after remaining * this attempts in one run")
+    ap.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    ap.add_argument("--rps", type=float, default=0, help="max requests per second; 0 = unlimited")
+    ap.add_argument("--retries", type=int, default=4, help="retries on 429/5xx/network errors")
+    ap.add_argument("--temperature", type=float, default=0.7)
+    ap.add_argument("--max-tokens", type=int, default=512)
+    ap.add_argument("--flush-every", type=int, default=20, help="samples between flush + progress checkpoint")
+    args = ap.parse_args()
+
+    report = asyncio.run(_main(args))
+    print(json.dumps(report, indent=2, ensure_ascii=False), file=sys.stderr)
+
 
 if __name__ == "__main__":
-    generate_batch(n=10)
+    main()
@@ -0,0 +1,284 @@
+"""
+حذف جفت‌های تقریباً تکراری (MinHash + LSH) روی shingleهای کاراکتری متن نرمال‌شدهٔ فارسی.
+
+    python scripts/near_dedup.py datasets/cleaned_dataset.jsonl -o datasets/dedup.jsonl --threshold 0.8
+    python scripts/dataset_pipeline.py datasets/dataset.json -o out.jsonl --near-dup 0.8   # به عنوان یک مرحله
+
+هر جفت فقط با امضای MinHash (num_perm عدد ۳۲ بیتی) و کلیدهای ۶۴ بیتی bandها نگه داشته می‌شود، نه با متن.
+جدول‌های LSH و امضاها کوچک شروع می‌شوند و با تعداد جفت‌های یکتا دو برابر می‌شوند؛ --capacity سقف آن‌هاست.
+بعد از رسیدن به سقف، جفت‌های یکتای بعدی نگه داشته می‌شوند ولی دیگر ایندکس نمی‌شوند (unindexed در گزارش).
+"""
+import argparse
+import json
+import re
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+_GRAM_BASE = np.uint64(1_000_003)
+_SHIFT = np.uint64(32)
+
+# یکسان‌سازی حروف عربی/فارسی، حذف اعراب و نیم‌فاصله، ارقام فارسی و عربی → لاتین
+_CHAR_MAP = str.maketrans({
+    "\u064a": "\u06cc", "\u0649": "\u06cc", "\u0643": "\u06a9", "\u0629": "\u0647", "\u06c0": "\u0647",
+    "\u0623": "\u0627", "\u0625": "\u0627", "\u0622": "\u0627", "\u0624": "\u0648",
+    "\u200c": " ", "\u200e": None, "\u200f": None, "\u0640": None,
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+_DIACRITICS_RE = re.compile(r"[\u064B-\u065F\u0670]")
+_WS_RE = re.compile(r"\s+")
+_REPEAT_RE = re.compile(r"(.)\1{2,}")      # «سلاااام» → «سلام»
+
+
+def normalize(text: str) -> str:
+    text = _DIACRITICS_RE.sub("", text.translate(_CHAR_MAP)).lower()
+    text = _REPEAT_RE.sub(r"\1", text)
+    return _WS_RE.sub(" ", text).strip()
+
+
+def shingle_hashes(text: str, k: int = 5) -> np.ndarray:
+    """hash چندجمله‌ای ۶۴ بیتی همهٔ n-gramهای کاراکتری، برداری با numpy (بدون ساختن رشتهٔ هر shingle)."""
+    cp = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if cp.size <= k:
+        k = max(cp.size, 1)
+        cp = cp if cp.size else np.zeros(1, dtype=np.uint64)
+    n = cp.size - k + 1
+    hv = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        hv = hv * _GRAM_BASE + cp[j:j + n]     # سرریز uint64 همان mod 2^64 است
+    return hv
+
+
+def choose_bands(threshold: float, num_perm: int) -> tuple[int, int]:
+    """(bands, rows) با bands*rows=num_perm که آستانهٔ LSH یعنی (1/b)^(1/r) نزدیک‌ترین به threshold باشد."""
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        err = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or err < best[0]:
+            best = (err, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """امضای MinHash با num_perm تابع hash از نوع multiply-shift یعنی ((a*x + b) mod 2^64) >> 32 روی hash هر shingle."""
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # a باید فرد باشد
+        self.a = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+        self.b = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hv = shingle_hashes(normalize(text), self.shingle_size)
+        phv = (np.outer(self.a, hv) + self.b[:, None]) >> _SHIFT
+        return phv.min(axis=1).astype(np.uint32)
+
+    def pair_signature(self, pair: dict) -> np.ndarray:
+        return self.signature(pair["instruction"] + " | " + pair["output"])
+
+
+class _BandTable:
+    """
+    hash table با آدرس‌دهی باز روی numpy: کلید ۶۴ بیتی band → شمارهٔ جفت نماینده.
+    با رسیدن ضریب بار به 0.5 اندازه دو برابر و کلیدها (برداری) دوباره درج می‌شوند.
+    """
+    def __init__(self, capacity: int):
+        size = 1 << max(4, (2 * capacity - 1).bit_length())     # ضریب بار ≤ 0.5
+        self.mask = size - 1
+        self.keys = np.zeros(size, dtype=np.uint64)               # 0 = خالی
+        self.values = np.zeros(size, dtype=np.int32)
+        self.count = 0
+
+    def _insert_many(self, keys: np.ndarray, values: np.ndarray) -> None:
+        """درج کلیدهای یکتا و غایب؛ در هر دور هر خانهٔ خالی به اولین مدعی می‌رسد و بقیه یک خانه جلو می‌روند."""
+        slots = (keys & np.uint64(self.mask)).astype(np.int64)
+        while keys.size:
+            cand = np.flatnonzero(self.keys[slots] == 0)
+            _, first = np.unique(slots[cand], return_index=True)
+            win = cand[first]
+            self.keys[slots[win]] = keys[win]
+            self.values[slots[win]] = values[win]
+            rest = np.ones(keys.size, dtype=bool)
+            rest[win] = False
+            keys, values, slots = keys[rest], values[rest], (slots[rest] + 1) & self.mask
+
+    def _grow(self) -> None:
+        used = self.keys != 0
+        keys, values = self.keys[used], self.values[used]
+        size = 2 * (self.mask + 1)
+        self.mask = size - 1
+        self.keys = np.zeros(size, dtype=np.uint64)
+        self.values = np.zeros(size, dtype=np.int32)
+        self._insert_many(keys, values)
+
+    def _slot(self, key: int) -> int:
+        i = key & self.mask
+        keys = self.keys
+        while keys[i] and keys[i] != key:
+            i = (i + 1) & self.mask
+        return i
+
+    def get(self, key: int) -> int | None:
+        i = self._slot(key)
+        return int(self.values[i]) if self.keys[i] else None
+
+    def put(self, key: int, value: int) -> None:
+        i = self._slot(key)
+        if not self.keys[i]:
+            self.keys[i] = key
+            self.values[i] = value
+            self.count += 1
+            if 2 * self.count > self.mask + 1:
+                self._grow()
+
+
+class NearDuplicateIndex:
+    """
+    ایندکس LSH آنلاین: check_add(sig) جفت را با جفت‌های قبلی مقایسه و در صورت یکتا بودن اضافه می‌کند.
+    کاندیداهای LSH با شباهت تخمینی امضاها (کسر مؤلفه‌های برابر) نسبت به threshold تأیید می‌شوند.
+    آرایه‌ها از initial جفت شروع و تا capacity دو برابر می‌شوند، پس حافظه متناسب با ورودی است.
+    """
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, capacity: int = 1_000_000, initial: int = 1024):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = choose_bands(threshold, num_perm)
+        self.capacity = capacity
+        rows = max(1, min(capacity, initial))
+        self.tables = [_BandTable(rows) for _ in range(self.bands)]
+        self.signatures = np.zeros((rows, num_perm), dtype=np.uint32)
+        self.cluster_size = np.ones(rows, dtype=np.int32)        # اندازهٔ خوشهٔ هر نماینده (با خودش)
+        self.indexed = 0
+        self.unindexed = 0
+        self.seen = 0
+
+    def _band_keys(self, sig: np.ndarray) -> list[int]:
+        bands = sig.reshape(self.bands, self.rows)
+        # crc32 دو نیمهٔ ۳۲ بیتی ↔ کلید ۶۴ بیتی غیر صفر
+        return [
+            ((zlib.crc32(row.tobytes()) << 32) | zlib.crc32(row.tobytes(), i + 1)) | 1
+            for i, row in enumerate(bands)
+        ]
+
+    def check_add(self, sig: np.ndarray) -> int | None:
+        """شمارهٔ نماینده اگر جفت تکراری باشد، وگرنه None (و جفت ایندکس می‌شود)."""
+        self.seen += 1
+        keys = self._band_keys(sig)
+        checked = set()
+        for table, key in zip(self.tables, keys):
+            rep = table.get(key)
+            if rep is None or rep in checked:
+                continue
+            checked.add(rep)
+            if np.count_nonzero(self.signatures[rep] == sig) >= self.threshold * self.num_perm:
+                self.cluster_size[rep] += 1
+                return rep
+        if self.indexed >= self.capacity:
+            self.unindexed += 1
+            return None
+        rep = self.indexed
+        if rep == len(self.signatures):
+            self._grow()
+        self.signatures[rep] = sig
+        for table, key in zip(self.tables, keys):
+            table.put(key, rep)
+        self.indexed += 1
+        return None
+
+    def _grow(self) -> None:
+        rows = min(self.capacity, 2 * len(self.signatures))
+        extra = rows - len(self.signatures)
+        self.signatures = np.concatenate([self.signatures, np.zeros((extra, self.num_perm), dtype=np.uint32)])
+        self.cluster_size = np.concatenate([self.cluster_size, np.ones(extra, dtype=np.int32)])
+
+    def memory_mb(self) -> float:
+        table = sum(t.keys.nbytes + t.values.nbytes for t in self.tables)
+        return round((table + self.signatures.nbytes + self.cluster_size.nbytes) / 1e6, 1)
+
+    def cluster_stats(self, top: int = 10) -> dict:
+        sizes = self.cluster_size[:self.indexed]
+        dup = sizes[sizes > 1]
+        edges = [(2, 2), (3, 5), (6, 10), (11, 100), (101, None)]
+        hist = {}
+        for lo, hi in edges:
+            mask = (dup >= lo) if hi is None else ((dup >= lo) & (dup <= hi))
+            hist[f"{lo}+" if hi is None else (str(lo) if lo == hi else f"{lo}-{hi}")] = int(mask.sum())
+        order = np.argsort(-sizes)[:top]
+        return {
+            "pairs": self.seen,
+            "unique": self.indexed + self.unindexed,
+            "duplicates": int((dup - 1).sum()),
+            "clusters_with_duplicates": int(dup.size),
+            "largest_cluster": int(sizes.max()) if sizes.size else 0,
+            "cluster_size_histogram": hist,
+            "top_clusters": [(int(i), int(sizes[i])) for i in order if sizes[i] > 1],
+            "unindexed": self.unindexed,
+            "bands": self.bands,
+            "rows": self.rows,
+            "index_mb": self.memory_mb(),
+        }
+
+
+def _examples(path: str, reps: dict[int, int]) -> list[dict]:
+    """متن نمایندهٔ بزرگ‌ترین خوشه‌ها از فایل خروجی (شمارهٔ نماینده = شمارهٔ ترتیب آن در ایندکس)"""
+    found = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i in reps:
+                found[i] = {"size": reps[i], **json.loads(line)}
+                if len(found) == len(reps):
+                    break
+    return [found[i] for i in reps if i in found]
+
+
+def dedup(pairs: Iterable[dict], output_path: str, hasher: MinHasher, index: NearDuplicateIndex) -> Iterator[dict]:
+    """جفت‌های یکتا را در output_path (JSONL) می‌نویسد و همان‌ها را yield می‌کند."""
+    with open(output_path, "w", encoding="utf-8") as out:
+        for pair in pairs:
+            if index.check_add(hasher.pair_signature(pair)) is None:
+                out.write(json.dumps(pair, ensure_ascii=False) + "\n")
+                yield pair
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("input", help="pairs as JSONL or a JSON array of {instruction, input, output}")
+    ap.add_argument("-o", "--output", required=True)
+    ap.add_argument("--threshold", type=float, default=0.8, help="estimated Jaccard similarity to count as duplicate")
+    ap.add_argument("--num-perm", type=int, default=64)
+    ap.add_argument("--shingle-size", type=int, default=5, help="character n-gram size")
+    ap.add_argument("--capacity", type=int, default=1_000_000, help="max unique pairs kept in the index (caps memory; tables grow with the input)")
+    ap.add_argument("--examples", type=int, default=5, help="print this many largest clusters with text")
+    args = ap.parse_args()
+
+    hasher = MinHasher(args.num_perm, args.shingle_size)
+    index = NearDuplicateIndex(args.threshold, args.num_perm, args.capacity)
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+
+    # خواندن جریانی (آرایهٔ JSON یا JSONL) مثل dataset_pipeline
+    from dataset_pipeline import iter_json
+
+    t0 = time.perf_counter()
+    kept = sum(1 for _ in dedup(iter_json(args.input), args.output, hasher, index))
+    seconds = time.perf_counter() - t0
+    report = {
+        "kept": kept,
+        "seconds": round(seconds, 3),
+        "pairs_per_second": round(index.seen / seconds, 1) if seconds else None,
+        **index.cluster_stats(),
+    }
+    if args.examples:
+        report["examples"] = _examples(args.output, dict(report["top_clusters"][:args.examples]))
+    print(json.dumps(report, indent=2, ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,341 @@
+"""
+ترجمهٔ هم‌زمان و قابل ادامهٔ dataset به فارسی با مدل محلی Ollama.
 
+    python translated_data/translate.py --fraction 0.001 --concurrency 4 --batch-size 8
+    python translated_data/translate.py --json-out translated_data/translated_sample.json   # ادامه از همان checkpoint
 
+- حداکثر --concurrency درخواست هم‌زمان به Ollama؛ رشته‌های کوتاه تک‌خطی تا --batch-size تا در یک prompt
+  (خطوط شماره‌دار) فرستاده می‌شوند و اگر پاسخ قابل تفکیک نبود، تک‌تک ترجمه می‌شوند.
+- هر آیتم به محض کامل شدن در خروجی JSONL (با شمارهٔ آیتم) نوشته می‌شود؛ اجرای دوباره آیتم‌های انجام‌شده را رد می‌کند.
+- کش دائمی (SQLite) با کلید sha256 از (مدل، نسخهٔ prompt، متن): هر رشتهٔ تکراری فقط یک بار ترجمه می‌شود.
+- آیتمی که ترجمه‌اش خطا بدهد نوشته نمی‌شود تا در اجرای بعدی دوباره امتحان شود.
+برای تست بدون مدل واقعی:  OLLAMA_BASE_URL=http://localhost:11435 (python -m app.ollama_stub در webapp/backendcode)
+"""
+import argparse
+import asyncio
+import hashlib
 import json
-from langchain.chat_models import ChatOllama
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import httpx
 from langchain.schema import SystemMessage, HumanMessage
 from tqdm import tqdm
-import time
 
-model = ChatOllama(
-    model="llama3.1",
-    temperature=0.6
-)
+# کلاینت مشترک Ollama (pool اتصال، keep_alive، timeout) از backend وب‌اپ
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "webapp" / "backendcode"))
+from app.llm import build_chat_model  # noqa: E402
+
+HERE = Path(__file__).resolve().parent
+FIELDS = ("instruction", "output")          # input در این dataset خالی است و ترجمه نمی‌شود
+PROMPT_VERSION = "1"                        # با تغییر promptها عوض شود تا کش قدیمی استفاده نشود
+SYSTEM = "You are a professional Persian translator."
+_NUMBERED_RE = re.compile(r"^\s*(\d+)[.)]\s*(.*)$")
+
+
+# ---------- cache ----------
+class TranslationCache:
+    """کش دائمی content-addressed: sha256(model, PROMPT_VERSION, text) → ترجمه"""
+    def __init__(self, path: str, model: str):
+        self.model = model
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, source TEXT, target TEXT)")
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{PROMPT_VERSION}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT target FROM translations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put_many(self, rows: list[tuple[str, str, str]]) -> None:
+        """rows: (key, source, target) ؛ یک commit برای هر batch"""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)", rows)
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# ---------- translation ----------
+def _batch_prompt(texts: list[str]) -> str:
+    lines = "\n".join(f"{i}. {t}" for i, t in enumerate(texts, 1))
+    return (
+        "Translate each numbered line into Persian. Reply with the same numbers, one line per item, "
+        "and only the translations.\n\n" + lines
+    )
+
+
+def parse_numbered(reply: str, n: int) -> list[str] | None:
+    """خطوط «i. ترجمه» ؛ None اگر دقیقاً شماره‌های 1..n نیامده باشند"""
+    found = {}
+    for line in reply.splitlines():
+        m = _NUMBERED_RE.match(line)
+        if m and 1 <= int(m.group(1)) <= n and int(m.group(1)) not in found:
+            found[int(m.group(1))] = m.group(2).strip()
+    if len(found) != n:
+        return None
+    return [found[i] for i in range(1, n + 1)]
+
+
+class Translator:
+    """
+    ترجمهٔ async با micro-batching: translate(text) رشته را در صف می‌گذارد و batcher تا batch_size رشته
+    (یا هر چه در linger ثانیه رسید) را در یک درخواست می‌فرستد. رشتهٔ در حال ترجمه دوباره فرستاده نمی‌شود.
+    """
+    def __init__(
+        self,
+        model,
+        cache: TranslationCache,
+        concurrency: int = 4,
+        batch_size: int = 8,
+        max_batch_chars: int = 1500,
+        retries: int = 2,
+        linger: float = 0.05,
+    ):
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batch_chars = max_batch_chars
+        self.retries = retries
+        self.linger = linger
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._batcher: asyncio.Task | None = None
+        self.stats = {"llm_calls": 0, "batches": 0, "batch_fallbacks": 0, "retries": 0, "errors": 0}
+
+    async def translate(self, text: str) -> str:
+        if not text.strip():
+            return text
+        key = self.cache.key(text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight[key] = fut
+            self._queue.put_nowait((key, text, fut))
+            if self._batcher is None:
+                self._batcher = asyncio.create_task(self._batch_loop())
+        return await asyncio.shield(fut)
+
+    def _batchable(self, text: str) -> bool:
+        return "\n" not in text and len(text) <= self.max_batch_chars // 2
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self._batchable(batch[0][1]):
+                deadline = loop.time() + self.linger
+                chars = len(batch[0][1])
+                while len(batch) < self.batch_size:
+                    try:
+                        entry = await asyncio.wait_for(self._queue.get(), max(0.0, deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        break
+                    if not self._batchable(entry[1]) or chars + len(entry[1]) > self.max_batch_chars:
+                        self._spawn([entry])
+                        continue
+                    batch.append(entry)
+                    chars += len(entry[1])
+            # backpressure: batch بعدی فقط وقتی جمع می‌شود که جای خالی برای درخواست باشد
+            await self._slots.acquire()
+            self._spawn(batch, acquired=True)
+
+    def _spawn(self, batch: list[tuple], acquired: bool = False) -> None:
+        task = asyncio.create_task(self._run_batch(batch, acquired))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _invoke(self, prompt: str) -> str:
+        for attempt in range(self.retries + 1):
+            try:
+                self.stats["llm_calls"] += 1
+                response = await self.model.ainvoke([SystemMessage(content=SYSTEM), HumanMessage(content=prompt)])
+                return response.content.strip()
+            except httpx.HTTPError:
+                if attempt == self.retries:
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(2 ** attempt)
+
+    async def _translate_batch(self, texts: list[str]) -> list[str]:
+        if len(texts) > 1:
+            self.stats["batches"] += 1
+            parsed = parse_numbered(await self._invoke(_batch_prompt(texts)), len(texts))
+            if parsed is not None:
+                return parsed
+            self.stats["batch_fallbacks"] += 1
+        return [await self._invoke(f"Translate the following into Persian:\n{t}") for t in texts]
+
+    async def _run_batch(self, batch: list[tuple], acquired: bool) -> None:
+        if not acquired:
+            await self._slots.acquire()
+        try:
+            results = await self._translate_batch([text for _, text, _ in batch])
+            self.cache.put_many([(key, text, out) for (key, text, _), out in zip(batch, results)])
+            for (key, _, fut), out in zip(batch, results):
+                fut.set_result(out)
+        except Exception as e:
+            self.stats["errors"] += len(batch)
+            for _, _, fut in batch:
+                fut.set_exception(e)
+        finally:
+            self._slots.release()
+            for key, _, _ in batch:
+                self._inflight.pop(key, None)
+
+    async def aclose(self) -> None:
+        if self._batcher is not None:
+            self._batcher.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# ---------- checkpoint ----------
+def load_checkpoint(path: Path) -> set[int]:
+    """
+    شمارهٔ آیتم‌های نوشته‌شده در خروجی JSONL. خط ناقص آخر (کرش وسط نوشتن) حذف می‌شود
+    تا append بعدی خط خراب نسازد.
+    """
+    if not path.exists():
+        return set()
+    done, valid_bytes = set(), 0
+    with open(path, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(raw)["id"])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(raw)
+    if valid_bytes != path.stat().st_size:
+        with open(path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return done
+
+
+def export_json(jsonl_path: Path, json_path: Path) -> int:
+    """خروجی مرتب‌شده به شکل آرایهٔ JSON قدیمی (translated_sample.json)"""
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        rows = sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["id"])
+    items = [{k: r[k] for k in ("instruction", "input", "output")} for r in rows]
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(items, f, ensure_ascii=False, indent=2)
+    return len(items)
+
+
+# ---------- driver ----------
+async def translate_dataset(
+    items: list[dict],
+    output_path: Path,
+    translator: Translator,
+    max_pending: int = 256,
+) -> dict:
+    done = load_checkpoint(output_path)
+    todo = [(i, item) for i, item in enumerate(items) if i not in done]
+    stats = {"items": len(items), "resumed": len(items) - len(todo), "written": 0, "failed": 0}
+    pending = asyncio.Semaphore(max_pending)      # آیتم‌های در جریان؛ حافظه با اندازهٔ dataset رشد نکند
+    bar = tqdm(total=len(todo), desc="Translating")
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        async def one(i: int, item: dict) -> None:
+            try:
+                translated = await asyncio.gather(*(translator.translate(item.get(k, "")) for k in FIELDS))
+                row = {"id": i, **item, **dict(zip(FIELDS, translated))}
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                out.flush()
+                stats["written"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                tqdm.write(f" Error translating item {i}: {e}")
+            finally:
+                bar.update(1)
+                pending.release()
+
+        tasks = []
+        for i, item in todo:
+            await pending.acquire()
+            tasks.append(asyncio.create_task(one(i, item)))
+        await asyncio.gather(*tasks)
+        await translator.aclose()
+    bar.close()
+    return stats
+
+
+def load_items(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("input", nargs="?", default=str(HERE / "craigslist_formatted.json"))
+    ap.add_argument("-o", "--output", default=str(HERE / "translated_sample.jsonl"), help="checkpoint (JSONL)")
+    ap.add_argument("--json-out", default=None, help="also export the ordered result as a JSON array")
+    ap.add_argument("--cache", default=str(HERE / "translation_cache.sqlite"))
+    ap.add_argument("--model", default="llama3.1")
+    ap.add_argument("--temperature", type=float, default=0.6)
+    ap.add_argument("--fraction", type=float, default=1.0, help="translate only the first fraction of the dataset")
+    ap.add_argument("--limit", type=int, default=None, help="translate only the first N items")
+    ap.add_argument("--concurrency", type=int, default=4, help="max simultaneous requests to Ollama")
+    ap.add_argument("--batch-size", type=int, default=8, help="short strings per prompt; 1 disables batching")
+    ap.add_argument("--max-batch-chars", type=int, default=1500)
+    ap.add_argument("--retries", type=int, default=2)
+    args = ap.parse_args()
+
+    items = load_items(args.input)
+    n = max(1, int(len(items) * args.fraction))
+    items = items[:min(n, args.limit) if args.limit else n]
+
+    model = build_chat_model(args.model, temperature=args.temperature)
+    cache = TranslationCache(args.cache, model.model)
+    translator = Translator(
+        model,
+        cache,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        max_batch_chars=args.max_batch_chars,
+        retries=args.retries,
+    )
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
 
-def translate_text(text):
-    if not text.strip():
-        return text
+    t0 = time.perf_counter()
     try:
-        messages = [
-            SystemMessage(content="You are a professional Persian translator."),
-            HumanMessage(content=f"Translate the following into Persian:\n{text}")
-        ]
-        response = model.invoke(messages)
-        return response.content.strip()
-    except Exception as e:
-        print(" Error translating:", e)
-        return text
-
-with open("C:/python/langchain projects/roshd\data/translated_data/craigslist_formatted.json", "r", encoding="utf-8") as f:
-    dataset = json.load(f)
-
-sample_size = max(1, int(len(dataset) * 0.001))
-subset = dataset[:sample_size]
-
-translated_dataset = []
-for item in tqdm(subset, desc="Translating 0.1% of data..."):
-    translated_item = {
-        "instruction": translate_text(item.get("instruction", "")),
-        "input": item.get("input", ""),
-        "output": translate_text(item.get("output", ""))
+        stats = asyncio.run(translate_dataset(items, output, translator, max_pending=args.concurrency * args.batch_size * 4))
+    finally:
+        cache.close()
+    seconds = time.perf_counter() - t0
+    report = {
+        **stats,
+        **translator.stats,
+        "cache_hits": cache.hits,
+        "cache_misses": cache.misses,
+        "seconds": round(seconds, 3),
+        "items_per_second": round(stats["written"] / seconds, 2) if seconds else None,
     }
-    translated_dataset.append(translated_item)
-    time.sleep(0.5)
+    if args.json_out:
+        report["exported"] = export_json(output, Path(args.json_out))
+    print(json.dumps(report, indent=2, ensure_ascii=False), file=sys.stderr)
 
-with open("translated_sample.json", "w", encoding="utf-8") as f:
-    json.dump(translated_dataset, f, ensure_ascii=False, indent=2)
 
-print(" ترجمه 1٪ از دیتا انجام شد و در 'translated_sample.json' ذخیره شد.")
+if __name__ == "__main__":
+    main()
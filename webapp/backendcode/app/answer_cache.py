@@ -0,0 +1,141 @@
+import re
+import threading
+import time
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from .cache import LRUCache
+
+_PUNCT_RE = re.compile(r"[؟?!.،,؛;:\"'«»()\[\]]+")
+_SPACE_RE = re.compile(r"\s+")
+_CHAR_MAP = str.maketrans({"ي": "ی", "ك": "ک", "‌": " "})
+
+
+def normalize_query(query: str) -> str:
+    """نسخهٔ سبک برای کلید کش: حروف عربی→فارسی، حذف علائم و فاصله‌های اضافه."""
+    q = query.translate(_CHAR_MAP).lower()
+    q = _PUNCT_RE.sub(" ", q)
+    return _SPACE_RE.sub(" ", q).strip()
+
+
+class _DocAnswers:
+    """پاسخ‌های کش‌شدهٔ یک doc_id؛ ماتریس بردارها برای مقایسهٔ یک‌جا."""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.vectors: np.ndarray | None = None
+        self.items: list[dict] = []   # {"answer", "created", "last_hit", "latency", "version"}
+        self.lock = threading.Lock()
+
+    def _drop(self, keep: np.ndarray) -> None:
+        self.items = [it for it, k in zip(self.items, keep) if k]
+        self.vectors = self.vectors[keep] if self.items else None
+
+    def expire(self, ttl: float | None, now: float, version=None) -> None:
+        """پاسخ‌های قدیمی‌تر از ttl و پاسخ‌های ساخته‌شده از نسخهٔ دیگری از ایندکس"""
+        if self.items:
+            keep = np.array([
+                (not ttl or now - it["created"] <= ttl) and it["version"] == version for it in self.items
+            ])
+            if not keep.all():
+                self._drop(keep)
+
+    def best(self, q: np.ndarray) -> tuple[int, float]:
+        if self.vectors is None:
+            return -1, 0.0
+        sims = self.vectors @ q
+        i = int(np.argmax(sims))
+        return i, float(sims[i])
+
+    def add(self, q: np.ndarray, item: dict) -> None:
+        if len(self.items) >= self.max_entries:
+            # کم‌استفاده‌ترین (قدیمی‌ترین last_hit) بیرون می‌رود
+            victim = min(range(len(self.items)), key=lambda i: self.items[i]["last_hit"])
+            keep = np.ones(len(self.items), dtype=bool)
+            keep[victim] = False
+            self._drop(keep)
+        self.items.append(item)
+        row = q[None, :]
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+
+
+class SemanticAnswerCache:
+    """
+    کش پاسخ بر اساس شباهت embedding سؤال نرمال‌شده، جدا برای هر doc_id.
+    اگر شباهت کسینوسی با یک سؤال قبلی ≥ threshold باشد، همان پاسخ برمی‌گردد.
+    هر پاسخ نسخهٔ ایندکسی را که از آن ساخته شده نگه می‌دارد (version در lookup/store)؛ پاسخ نسخهٔ دیگر miss
+    است و دور ریخته می‌شود، پس بازسازی ایندکس در پروسهٔ دیگر هم پاسخ کهنه برنمی‌گرداند.
+    invalidate(doc_id) همان کار را فوراً برای کل doc_id انجام می‌دهد.
+    """
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        threshold: float = 0.92,
+        ttl: float | None = 86400,
+        max_docs: int | None = 1000,
+        max_per_doc: int = 200,
+    ):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl or None
+        self.max_per_doc = max_per_doc
+        self._docs = LRUCache(max_entries=max_docs)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.lookup_seconds = 0.0
+
+    def embed(self, query: str) -> np.ndarray:
+        v = np.asarray(self.embeddings.embed_query(normalize_query(query)), dtype="float32")
+        n = np.linalg.norm(v)
+        return v / n if n else v
+
+    def lookup(self, doc_id: str, query: str, version=None) -> tuple[str | None, np.ndarray]:
+        """(answer یا None, بردار سؤال)؛ بردار را به store بدهید تا دوباره embed نشود."""
+        t0 = time.perf_counter()
+        q = self.embed(query)
+        answer, item = None, None
+        bucket = self._docs.get(doc_id)
+        if bucket is not None:
+            now = time.time()
+            with bucket.lock:
+                bucket.expire(self.ttl, now, version)
+                i, sim = bucket.best(q)
+                if i >= 0 and sim >= self.threshold:
+                    item = bucket.items[i]
+                    item["last_hit"] = now
+                    answer = item["answer"]
+        with self._lock:
+            self.lookup_seconds += time.perf_counter() - t0
+            if answer is not None:
+                self.hits += 1
+                self.saved_seconds += item["latency"]
+            else:
+                self.misses += 1
+        return answer, q
+
+    def store(self, doc_id: str, q: np.ndarray, answer: str, latency: float, version=None) -> None:
+        bucket = self._docs.get_or_load(doc_id, lambda: _DocAnswers(self.max_per_doc))
+        now = time.time()
+        with bucket.lock:
+            bucket.expire(self.ttl, now, version)
+            i, sim = bucket.best(q)
+            if i >= 0 and sim >= self.threshold:
+                return
+            bucket.add(q, {"answer": answer, "created": now, "last_hit": now, "latency": latency, "version": version})
+
+    def invalidate(self, doc_id: str) -> None:
+        self._docs.invalidate(doc_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "docs": len(self._docs),
+                "entries": sum(len(b.items) for b in self._docs.values()),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "latency_saved_seconds": round(self.saved_seconds, 3),
+                "lookup_seconds_total": round(self.lookup_seconds, 3),
+            }
@@ -0,0 +1,320 @@
+"""
+حالت سرویس async برای همان endpointهای app.server (aiohttp).
+    python -m app.async_server            # پورت 8000 ، یا ASYNC_HOST / ASYNC_PORT
+فراخوانی‌های LLM روی event loop اجرا می‌شوند و هر درخواست چت تا گرفتن slot از llm_limiter منتظر می‌ماند؛
+کارهای DB و دیسک با asyncio.to_thread از loop بیرون می‌روند. پیکربندی و اشیای مشترک
+(pipeline، rag_manager، ingest_queue، llm_limiter) همان نمونه‌های app.server هستند.
+"""
+import asyncio
+import json
+import os
+import time
+from uuid import uuid4
+from aiohttp import web
+from pydantic import ValidationError
+
+from app import server as core
+from app.jobs import QueueFull
+from app.limiter import Overloaded
+from app.metrics import REGISTRY, CONTENT_TYPE, current_trace, end_trace, observe_request, observe_stages, span, start_trace
+
+routes = web.RouteTableDef()
+
+
+def _json(data: dict, status: int = 200, headers: dict | None = None) -> web.Response:
+    return web.json_response(data, status=status, headers=headers, dumps=lambda d: json.dumps(d, ensure_ascii=False, default=str))
+
+
+def _overloaded(e: Overloaded) -> web.Response:
+    return _json({"error": e.reason, "retry_after": e.retry_after}, 429, {"Retry-After": str(e.retry_after)})
+
+
+async def _save_upload(field, path) -> None:
+    with open(path, "wb") as out:
+        while True:
+            block = await field.read_chunk(1 << 20)
+            if not block:
+                break
+            await asyncio.to_thread(out.write, block)
+
+
+async def _read_form(request: web.Request, src_path) -> tuple[dict, bool]:
+    """فیلدهای متنی multipart و ذخیرهٔ فایل pdf در src_path: (fields, has_pdf)"""
+    fields, has_pdf = {}, False
+    reader = await request.multipart()
+    async for field in reader:
+        if field.name == "file":
+            if field.filename and field.filename.lower().endswith(".pdf"):
+                await _save_upload(field, src_path)
+                has_pdf = True
+        else:
+            fields[field.name] = (await field.text()).strip()
+    return fields, has_pdf
+
+
+def _queued(freelancer_id: str, job_id: str) -> web.Response:
+    return _json(
+        {"message": "queued", "job_id": job_id, "freelancer_id": freelancer_id, "status_url": f"/jobs/{job_id}"},
+        202, {"Location": f"/jobs/{job_id}"},
+    )
+
+
+@routes.get("/health")
+async def health(request: web.Request):
+    return _json({"status": "ok"})
+
+
+@routes.get("/metrics")
+async def metrics(request: web.Request):
+    text = await asyncio.to_thread(REGISTRY.render)
+    return web.Response(text=text, headers={"Content-Type": CONTENT_TYPE})
+
+
+@routes.get("/stats/cache")
+async def cache_stats(request: web.Request):
+    per_entry = request.query.get("items", "1") != "0"
+    rag = core.rag_manager
+    return _json({
+        "rag": rag.cache_stats(per_entry=per_entry),
+        "sessions": rag.session_stats(),
+        "answers": rag.answer_cache_stats(),
+        "chat": rag.stage_stats(),
+        "llm": core.llm_limiter.stats(),
+        "freelancers": core.freelancer_cache.stats(),
+        "shared_index": core.shared_index.stats() if core.shared_index else None,
+        "search": core.skill_search.stats(),
+    })
+
+
+@routes.get("/docs")
+async def list_docs(request: web.Request):
+    try:
+        limit, cursor = core.page_params(request.query)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+    items, next_cursor = await asyncio.to_thread(core.doc_items, limit, cursor)
+    return _json({"items": items, "next_cursor": next_cursor})
+
+
+@routes.post("/freelancers")
+async def create_freelancer(request: web.Request):
+    freelancer_id = str(uuid4())
+    job_id = core.ingest_queue.new_job_id()
+    src_path = core.upload_path(freelancer_id, job_id)
+    fields, has_pdf = await _read_form(request, src_path)
+    name = fields.get("name", "")
+    if not name or not has_pdf:
+        src_path.unlink(missing_ok=True)
+        return _json({"error": "name is required" if not name else "file (.pdf) is required"}, 400)
+    try:
+        await asyncio.to_thread(
+            core.ingest_queue.submit, freelancer_id, name, fields.get("description", ""), str(src_path), job_id
+        )
+    except QueueFull:
+        src_path.unlink(missing_ok=True)
+        return _json({"error": "ingestion queue is full, try again later"}, 503, {"Retry-After": "30"})
+    return _queued(freelancer_id, job_id)
+
+
+@routes.put("/freelancers/{freelancer_id}/file")
+async def replace_freelancer_file(request: web.Request):
+    freelancer_id = request.match_info["freelancer_id"]
+    fr = await asyncio.to_thread(core.freelancer_dict, freelancer_id)
+    if not fr:
+        return _json({"error": "freelancer not found"}, 404)
+    job_id = core.ingest_queue.new_job_id()
+    src_path = core.upload_path(freelancer_id, job_id)
+    _fields, has_pdf = await _read_form(request, src_path)
+    if not has_pdf:
+        src_path.unlink(missing_ok=True)
+        return _json({"error": "file (.pdf) is required"}, 400)
+    try:
+        await asyncio.to_thread(
+            core.ingest_queue.submit, freelancer_id, fr["name"], fr["description"], str(src_path), job_id
+        )
+    except QueueFull:
+        src_path.unlink(missing_ok=True)
+        return _json({"error": "ingestion queue is full, try again later"}, 503, {"Retry-After": "30"})
+    return _queued(freelancer_id, job_id)
+
+
+@routes.get("/jobs/{job_id}")
+async def get_job(request: web.Request):
+    out = await asyncio.to_thread(core.job_payload, request.match_info["job_id"])
+    if out is None:
+        return _json({"error": "job not found"}, 404)
+    return _json({"job": out})
+
+
+@routes.post("/jobs/{job_id}/retry")
+async def retry_job(request: web.Request):
+    job_id = request.match_info["job_id"]
+    try:
+        ok = await asyncio.to_thread(core.ingest_queue.retry, job_id)
+    except QueueFull:
+        return _json({"error": "ingestion queue is full, try again later"}, 503, {"Retry-After": "30"})
+    if ok is None:
+        return _json({"error": "job not found"}, 404)
+    if not ok:
+        return _json({"error": "job is not failed or its upload is no longer available"}, 409)
+    return _json({"message": "queued", "job_id": job_id, "status_url": f"/jobs/{job_id}"}, 202, {"Location": f"/jobs/{job_id}"})
+
+
+@routes.get("/freelancers")
+async def list_freelancers(request: web.Request):
+    try:
+        limit, cursor = core.page_params(request.query)
+    except ValueError as e:
+        return _json({"error": str(e)}, 400)
+    items, next_cursor = await asyncio.to_thread(core.freelancer_items, limit, cursor)
+    return _json({"items": items, "next_cursor": next_cursor})
+
+
+@routes.post("/search")
+async def search(request: web.Request):
+    try:
+        body = core.SearchBody(**(await request.json()))
+    except (ValidationError, ValueError, TypeError) as e:
+        errors = e.errors() if isinstance(e, ValidationError) else "invalid JSON body"
+        return _json({"error": errors}, 400)
+    err = core.search_error(body)
+    if err:
+        return _json({"error": err}, 400)
+    try:
+        results = await asyncio.to_thread(core.search_freelancers, body)
+    except Exception as e:
+        return _json({"error": str(e)}, 500)
+    return _json({"results": results})
+
+
+async def _parse_chat(request: web.Request):
+    try:
+        body = core.ChatBody(**(await request.json()))
+    except (ValidationError, ValueError, TypeError) as e:
+        errors = e.errors() if isinstance(e, ValidationError) else "invalid JSON body"
+        return None, None, _json({"error": errors}, 400)
+    timings = {}
+    with span("db", timings):
+        doc_id, err = await asyncio.to_thread(core.resolve_doc_id, body)
+    observe_stages("chat", timings)
+    if err:
+        return body, None, _json({"error": err[0]}, err[1])
+    return body, doc_id, None
+
+
+@routes.post("/chat")
+async def chat(request: web.Request):
+    body, doc_id, err = await _parse_chat(request)
+    if err:
+        return err
+    session_id = body.session_id or str(uuid4())
+    try:
+        answer = await core.rag_manager.aask(doc_id, body.query, session_id=session_id)
+        return _json({"answer": answer, "session_id": session_id})
+    except Overloaded as e:
+        return _overloaded(e)
+    except FileNotFoundError:
+        return _json({"error": "index not found for this id. create freelancer first."}, 404)
+    except Exception as e:
+        return _json({"error": str(e)}, 500)
+
+
+@routes.post("/chat/stream")
+async def chat_stream(request: web.Request):
+    body, doc_id, err = await _parse_chat(request)
+    if err:
+        return err
+    session_id = body.session_id or str(uuid4())
+
+    # مثل نسخهٔ Flask: 404 و 429 قبل از ارسال headerهای stream
+    pieces = core.rag_manager.astream(doc_id, body.query, session_id=session_id)
+    try:
+        first = await anext(pieces, None)
+    except Overloaded as e:
+        return _overloaded(e)
+    except FileNotFoundError:
+        return _json({"error": "index not found for this id. create freelancer first."}, 404)
+    except Exception as e:
+        return _json({"error": str(e)}, 500)
+
+    resp = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    parts = []
+    try:
+        # pieces قفل گفتگو و slot مدل را گرفته است؛ قطع اتصال هنگام prepare هم باید به aclose برسد
+        await resp.prepare(request)
+        if first is not None:
+            parts.append(first)
+            await resp.write(core._sse({"token": first}).encode("utf-8"))
+        async for piece in pieces:
+            parts.append(piece)
+            await resp.write(core._sse({"token": piece}).encode("utf-8"))
+        done = {"answer": "".join(parts), "session_id": session_id}
+        await resp.write(core._sse(done, event="done").encode("utf-8"))
+    except (ConnectionResetError, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        await resp.write(core._sse({"error": str(e)}, event="error").encode("utf-8"))
+    finally:
+        await pieces.aclose()
+    await resp.write_eof()
+    return resp
+
+
+# ---------- Request tracing (مثل before/after_request در app.server) ----------
+@web.middleware
+async def trace_requests(request: web.Request, handler):
+    # asyncio.to_thread context را کپی می‌کند، پس مراحل داخل threadها هم در همین trace ثبت می‌شوند
+    token = start_trace()
+    request["trace"] = current_trace()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        observe_request(request.method, route, status, time.perf_counter() - request["trace"].t_start)
+        end_trace(token)
+
+
+async def _timing_header(request: web.Request, response: web.StreamResponse) -> None:
+    trace = request.get("trace")
+    if trace is not None and core.wants_timings(request.headers):
+        response.headers["Server-Timing"] = trace.server_timing()
+
+
+# ---------- CORS (همان رفتار پیش‌فرض flask_cors در app.server) ----------
+@web.middleware
+async def cors_preflight(request: web.Request, handler):
+    if request.method != "OPTIONS":
+        return await handler(request)
+    resp = web.Response()
+    resp.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, OPTIONS"
+    resp.headers["Access-Control-Allow-Headers"] = request.headers.get("Access-Control-Request-Headers", "*")
+    return resp
+
+
+async def _cors_headers(request: web.Request, response: web.StreamResponse) -> None:
+    # on_response_prepare: برای stream هم قبل از ارسال headerها اجرا می‌شود
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    response.headers["Access-Control-Expose-Headers"] = "Server-Timing"
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[trace_requests, cors_preflight], client_max_size=200 * 1024 * 1024)
+    app.on_response_prepare.append(_cors_headers)
+    app.on_response_prepare.append(_timing_header)
+    app.add_routes(routes)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host=os.getenv("ASYNC_HOST", "0.0.0.0"), port=int(os.getenv("ASYNC_PORT", "8000")))
@@ -0,0 +1,238 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class _Entry:
+    __slots__ = ("value", "size", "created", "last_access", "hits", "load_seconds")
+
+    def __init__(self, value: Any, size: int, load_seconds: float):
+        now = time.monotonic()
+        self.value = value
+        self.size = size
+        self.created = now
+        self.last_access = now
+        self.hits = 0
+        self.load_seconds = load_seconds
+
+
+class LRUCache:
+    """
+    کش LRU محدود به تعداد و/یا حجم تخمینی (بایت) با TTL بیکاری.
+    loader برای هر کلید فقط یک بار اجرا می‌شود، حتی اگر چند thread هم‌زمان بخواهند.
+    on_evict(key, value) برای هر مقداری که از کش بیرون می‌رود (evict/expire/invalidate/جایگزینی/clear)
+    بیرون از قفل صدا زده می‌شود؛ مثلاً برای بستن فایل‌های mmap.
+    """
+    def __init__(
+        self,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        ttl: float | None = None,
+        sizeof: Callable[[Any], int] | None = None,
+        history_size: int = 1024,
+        on_evict: Callable[[Hashable, Any], None] | None = None,
+    ):
+        self.max_entries = max_entries or None
+        self.max_bytes = max_bytes or None
+        self.ttl = ttl or None
+        self.sizeof = sizeof or (lambda _v: 0)
+        self.on_evict = on_evict
+        self._dropped: list[tuple[Hashable, Any]] = []   # منتظر on_evict
+        self._data: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks: dict[Hashable, threading.Lock] = {}
+        self._bytes = 0
+        # شمارنده‌های کلی
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.load_seconds = 0.0
+        # miss/eviction هر کلید بعد از بیرون رفتن از کش هم نگه داشته می‌شود (محدود)
+        self._history: "OrderedDict[Hashable, dict]" = OrderedDict()
+        self._history_size = history_size
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    # ---------- internals (قفل باید گرفته شده باشد) ----------
+    def _hist(self, key: Hashable) -> dict:
+        h = self._history.get(key)
+        if h is None:
+            h = {"misses": 0, "evictions": 0}
+            self._history[key] = h
+            while len(self._history) > self._history_size:
+                self._history.popitem(last=False)
+        else:
+            self._history.move_to_end(key)
+        return h
+
+    def _remove(self, key: Hashable, reason: str) -> None:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        if self.on_evict is not None:
+            self._dropped.append((key, entry.value))
+        if reason == "evicted":
+            self.evictions += 1
+            self._hist(key)["evictions"] += 1
+        elif reason == "expired":
+            self.expirations += 1
+
+    def _expire(self, now: float) -> None:
+        if not self.ttl:
+            return
+        # ترتیب OrderedDict همان ترتیب دسترسی است؛ قدیمی‌ترها اول
+        while self._data:
+            key, entry = next(iter(self._data.items()))
+            if now - entry.last_access <= self.ttl:
+                break
+            self._remove(key, "expired")
+
+    def _shrink(self, keep: Hashable | None = None) -> None:
+        def over() -> bool:
+            if self.max_entries and len(self._data) > self.max_entries:
+                return True
+            return bool(self.max_bytes and self._bytes > self.max_bytes)
+
+        for key in list(self._data.keys()):
+            if not over():
+                break
+            if key == keep:
+                continue
+            self._remove(key, "evicted")
+
+    def _lookup(self, key: Hashable) -> _Entry | None:
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._data.get(key)
+        if entry is not None:
+            entry.hits += 1
+            entry.last_access = now
+            self._data.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def _notify(self) -> None:
+        """on_evict برای مقادیر بیرون‌رفته؛ بیرون از قفل تا hook بتواند کند یا بازگشتی باشد."""
+        if not self._dropped:
+            return
+        with self._lock:
+            dropped, self._dropped = self._dropped, []
+        for key, value in dropped:
+            try:
+                self.on_evict(key, value)
+            except Exception:
+                pass
+
+    # ---------- public ----------
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._lookup(key)
+            value = entry.value if entry is not None else default
+        self._notify()
+        return value
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        try:
+            return self._get_or_load(key, loader)
+        finally:
+            self._notify()
+
+    def _get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry.value
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # شاید thread دیگری در همین فاصله بارگذاری کرده باشد
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    return entry.value
+            try:
+                t0 = time.perf_counter()
+                value = loader()
+                elapsed = time.perf_counter() - t0
+                size = int(self.sizeof(value))
+                with self._lock:
+                    self.misses += 1
+                    self.load_seconds += elapsed
+                    self._hist(key)["misses"] += 1
+                    self._data[key] = _Entry(value, size, elapsed)
+                    self._bytes += size
+                    self._shrink(keep=key)
+                return value
+            finally:
+                with self._lock:
+                    if self._key_locks.get(key) is key_lock:
+                        del self._key_locks[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """مقدار از پیش آماده (بدون loader)؛ مقدار قبلی همین کلید جایگزین می‌شود."""
+        size = int(self.sizeof(value))
+        with self._lock:
+            self._remove(key, "invalidated")
+            self._data[key] = _Entry(value, size, 0.0)
+            self._bytes += size
+            self._shrink(keep=key)
+        self._notify()
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            existed = key in self._data
+            self._remove(key, "invalidated")
+        self._notify()
+        return existed
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._data):
+                self._remove(key, "invalidated")
+        self._notify()
+
+    def values(self) -> list:
+        with self._lock:
+            return [e.value for e in self._data.values()]
+
+    def stats(self, per_entry: bool = True) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            now = time.monotonic()
+            lookups = self.hits + self.misses
+            out = {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "load_seconds_total": round(self.load_seconds, 4),
+            }
+            if per_entry:
+                items = {}
+                for key, e in self._data.items():
+                    h = self._history.get(key, {})
+                    items[str(key)] = {
+                        "bytes": e.size,
+                        "hits": e.hits,
+                        "misses": h.get("misses", 0),
+                        "evictions": h.get("evictions", 0),
+                        "load_seconds": round(e.load_seconds, 4),
+                        "idle_seconds": round(now - e.last_access, 1),
+                    }
+                out["items"] = items
+        self._notify()
+        return out
@@ -0,0 +1,262 @@
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+COMPACT_DIR = "compact"
+FORMAT_VERSION = 1
+QUANTIZERS = ("sq8", "pq")
+# PQ با 256 مرکز در هر زیرفضا به چند هزار نمونهٔ آموزشی نیاز دارد؛ کمتر از این sq8 می‌گیریم
+_PQ_MIN_VECTORS = 4096
+# نسخه‌های قدیمی‌تر از نسخهٔ قبلی فقط وقتی پاک می‌شوند که این‌قدر (ثانیه) از نوشتنشان گذشته باشد
+STALE_GRACE_SECONDS = 600
+_LEGACY_FILES = ("vectors.faiss", "store.bin", "store.idx.npy")
+
+# IO_FLAG_MMAP_IFC کدهای index را بدون کپی از page cache می‌خواند (faiss >= 1.9)
+_MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+def _quantized_index(vectors: np.ndarray, quantizer: str):
+    d = vectors.shape[1]
+    if quantizer == "pq" and len(vectors) >= _PQ_MIN_VECTORS:
+        m = next(m for m in (32, 16, 8, 4, 2, 1) if d % m == 0)
+        index = faiss.IndexPQ(d, m, 8, faiss.METRIC_INNER_PRODUCT)
+        kind = "pq"
+    else:
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        kind = "sq8"
+    if len(vectors):
+        index.train(vectors)
+        index.add(vectors)
+    return index, kind
+
+
+def write_compact(vs, out_dir: str, quantizer: str = "sq8", embed_model: str | None = None) -> dict:
+    """
+    یک FAISS vectorstore (langchain) را به فرمت فشرده می‌نویسد:
+      vectors.faiss  بردارهای کوانتیزه (int8 یا PQ)، قابل mmap
+      store.bin      متن و metadata (JSON) همهٔ chunkها پشت سر هم
+      store.idx.npy  جدول offset با ستون‌های text_off, text_len, meta_off, meta_len
+      compact.json   مشخصات فرمت
+    فایل‌های داده در زیرپوشهٔ تازهٔ data-<id> نوشته می‌شوند و compact.json (که به آن اشاره می‌کند)
+    آخر و با os.replace جایگزین می‌شود؛ فایلی که CompactIndex دیگری mmap کرده هرگز درجا بازنویسی
+    نمی‌شود (بازنویسی درجا = SIGBUS). نسخهٔ قبلی همیشه می‌ماند تا readerی که compact.json قبلی را خوانده
+    (یا CompactIndex کش‌شده‌ای که store.bin را دوباره باز می‌کند) فایل‌هایش را پیدا کند؛ نسخه‌های قدیمی‌تر
+    بعد از STALE_GRACE_SECONDS پاک می‌شوند.
+    """
+    if quantizer not in QUANTIZERS:
+        raise ValueError(f"quantizer must be one of {QUANTIZERS}")
+    root = Path(out_dir)
+    root.mkdir(parents=True, exist_ok=True)
+    try:
+        previous = json.loads((root / "compact.json").read_text(encoding="utf-8")).get("data")
+    except (OSError, ValueError):
+        previous = None
+    data = f"data-{uuid.uuid4().hex[:12]}"
+    out = root / data
+    out.mkdir()
+
+    n = vs.index.ntotal
+    vectors = vs.index.reconstruct_n(0, n) if n else np.zeros((0, vs.index.d), dtype="float32")
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    faiss.normalize_L2(vectors)
+    index, kind = _quantized_index(vectors, quantizer)
+    faiss.write_index(index, str(out / "vectors.faiss"))
+
+    table = np.zeros((n, 4), dtype="int64")
+    pos = 0
+    with (out / "store.bin").open("wb") as f:
+        for i in range(n):
+            doc = vs.docstore.search(vs.index_to_docstore_id[i])
+            text = doc.page_content.encode("utf-8")
+            meta = json.dumps(doc.metadata, ensure_ascii=False).encode("utf-8")
+            f.write(text)
+            f.write(meta)
+            table[i] = (pos, len(text), pos + len(text), len(meta))
+            pos += len(text) + len(meta)
+    np.save(out / "store.idx.npy", table)
+
+    info = {
+        "format": FORMAT_VERSION,
+        "dim": int(vs.index.d),
+        "count": int(n),
+        "quantizer": kind,
+        "embed_model": embed_model,
+        "data": data,
+    }
+    tmp = root / "compact.json.tmp"
+    tmp.write_text(json.dumps(info), encoding="utf-8")
+    os.replace(tmp, root / "compact.json")
+    # فرمت قدیمی (بدون data) نسخهٔ قبلی را مستقیم در root داشت
+    remove_stale_versions(root, keep={"compact.json", data, *([previous] if previous else _LEGACY_FILES)})
+    return info
+
+
+def remove_stale_versions(root: Path, keep: set[str]) -> None:
+    """
+    همه‌چیز در root جز نام‌های keep (manifest، نسخهٔ فعلی و قبلی) که بیش از STALE_GRACE_SECONDS از نوشتنش
+    گذشته: نسخه‌های قدیمی، فایل‌های فرمت قدیمی که مستقیم در root بودند و tmpهای نیمه‌کاره؛ با unlink ، نه بازنویسی.
+    """
+    cutoff = time.time() - STALE_GRACE_SECONDS
+    for p in root.iterdir():
+        if p.name in keep:
+            continue
+        try:
+            if p.stat().st_mtime >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        if p.is_dir():
+            shutil.rmtree(p, ignore_errors=True)
+        else:
+            try:
+                p.unlink()
+            except OSError:
+                pass      # ویندوز: هنوز mmap است
+
+
+def has_compact(index_dir: str) -> bool:
+    return (Path(index_dir) / COMPACT_DIR / "compact.json").exists()
+
+
+class CompactIndex:
+    """
+    خواندن فرمت فشرده با mmap؛ باز کردن آن تقریباً هزینه‌ای ندارد و چند پروسه
+    page cache یکسانی را به اشتراک می‌گذارند.
+    close() (مثلاً از on_evict کش) تا پایان خواندن‌های در جریان عقب می‌افتد و استفادهٔ بعدی
+    store.bin را دوباره باز می‌کند.
+    """
+    def __init__(self, compact_dir: str):
+        self.root = Path(compact_dir)
+        self.info = json.loads((self.root / "compact.json").read_text(encoding="utf-8"))
+        if self.info.get("format") != FORMAT_VERSION:
+            raise ValueError(f"unsupported compact index format: {self.info.get('format')}")
+        # فرمت قدیمی (بدون data) فایل‌ها را مستقیم کنار compact.json داشت
+        self.data_dir = self.root / self.info.get("data", "")
+        self.index = faiss.read_index(str(self.data_dir / "vectors.faiss"), _MMAP_FLAG)
+        self.table = np.load(self.data_dir / "store.idx.npy", mmap_mode="r")
+        self._lock = threading.Lock()
+        self._active = 0
+        self._closing = False
+        self._fh = None
+        self._store = None
+        self._mapped_bytes: int | None = None
+        self._open_store()
+        self.resident_bytes()      # اندازه‌ها همین حالا که فایل‌ها قطعاً وجود دارند
+
+    def _open_store(self) -> None:
+        self._fh = open(self.data_dir / "store.bin", "rb")
+        size = os.fstat(self._fh.fileno()).st_size
+        self._store = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def _close_store(self) -> None:
+        if isinstance(self._store, mmap.mmap):
+            self._store.close()
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = self._store = None
+        self._closing = False
+
+    @contextmanager
+    def _mapped(self):
+        with self._lock:
+            if self._store is None:
+                self._open_store()
+            self._closing = False
+            self._active += 1
+            store = self._store
+        try:
+            yield store
+        finally:
+            with self._lock:
+                self._active -= 1
+                if self._closing and not self._active:
+                    self._close_store()
+
+    @classmethod
+    def open(cls, index_dir: str) -> "CompactIndex":
+        return cls(str(Path(index_dir) / COMPACT_DIR))
+
+    def __len__(self) -> int:
+        return int(self.info["count"])
+
+    def document(self, i: int) -> Document:
+        text_off, text_len, meta_off, meta_len = (int(v) for v in self.table[i])
+        with self._mapped() as store:
+            text = store[text_off:text_off + text_len].decode("utf-8")
+            meta = json.loads(store[meta_off:meta_off + meta_len].decode("utf-8"))
+        return Document(page_content=text, metadata=meta)
+
+    def metadata(self, i: int) -> dict:
+        _text_off, _text_len, meta_off, meta_len = (int(v) for v in self.table[i])
+        with self._mapped() as store:
+            return json.loads(store[meta_off:meta_off + meta_len].decode("utf-8"))
+
+    def search(self, vector: list[float], k: int = 10) -> list[tuple[Document, float]]:
+        if not len(self):
+            return []
+        q = np.asarray([vector], dtype="float32")
+        faiss.normalize_L2(q)
+        scores, ids = self.index.search(q, min(k, len(self)))
+        return [
+            (self.document(i), float(s))
+            for s, i in zip(scores[0].tolist(), ids[0].tolist())
+            if i >= 0
+        ]
+
+    def resident_bytes(self) -> int:
+        """
+        حجم فایل‌های map شده (بردارها، متن‌ها و جدول offset) به علاوهٔ سربار اشیای پایتون؛
+        صفحه‌ها در page cache بین پروسه‌ها مشترک‌اند ولی در بدترین حالت همه resident می‌شوند.
+        """
+        if self._mapped_bytes is None:
+            self._mapped_bytes = sum(
+                (self.data_dir / name).stat().st_size for name in ("vectors.faiss", "store.bin", "store.idx.npy")
+            )
+        return self._mapped_bytes + 64 * 1024
+
+    def close(self) -> None:
+        with self._lock:
+            if self._active:
+                self._closing = True
+            elif self._store is not None:
+                self._close_store()
+
+
+class CompactIndexRetriever(BaseRetriever):
+    """retriever روی CompactIndex."""
+    index: CompactIndex
+    embeddings: Embeddings
+    k: int = 10
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        vector = self.embeddings.embed_query(query)
+        return [doc for doc, _score in self.index.search(vector, self.k)]
+
+
+if __name__ == "__main__":
+    # تبدیل ایندکس‌های موجود: python -m app.compact_index app/storage/docs/*/my_faiss_index
+    import argparse
+    from langchain_community.embeddings import FakeEmbeddings
+    from langchain.vectorstores import FAISS
+
+    ap = argparse.ArgumentParser(description="write the compact mmap format next to existing FAISS indexes")
+    ap.add_argument("index_dirs", nargs="+")
+    ap.add_argument("--quantizer", choices=QUANTIZERS, default="sq8")
+    args = ap.parse_args()
+    for index_dir in args.index_dirs:
+        # load_local فقط برای query به embeddings نیاز دارد
+        vs = FAISS.load_local(index_dir, embeddings=FakeEmbeddings(size=1), allow_dangerous_deserialization=True)
+        info = write_compact(vs, str(Path(index_dir) / COMPACT_DIR), quantizer=args.quantizer)
+        print(index_dir, info)
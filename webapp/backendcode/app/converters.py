@@ -1,18 +1,93 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import fitz  # PyMuPDF
 
-def pdf_to_markdown(pdf_path: str, md_path: str) -> str:
+def _page_part(i: int, text: str) -> str:
+    return f"## صفحه {i}\n{text}\n"
+
+def _extract_range(pdf_path: str, start: int, stop: int) -> list[tuple[int, str]]:
+    """متن صفحات [start, stop) ؛ در worker process اجرا می‌شود."""
+    doc = fitz.open(pdf_path)
+    try:
+        out = []
+        for i in range(start, stop):
+            text = doc[i].get_text("text").strip()
+            if text:
+                out.append((i + 1, text))
+        return out
+    finally:
+        doc.close()
+
+def _auto_workers() -> int:
+    return max(1, min(4, os.cpu_count() or 1))
+
+def pdf_to_markdown_pages(
+    pdf_path: str,
+    md_path: str,
+    workers: int | None = None,
+    pages_per_task: int = 16,
+    min_parallel_pages: int = 200,
+) -> list[dict]:
+    """
+    مثل pdf_to_markdown ولی بازه‌های صفحه را در چند process استخراج می‌کند و
+    هر بازه را به محض آماده شدن (به ترتیب صفحه) روی دیسک می‌نویسد.
+    راه‌اندازی processها حدود یک تا دو ثانیه هزینه دارد، پس فقط برای اسناد بلندتر از
+    min_parallel_pages صفحه موازی اجرا می‌شود.
+    خروجی: [{"page", "start", "end"}] ؛ offset کاراکتری هر صفحه در متن md.
+    """
     pdf_p = Path(pdf_path)
     md_p = Path(md_path)
+    md_p.parent.mkdir(parents=True, exist_ok=True)
 
     doc = fitz.open(str(pdf_p))
-    parts = []
-    for i, page in enumerate(doc, start=1):
-        text = page.get_text("text").strip()
-        if text:
-            parts.append(f"## صفحه {i}\n{text}\n")
+    n_pages = doc.page_count
     doc.close()
 
-    md_p.parent.mkdir(parents=True, exist_ok=True)
-    md_p.write_text("\n".join(parts), encoding="utf-8")
-    return str(md_p)
+    workers = workers or _auto_workers()
+    ranges = [(s, min(s + pages_per_task, n_pages)) for s in range(0, n_pages, pages_per_task)]
+
+    offsets: list[dict] = []
+    pos = 0
+    with md_p.open("w", encoding="utf-8") as out:
+        def write(batch: list[tuple[int, str]]):
+            nonlocal pos
+            for page, text in batch:
+                if offsets:
+                    out.write("\n")
+                    pos += 1
+                part = _page_part(page, text)
+                out.write(part)
+                offsets.append({"page": page, "start": pos, "end": pos + len(part)})
+                pos += len(part)
+
+        if workers <= 1 or len(ranges) < 2 or n_pages < min_parallel_pages:
+            for start, stop in ranges:
+                write(_extract_range(str(pdf_p), start, stop))
+        else:
+            # spawn: این تابع ممکن است از threadهای صف ingest صدا زده شود
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=min(workers, len(ranges)), mp_context=ctx) as ex:
+                # map ترتیب را حفظ می‌کند؛ هر بازه به محض آماده شدنِ بازه‌های قبلی نوشته می‌شود
+                for batch in ex.map(_extract_range, [str(pdf_p)] * len(ranges),
+                                    [s for s, _ in ranges], [e for _, e in ranges]):
+                    write(batch)
+    return offsets
+
+def pdf_to_markdown(pdf_path: str, md_path: str, workers: int | None = 1) -> str:
+    pdf_to_markdown_pages(pdf_path, md_path, workers=workers)
+    return str(Path(md_path))
+
+def page_for_offset(offsets: list[dict], char_offset: int) -> int | None:
+    """شمارهٔ صفحه‌ای که offset داده‌شده داخل آن است."""
+    lo, hi = 0, len(offsets) - 1
+    found = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if offsets[mid]["start"] <= char_offset:
+            found = offsets[mid]["page"]
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return found
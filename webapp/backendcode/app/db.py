@@ -1,14 +1,73 @@
-from sqlalchemy import create_engine, Column, String, DateTime, Text
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import create_engine, event, inspect, text, Boolean, Column, DateTime, Index, Integer, String, Text
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Callable, Iterator
 import os
 
+from .cache import LRUCache
+
 DB_URL = os.getenv("DB_URL", "sqlite:///app/storage/skillbot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))                 # اتصال باز در هر پروسه (worker)
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))          # اتصال موقت بیشتر از pool در اوج بار
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))        # ثانیه انتظار برای اتصال آزاد
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))        # ثانیه؛ قبل از timeout سمت سرور DB
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))   # انتظار برای قفل نویسنده به جای خطا
+
+def _make_engine(url: str):
+    if not url.startswith("sqlite"):
+        return create_engine(
+            url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+    connect_args = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # دیتابیس حافظه‌ای فقط روی همان یک اتصال وجود دارد
+        return create_engine(url, connect_args=connect_args, poolclass=StaticPool)
+    eng = create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+
+    @event.listens_for(eng, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL: خواننده‌ها منتظر نویسنده (مثلاً job ingest) نمی‌مانند و چند worker می‌توانند هم‌زمان بخوانند
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.close()
+
+    return eng
 
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+engine = _make_engine(DB_URL)
+SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
 Base = declarative_base()
 
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    یک session برای یک واحد کار (یک درخواست HTTP یا یک به‌روزرسانی job):
+    commit در پایان، rollback در خطا و برگرداندن اتصال به pool در هر حال.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
 class Freelancer(Base):
     __tablename__ = "freelancers"
     id = Column(String, primary_key=True)          # همان GUID
@@ -18,6 +77,84 @@ class Freelancer(Base):
     md_path = Column(String, nullable=False)
     index_dir = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # وضعیت workspace که pipeline بعد از هر ingest ثبت می‌کند (GET /docs بدون اسکن دیسک)
+    has_pdf = Column(Boolean, nullable=True)
+    has_md = Column(Boolean, nullable=True)
+    has_index = Column(Boolean, nullable=True)       # NULL = هنوز ثبت نشده (ردیف‌های قدیمی)
+    chunks = Column(Integer, nullable=True)
+    index_bytes = Column(Integer, nullable=True)
+
+    # صفحه‌بندی keyset روی (created_at, id) نزولی
+    __table_args__ = (Index("ix_freelancers_created_at_id", "created_at", "id"),)
+
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+    id = Column(String, primary_key=True)
+    freelancer_id = Column(String, nullable=False, index=True)
+    name = Column(String, nullable=False)
+    description = Column(Text, nullable=True)
+    src_path = Column(String, nullable=False)      # فایل آپلودشده در uploads
+    status = Column(String, nullable=False, default="queued")   # queued / running / done / failed
+    stage = Column(String, nullable=True)          # مرحلهٔ جاری pipeline
+    error = Column(Text, nullable=True)
+    timings = Column(Text, nullable=True)          # JSON: {stage: seconds}
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    owner = Column(String, nullable=True)          # host:pid پروسه‌ای که job را گرفته
+    heartbeat_at = Column(DateTime, nullable=True) # آخرین نشانهٔ زنده بودن owner
+
+def _migrate():
+    """ستون‌ها و ایندکس‌های جدید روی جدول‌های موجود (create_all فقط جدول‌های جدید را می‌سازد)."""
+    insp = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        with engine.begin() as conn:
+            for col in table.columns:
+                if col.name not in existing:
+                    col_type = col.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}"))
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _migrate()
+
+class FreelancerCache:
+    """
+    کش درون‌پروسه‌ای مشخصات فریلنسر (id → dict) تا /chat در حالت معمول به DB نرود.
+    نبودِ یک id کش نمی‌شود تا فریلنسری که worker دیگری ساخته بلافاصله دیده شود؛
+    بعد از هر ingest همین پروسه invalidate صدا زده می‌شود و بقیهٔ workerها بعد از ttl بیکاری تازه می‌شوند.
+    """
+    def __init__(self, to_dict: Callable[[Freelancer], dict], max_entries: int | None = 10000, ttl: float | None = 300):
+        self.to_dict = to_dict
+        self._cache = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.misses = 0      # رفتن به DB (LRUCache فقط hitها را می‌شمارد چون loader ندارد)
+
+    def get(self, freelancer_id: str) -> dict | None:
+        fr = self._cache.get(freelancer_id)
+        if fr is not None:
+            return fr
+        self.misses += 1
+        with session_scope() as db:
+            row = db.get(Freelancer, freelancer_id)
+            fr = self.to_dict(row) if row else None
+        if fr is not None:
+            self._cache.put(freelancer_id, fr)
+        return fr
+
+    def exists(self, freelancer_id: str) -> bool:
+        return self.get(freelancer_id) is not None
+
+    def invalidate(self, freelancer_id: str) -> bool:
+        return self._cache.invalidate(freelancer_id)
+
+    def stats(self) -> dict:
+        out = self._cache.stats(per_entry=False)
+        lookups = out["hits"] + self.misses
+        out["misses"] = self.misses
+        out["hit_rate"] = (out["hits"] / lookups) if lookups else 0.0
+        return out
@@ -0,0 +1,77 @@
+import threading
+from langchain_core.embeddings import Embeddings
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+
+class EmbeddingService(Embeddings):
+    """
+    یک مدل embedding مشترک برای کل پروسه (ایندکس‌سازی و چت).
+    مدل فقط یک بار و به صورت lazy بارگذاری می‌شود.
+    """
+    def __init__(
+        self,
+        model_name: str,
+        device: str | None = None,
+        batch_size: int = 16,
+        num_threads: int | None = None,
+        normalize: bool = True,
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.normalize = normalize
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def _load(self) -> HuggingFaceEmbeddings:
+        # double-checked locking: فقط اولین درخواست مدل را از دیسک می‌خواند
+        if self._model is not None:
+            return self._model
+        with self._lock:
+            if self._model is None:
+                import torch
+                if self.num_threads:
+                    torch.set_num_threads(self.num_threads)
+                device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+                self._model = HuggingFaceEmbeddings(
+                    model_name=self.model_name,
+                    model_kwargs={"device": device},
+                    encode_kwargs={
+                        "batch_size": self.batch_size,
+                        "normalize_embeddings": self.normalize,
+                    },
+                )
+        return self._model
+
+    # inference روی SentenceTransformer حالت مشترکی را تغییر نمی‌دهد،
+    # پس بعد از بارگذاری، فراخوانی هم‌زمان از چند thread مجاز است.
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._load().embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._load().embed_query(text)
+
+    def warmup(self) -> None:
+        """بارگذاری مدل و یک encode آزمایشی تا اولین درخواست کاربر کند نباشد."""
+        self.embed_query("سلام")
+
+
+_services: dict[str, EmbeddingService] = {}
+_services_lock = threading.Lock()
+
+
+def get_embedding_service(model_name: str, **kwargs) -> EmbeddingService:
+    """
+    سرویس مشترک برای هر model_name؛ kwargs فقط در اولین فراخوانی اعمال می‌شود.
+    """
+    with _services_lock:
+        svc = _services.get(model_name)
+        if svc is None:
+            svc = EmbeddingService(model_name, **kwargs)
+            _services[model_name] = svc
+        return svc
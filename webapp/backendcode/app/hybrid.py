@@ -0,0 +1,213 @@
+import json
+import math
+import sys
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Callable
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from .textproc import chunk_hash
+
+BM25_FILE = "bm25.json"
+BM25_VERSION = 1
+
+
+class BM25Index:
+    """
+    ایندکس معکوس BM25 روی chunkهای پیش‌پردازش‌شده (توکن‌ها با فاصله جدا شده‌اند).
+    هر chunk با hash متنش (همان metadata["hash"] ایندکس FAISS) شناسایی می‌شود.
+    """
+    def __init__(self, hashes: list[str], lengths: list[int], postings: dict[str, list[list[int]]],
+                 k1: float = 1.5, b: float = 0.75):
+        self.hashes = hashes
+        self.lengths = lengths
+        self.postings = postings            # term → [[chunk_idx, tf], ...]
+        self.k1 = k1
+        self.b = b
+        self._nbytes: int | None = None
+        self.avgdl = (sum(lengths) / len(lengths)) if lengths else 0.0
+        n = len(hashes)
+        self.idf = {
+            term: math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in postings.items()
+        }
+
+    @classmethod
+    def build(cls, chunks: dict[str, list[str]], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """chunks: hash → لیست توکن‌ها"""
+        hashes, lengths = [], []
+        postings: dict[str, list[list[int]]] = {}
+        for i, (h, tokens) in enumerate(chunks.items()):
+            hashes.append(h)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append([i, tf])
+        return cls(hashes, lengths, postings, k1=k1, b=b)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def nbytes(self) -> int:
+        """
+        تخمین حافظهٔ پایتون: هر posting یک لیست [idx, tf] است و بیشترین سهم را دارد؛
+        هر term در postings و idf کلید دارد و هر chunk یک hash و یک طول.
+        """
+        if self._nbytes is None:
+            postings = sum(len(plist) for plist in self.postings.values())
+            terms = sum(sys.getsizeof(t) for t in self.postings)
+            self._nbytes = (
+                postings * (sys.getsizeof([0, 0]) + 8 + 28)
+                + terms + len(self.postings) * (2 * 100 + sys.getsizeof([]))
+                + sum(sys.getsizeof(h) + 8 for h in self.hashes)
+                + len(self.lengths) * (28 + 8)
+            )
+        return self._nbytes
+
+    def save(self, index_dir: str) -> None:
+        data = {
+            "version": BM25_VERSION,
+            "k1": self.k1,
+            "b": self.b,
+            "hashes": self.hashes,
+            "lengths": self.lengths,
+            "postings": self.postings,
+        }
+        path = Path(index_dir) / BM25_FILE
+        path.with_suffix(".tmp").write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        path.with_suffix(".tmp").replace(path)
+
+    @classmethod
+    def load(cls, index_dir: str) -> "BM25Index | None":
+        path = Path(index_dir) / BM25_FILE
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text(encoding="utf-8"))
+        if data.get("version") != BM25_VERSION:
+            return None
+        return cls(data["hashes"], data["lengths"], data["postings"], k1=data["k1"], b=data["b"])
+
+    def search(self, tokens: list[str], k: int = 20) -> list[tuple[str, float]]:
+        """(hash, score) بهترین‌ها اول."""
+        if not self.hashes:
+            return []
+        scores: dict[int, float] = {}
+        k1, b, avgdl = self.k1, self.b, self.avgdl or 1.0
+        for term in set(tokens):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = self.idf[term]
+            for i, tf in plist:
+                norm = k1 * (1 - b + b * self.lengths[i] / avgdl)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:k]
+        return [(self.hashes[i], s) for i, s in best]
+
+
+class LexicalReranker:
+    """
+    reranker ارزان CPU: امتیاز ترکیبی را با پوشش توکن‌های سؤال در متن chunk تنظیم می‌کند.
+    chunkی که همهٔ کلمات کلیدی سؤال را دارد از chunkی که فقط از نظر برداری نزدیک است جلو می‌افتد.
+    """
+    def __init__(self, weight: float = 0.3):
+        self.weight = weight
+
+    def score(self, query: str, query_tokens: list[str], docs: list[Document], fused: list[float]) -> list[float]:
+        terms = set(query_tokens)
+        top = max(fused) if fused else 1.0
+        out = []
+        for doc, f in zip(docs, fused):
+            coverage = len(terms & set(doc.page_content.split())) / len(terms) if terms else 0.0
+            out.append((1 - self.weight) * (f / top) + self.weight * coverage)
+        return out
+
+
+class CrossEncoderReranker:
+    """reranker با cross-encoder محلی (sentence-transformers)؛ دقیق‌تر ولی کندتر از LexicalReranker."""
+    def __init__(self, model_name: str, max_length: int = 512):
+        self.model_name = model_name
+        self.max_length = max_length
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, max_length=self.max_length)
+        return self._model
+
+    def score(self, query: str, query_tokens: list[str], docs: list[Document], fused: list[float]) -> list[float]:
+        if not docs:
+            return []
+        scores = self._load().predict([(query, d.page_content) for d in docs])
+        return [float(s) for s in scores]
+
+
+def _key(doc: Document) -> str:
+    # همان کلید BM25 و fetch (rag._doc_hash)؛ chunkهای قدیمی بدون hash در metadata هم دو بار نمی‌آیند
+    return doc.metadata.get("hash") or chunk_hash(doc.page_content)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 + بردار با Reciprocal Rank Fusion، سپس rerank و انتخاب k تطبیقی:
+    از بهترین chunk شروع می‌کند و تا وقتی امتیاز نسبت به اولی از margin کمتر نشده
+    و بودجهٔ توکن context پر نشده، chunk اضافه می‌کند (بین min_k و max_k).
+    """
+    vector_search: Callable[[str, int], list[tuple[Document, float]]]
+    bm25: BM25Index | None = None
+    fetch: Callable[[str], Document | None]
+    tokenize: Callable[[str], list[str]]
+    count_tokens: Callable[[str], int]
+    reranker: object | None = None
+    candidates: int = 20
+    rrf_k: int = 60
+    min_k: int = 2
+    max_k: int = 6
+    margin: float = 0.6
+    token_budget: int = 1800
+
+    def _fuse(self, query: str, tokens: list[str]) -> tuple[list[Document], list[float]]:
+        fused: dict[str, float] = {}
+        docs: dict[str, Document] = {}
+        for rank, (doc, _score) in enumerate(self.vector_search(query, self.candidates)):
+            key = _key(doc)
+            docs[key] = doc
+            fused[key] = fused.get(key, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        if self.bm25 is not None:
+            for rank, (h, _score) in enumerate(self.bm25.search(tokens, self.candidates)):
+                if h not in docs:
+                    doc = self.fetch(h)
+                    if doc is None:
+                        continue
+                    docs[h] = doc
+                fused[h] = fused.get(h, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        order = sorted(fused, key=fused.get, reverse=True)
+        return [docs[key] for key in order], [fused[key] for key in order]
+
+    def select(self, ranked: list[tuple[Document, float]]) -> list[Document]:
+        if not ranked:
+            return []
+        top = ranked[0][1]
+        out, used = [], 0
+        for doc, score in ranked[:self.max_k]:
+            if len(out) >= self.min_k:
+                if top > 0 and score < top * self.margin:
+                    break
+                if used + self.count_tokens(doc.page_content) > self.token_budget:
+                    break
+            out.append(doc)
+            used += self.count_tokens(doc.page_content)
+        return out
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        tokens = self.tokenize(query)
+        docs, fused = self._fuse(query, tokens)
+        reranker = self.reranker or LexicalReranker()
+        scores = reranker.score(query, tokens, docs, fused)
+        ranked = sorted(zip(docs, scores), key=lambda ds: ds[1], reverse=True)
+        return self.select(ranked)
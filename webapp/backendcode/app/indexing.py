@@ -1,27 +1,18 @@
+import json
+import shutil
 from pathlib import Path
-from hazm import Normalizer, word_tokenize
 from langchain.document_loaders import TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain.vectorstores import FAISS
-import torch
-
-_normalizer = Normalizer()
-
-def _preprocess(text: str) -> str:
-    try:
-        text = text.lower()
-        text = _normalizer.normalize(text)
-        text = ''.join(c for c in text if c.isalnum() or c.isspace())
-        return ' '.join(word_tokenize(text))
-    except Exception:
-        return text
-
-def build_faiss_index(md_path: str, out_dir: str, embed_model: str = "Msobhi/Persian_Sentence_Embedding_v3"):
-    md_path = Path(md_path)
-    out_dir = Path(out_dir)
-    out_dir.mkdir(parents=True, exist_ok=True)
+from .embeddings import get_embedding_service
+from .converters import page_for_offset
+from .compact_index import COMPACT_DIR, write_compact
+from .hybrid import BM25Index
+from .skill_search import SEARCH_DIR, write_search_data
+from .textproc import chunk_hash, preprocess_many
 
+def _split(md_path: Path, add_start_index: bool = False):
     loader = TextLoader(str(md_path), encoding='utf-8')
     docs = loader.load()
 
@@ -33,20 +24,126 @@ def build_faiss_index(md_path: str, out_dir: str, embed_model: str = "Msobhi/Per
         length_function=lambda x: len(x.split())
     )
     splits = splitter.split_documents(docs)
-    texts = [_preprocess(d.page_content) for d in splits]
-
-    embeddings = HuggingFaceEmbeddings(
-        model_name=embed_model,
-        encode_kwargs={
-        "batch_size": 16,
-        "normalize_embeddings": True,
-        }
+    if add_start_index:
+        # add_start_index خود splitter با length_function کلمه‌ای offset اشتباه می‌دهد
+        text = docs[0].page_content if docs else ""
+        cursor = 0
+        for d in splits:
+            idx = text.find(d.page_content, cursor)
+            if idx < 0:
+                idx = max(text.find(d.page_content), 0)
+            d.metadata["start_index"] = idx
+            cursor = idx + 1
+    return splits
+
+def _load_existing(out_dir: Path, embeddings: Embeddings, model_name: str):
+    """ایندکس قبلی را فقط اگر با همان مدل embedding ساخته شده باشد برمی‌گرداند."""
+    meta_path = out_dir / "index_meta.json"
+    if not (out_dir / "index.faiss").exists() or not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    if meta.get("embed_model") != model_name:
+        return None
+    return FAISS.load_local(str(out_dir), embeddings=embeddings, allow_dangerous_deserialization=True)
+
+def sync_faiss_index(
+    md_path: str,
+    out_dir: str,
+    embed_model: str = "Msobhi/Persian_Sentence_Embedding_v3",
+    embeddings: Embeddings | None = None,
+    incremental: bool = True,
+    page_offsets: list[dict] | None = None,
+    compact: str | None = None,
+    preprocess_workers: int | None = 1,
+) -> dict:
+    """
+    ایندکس را با محتوای md هم‌گام می‌کند. هر chunk با hash متنش شناسایی می‌شود؛
+    اگر ایندکس قبلی وجود داشته باشد فقط chunkهای جدید embed و chunkهای حذف‌شده پاک می‌شوند.
+    اگر page_offsets (خروجی pdf_to_markdown_pages) داده شود، شمارهٔ صفحهٔ هر chunk در metadata می‌آید.
+    اگر compact نام یک quantizer (sq8/pq) باشد، نسخهٔ فشرده و قابل mmap هم در out_dir/compact نوشته می‌شود.
+    بردارهای نرمال‌شده و centroid برای جستجوی بین فریلنسرها (/search) در out_dir/search نوشته می‌شوند.
+    preprocess_workers: تعداد processهای نرمال‌سازی متن (None = خودکار، فقط برای اسناد بزرگ).
+    خروجی: تعداد chunkهای added / removed / kept
+    """
+    md_path = Path(md_path)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    splits = _split(md_path, add_start_index=bool(page_offsets))
+    texts = preprocess_many([d.page_content for d in splits], workers=preprocess_workers)
+
+    embeddings = embeddings or get_embedding_service(embed_model)
+    model_name = getattr(embeddings, "model_name", embed_model)
+
+    # chunk تکراری در یک سند فقط یک بار embed می‌شود
+    chunks: dict[str, dict] = {}
+    for i, text in enumerate(texts):
+        h = chunk_hash(text)
+        if h not in chunks:
+            metadata = {"source": f"chunk_{i}", "hash": h}
+            if page_offsets:
+                metadata["page"] = page_for_offset(page_offsets, splits[i].metadata.get("start_index", 0))
+            chunks[h] = {"text": text, "metadata": metadata}
+
+    vs = _load_existing(out_dir, embeddings, model_name) if incremental else None
+    if vs is None:
+        vs = FAISS.from_texts(
+            [c["text"] for c in chunks.values()],
+            embedding=embeddings,
+            metadatas=[c["metadata"] for c in chunks.values()],
+            ids=list(chunks.keys()),
+        )
+        stats = {"added": len(chunks), "removed": 0, "kept": 0}
+    else:
+        # ایندکس‌های قدیمی id تصادفی دارند؛ hash را از خود متن حساب کن
+        existing: dict[str, str] = {}
+        stale: list[str] = []
+        for store_id in vs.index_to_docstore_id.values():
+            doc = vs.docstore.search(store_id)
+            h = chunk_hash(doc.page_content)
+            if h in chunks and h not in existing:
+                existing[h] = store_id
+                doc.metadata = chunks[h]["metadata"]
+            else:
+                stale.append(store_id)
+        if stale:
+            vs.delete(stale)
+        new = [h for h in chunks if h not in existing]
+        if new:
+            vs.add_texts(
+                [chunks[h]["text"] for h in new],
+                metadatas=[chunks[h]["metadata"] for h in new],
+                ids=new,
+            )
+        stats = {"added": len(new), "removed": len(stale), "kept": len(existing)}
+
+    vs.save_local(str(out_dir))
+    # متن chunkها از قبل نرمال و توکن‌شده است؛ BM25 بدون embed دوباره کامل بازسازی می‌شود
+    BM25Index.build({h: c["text"].split() for h, c in chunks.items()}).save(str(out_dir))
+    (out_dir / "index_meta.json").write_text(
+        json.dumps({"embed_model": model_name, "chunks": len(chunks)}), encoding="utf-8"
     )
+    write_search_data(vs, str(out_dir / SEARCH_DIR), embed_model=model_name)
+    if compact:
+        write_compact(vs, str(out_dir / COMPACT_DIR), quantizer=compact, embed_model=model_name)
+    elif (out_dir / COMPACT_DIR).exists():
+        # نسخهٔ فشردهٔ قدیمی دیگر با ایندکس هم‌خوان نیست
+        shutil.rmtree(out_dir / COMPACT_DIR)
+    return stats
 
-    vs = FAISS.from_texts(
-        texts,
-        embedding=embeddings,
-        metadatas=[{"source": f"chunk_{i}"} for i in range(len(texts))]
+def build_faiss_index(
+    md_path: str,
+    out_dir: str,
+    embed_model: str = "Msobhi/Persian_Sentence_Embedding_v3",
+    embeddings: Embeddings | None = None,
+    incremental: bool = True,
+    page_offsets: list[dict] | None = None,
+    compact: str | None = None,
+    preprocess_workers: int | None = 1,
+):
+    sync_faiss_index(
+        md_path, out_dir, embed_model=embed_model, embeddings=embeddings,
+        incremental=incremental, page_offsets=page_offsets, compact=compact,
+        preprocess_workers=preprocess_workers,
     )
-    vs.save_local(str(out_dir))
     return str(out_dir)
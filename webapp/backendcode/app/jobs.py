@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable
+from sqlalchemy import or_
+from .db import session_scope, Freelancer, IngestJob
+from .locks import file_lock
+from .pipeline import DocPipeline
+
+log = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """صف ایندکس‌سازی پر است؛ کلاینت باید بعداً دوباره تلاش کند."""
+
+
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_alive(owner: str | None) -> bool | None:
+    """True/False برای پروسه‌ای روی همین host ، None اگر معلوم نباشد (host دیگر)"""
+    if not owner or ":" not in owner:
+        return None
+    host, pid = owner.rsplit(":", 1)
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class IngestQueue:
+    """
+    صف پس‌زمینه برای pipeline (PDF → MD → Index) با تعداد worker محدود.
+    وضعیت هر job (queued/running/done/failed) و زمان هر مرحله در جدول ingest_jobs ذخیره می‌شود.
+
+    چند پروسه (worker سرور) می‌توانند یک جدول را به اشتراک بگذارند: هر job با یک UPDATE شرطی
+    (queued → running) فقط توسط یک پروسه گرفته می‌شود و owner آن هر heartbeat ثانیه heartbeat_at را
+    به‌روز می‌کند. recover فقط jobهای running را برمی‌گرداند که owner آن‌ها مرده یا heartbeat آن‌ها
+    قدیمی‌تر از stale_after است؛ همان thread هر stale_after/2 ثانیه recover را اجرا می‌کند تا job یک
+    worker کرش‌کرده منتظر ری‌استارت پروسه‌ای نماند.
+    jobهای یک doc_id (مثلاً دو PUT پشت سر هم) با قفل فایلی per-doc_id یکی‌یکی اجرا می‌شوند و هر job
+    فایل آپلود مخصوص خودش را دارد که بعد از پایان موفق job پاک می‌شود؛ فایل job ناموفق برای retry
+    نگه داشته می‌شود و بعد از failed_retention ثانیه پاک می‌شود.
+    """
+    def __init__(
+        self,
+        pipeline: DocPipeline,
+        workers: int = 2,
+        max_pending: int = 100,
+        on_done: Callable[[str], None] | None = None,
+        heartbeat: float = 15.0,
+        stale_after: float = 90.0,
+        failed_retention: float = 7 * 86400,
+    ):
+        self.pipeline = pipeline
+        self.max_pending = max_pending
+        self.on_done = on_done
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.failed_retention = failed_retention
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._running: set[str] = set()
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._beat = threading.Thread(target=self._heartbeat_loop, name="ingest-heartbeat", daemon=True)
+        self._beat.start()
+
+    def _update(self, job_id: str, **fields) -> None:
+        with session_scope() as db:
+            db.query(IngestJob).filter(IngestJob.id == job_id).update(fields)
+
+    def _claim(self, job_id: str) -> bool:
+        """queued → running به صورت اتمیک؛ False اگر پروسهٔ دیگری زودتر گرفته باشد"""
+        now = datetime.utcnow()
+        with session_scope() as db:
+            n = db.query(IngestJob).filter(IngestJob.id == job_id, IngestJob.status == "queued").update(
+                {"status": "running", "owner": OWNER, "started_at": now, "heartbeat_at": now},
+                synchronize_session=False,
+            )
+        return n == 1
+
+    def _heartbeat_loop(self) -> None:
+        reclaim_every = max(self.heartbeat, self.stale_after / 2)
+        next_reclaim = time.monotonic() + reclaim_every
+        while not self._stop.wait(self.heartbeat):
+            with self._running_lock:
+                running = list(self._running)
+            if running:
+                try:
+                    with session_scope() as db:
+                        db.query(IngestJob).filter(IngestJob.id.in_(running), IngestJob.owner == OWNER).update(
+                            {"heartbeat_at": datetime.utcnow()}, synchronize_session=False,
+                        )
+                except Exception:
+                    pass      # DB موقتاً در دسترس نیست؛ heartbeat بعدی
+            if time.monotonic() >= next_reclaim:
+                next_reclaim = time.monotonic() + reclaim_every
+                try:
+                    n = self.recover()
+                    if n:
+                        log.info("reclaimed %d stale ingestion job(s)", n)
+                    self.purge_failed_uploads()
+                except Exception:
+                    log.exception("periodic ingestion job reclaim failed")
+
+    def _dispatch(self, job_id: str) -> None:
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull(f"more than {self.max_pending} ingestion jobs pending")
+        try:
+            self._executor.submit(self._run, job_id)
+        except Exception:
+            self._slots.release()
+            raise
+
+    @staticmethod
+    def new_job_id() -> str:
+        """برای نام‌گذاری فایل آپلود پیش از submit"""
+        return str(uuid.uuid4())
+
+    def submit(self, freelancer_id: str, name: str, description: str, src_path: str, job_id: str | None = None) -> str:
+        job_id = job_id or self.new_job_id()
+        with session_scope() as db:
+            db.add(IngestJob(
+                id=job_id,
+                freelancer_id=freelancer_id,
+                name=name,
+                description=description,
+                src_path=src_path,
+                status="queued",
+            ))
+        try:
+            self._dispatch(job_id)
+        except QueueFull:
+            self._update(job_id, status="failed", error="queue full", finished_at=datetime.utcnow())
+            raise
+        return job_id
+
+    def _stale(self, job: IngestJob, cutoff: datetime) -> bool:
+        if job.status == "queued":
+            # job تازهٔ پروسهٔ زنده‌ای که هنوز در صف خودش است؛ claim اتمیک تکرار را هم مانع می‌شود
+            return job.created_at is None or job.created_at < cutoff
+        alive = _owner_alive(job.owner)
+        if alive is False:
+            return True
+        beat = job.heartbeat_at or job.started_at
+        return beat is None or beat < cutoff
+
+    def recover(self) -> int:
+        """
+        jobهای رهاشده (owner مرده یا بدون heartbeat تازه) را دوباره در صف می‌گذارد، اگر فایل آپلود هنوز باشد.
+        jobهایی که پروسهٔ زندهٔ دیگری در حال اجرای آن‌هاست دست نمی‌خورند.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        with session_scope() as db:
+            rows = db.query(IngestJob).filter(IngestJob.status.in_(["queued", "running"])).all()
+            pending = [(r.id, r.src_path, r.status, r.owner, r.heartbeat_at) for r in rows if self._stale(r, cutoff)]
+        n = 0
+        for job_id, src_path, status, owner, heartbeat_at in pending:
+            if not Path(src_path).exists():
+                self._update(job_id, status="failed", error="upload missing after restart",
+                             finished_at=datetime.utcnow())
+                continue
+            if status == "running":
+                # فقط اگر در این فاصله owner دیگری آن را نگرفته باشد
+                with session_scope() as db:
+                    reset = db.query(IngestJob).filter(
+                        IngestJob.id == job_id,
+                        IngestJob.status == "running",
+                        IngestJob.owner.is_(None) if owner is None else IngestJob.owner == owner,
+                        or_(IngestJob.heartbeat_at.is_(None), IngestJob.heartbeat_at == heartbeat_at),
+                    ).update({"status": "queued", "stage": None, "owner": None}, synchronize_session=False)
+                if not reset:
+                    continue
+            try:
+                self._dispatch(job_id)
+                n += 1
+            except QueueFull:
+                self._update(job_id, status="failed", error="queue full", finished_at=datetime.utcnow())
+        return n
+
+    def retry(self, job_id: str) -> bool | None:
+        """
+        job ناموفق را با همان فایل آپلود دوباره در صف می‌گذارد.
+        None اگر job نباشد، False اگر failed نباشد یا فایل آپلود دیگر نباشد؛ QueueFull اگر صف پر باشد.
+        """
+        with session_scope() as db:
+            job = db.query(IngestJob).filter(IngestJob.id == job_id).first()
+            if job is None:
+                return None
+            status, src_path = job.status, job.src_path
+        if status != "failed" or not Path(src_path).exists():
+            return False
+        with session_scope() as db:
+            n = db.query(IngestJob).filter(IngestJob.id == job_id, IngestJob.status == "failed").update(
+                {"status": "queued", "stage": None, "error": None, "owner": None,
+                 "started_at": None, "heartbeat_at": None, "finished_at": None, "created_at": datetime.utcnow()},
+                synchronize_session=False,
+            )
+        if n != 1:
+            return False       # درخواست retry هم‌زمان دیگری زودتر گرفت
+        try:
+            self._dispatch(job_id)
+        except QueueFull:
+            self._update(job_id, status="failed", error="queue full", finished_at=datetime.utcnow())
+            raise
+        return True
+
+    def purge_failed_uploads(self) -> int:
+        """فایل آپلود jobهای ناموفقی که بیش از failed_retention ثانیه retry نشده‌اند"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.failed_retention)
+        with session_scope() as db:
+            paths = [src for (src,) in db.query(IngestJob.src_path).filter(
+                IngestJob.status == "failed", IngestJob.finished_at < cutoff,
+            )]
+        n = 0
+        for src in paths:
+            p = Path(src)
+            if p.exists():
+                p.unlink(missing_ok=True)
+                n += 1
+        return n
+
+    def _run(self, job_id: str) -> None:
+        try:
+            with session_scope() as db:
+                job = db.query(IngestJob).filter(IngestJob.id == job_id).first()
+                if job is None:
+                    return
+                freelancer_id, name, description, src_path = job.freelancer_id, job.name, job.description, job.src_path
+
+            if not self._claim(job_id):
+                return
+            with self._running_lock:
+                self._running.add(job_id)
+            try:
+                # دو job یک فریلنسر (در هر پروسه‌ای) هم‌زمان روی یک workspace نمی‌نویسند
+                with file_lock(self.pipeline.docs_dir / ".locks" / f"{freelancer_id}.lock"):
+                    result = self.pipeline.run_all(
+                        src_path,
+                        doc_id=freelancer_id,
+                        on_stage=lambda stage: self._update(job_id, stage=stage),
+                    )
+                    self._finish(job_id, freelancer_id, name, description, result)
+            except Exception as e:
+                self._update(job_id, status="failed", error=str(e), finished_at=datetime.utcnow())
+                return
+            finally:
+                with self._running_lock:
+                    self._running.discard(job_id)
+
+            # pipeline آن را در workspace کپی کرده است؛ در صورت خطا برای retry می‌ماند
+            Path(src_path).unlink(missing_ok=True)
+            if self.on_done:
+                self.on_done(freelancer_id)
+        finally:
+            self._slots.release()
+
+    def _finish(self, job_id: str, freelancer_id: str, name: str, description: str, result: dict) -> None:
+        """ثبت فریلنسر و بستن job در یک تراکنش."""
+        with session_scope() as db:
+            fr = db.query(Freelancer).filter(Freelancer.id == freelancer_id).first()
+            if fr is None:
+                fr = Freelancer(id=freelancer_id)
+                db.add(fr)
+            fr.name = name
+            fr.description = description
+            fr.pdf_path = result["pdf_path"]
+            fr.md_path = result["md_path"]
+            fr.index_dir = result["index_dir"]
+            for key, value in result["workspace"].items():
+                setattr(fr, key, value)
+            job = db.query(IngestJob).filter(IngestJob.id == job_id).first()
+            job.status = "done"
+            job.stage = None
+            job.timings = json.dumps(result["timings"])
+            job.finished_at = datetime.utcnow()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._stop.set()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,150 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class Overloaded(Exception):
+    """صف مدل پر است یا انتظار از queue_timeout گذشته؛ سرور باید 429 با Retry-After برگرداند."""
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """
+    محدودکنندهٔ هم‌زمانی جلوی LLM محلی: حداکثر concurrency فراخوانی هم‌زمان،
+    حداکثر max_queue درخواست در صف و حداکثر queue_timeout ثانیه انتظار.
+    هم از threadها (slot) و هم از event loop (aslot) قابل استفاده است و هر دو یک صف FIFO مشترک دارند؛
+    جای خالی مستقیم به اولین منتظر داده می‌شود تا درخواست تازه از صف جلو نزند.
+    """
+    def __init__(self, concurrency: int = 2, max_queue: int = 16, queue_timeout: float = 30.0):
+        if concurrency < 1:
+            raise ValueError("concurrency must be >= 1")
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._waiters: deque = deque()     # threading.Event یا (loop, future)
+        self.active = 0
+        self.served = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._hold_avg: float | None = None  # میانگین نمایی مدت نگه داشتن هر slot
+
+    # ---------- common ----------
+    def retry_after(self) -> int:
+        """تخمین ثانیه تا خالی شدن صف فعلی."""
+        hold = self._hold_avg or 5.0
+        return max(1, math.ceil(hold * (len(self._waiters) / self.concurrency + 1)))
+
+    def _try_enter(self, waiter) -> bool:
+        # قفل باید گرفته شده باشد؛ True یعنی slot بلافاصله گرفته شد
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded("llm queue is full", self.retry_after())
+        self._waiters.append(waiter)
+        return False
+
+    def _withdraw(self, waiter) -> bool:
+        # قفل باید گرفته شده باشد؛ False یعنی slot هم‌زمان به این منتظر واگذار شده و مال اوست
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            return False
+        return True
+
+    def release(self, held: float | None = None) -> None:
+        with self._lock:
+            self.served += 1
+            if held is not None:
+                self._hold_avg = held if self._hold_avg is None else 0.8 * self._hold_avg + 0.2 * held
+            if self._waiters:
+                # active ثابت می‌ماند؛ slot به منتظر بعدی منتقل می‌شود
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                else:
+                    loop, fut = waiter
+                    loop.call_soon_threadsafe(_resolve, fut)
+                return
+            self.active -= 1
+
+    # ---------- threads ----------
+    def acquire(self) -> None:
+        event = threading.Event()
+        with self._lock:
+            if self._try_enter(event):
+                return
+        if event.wait(self.queue_timeout):
+            return
+        with self._lock:
+            if self._withdraw(event):
+                self.timeouts += 1
+                raise Overloaded("timed out waiting for the llm", self.retry_after())
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - t0)
+
+    # ---------- asyncio ----------
+    async def aacquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        waiter = (loop, fut)
+        with self._lock:
+            if self._try_enter(waiter):
+                return
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if self._withdraw(waiter):
+                    self.timeouts += 1
+                    raise Overloaded("timed out waiting for the llm", self.retry_after()) from None
+        except asyncio.CancelledError:
+            # کلاینت قطع شد؛ اگر slot در همین لحظه به ما رسیده بود پسش بده
+            with self._lock:
+                granted = not self._withdraw(waiter)
+            if granted:
+                self.release()
+            raise
+
+    @asynccontextmanager
+    async def aslot(self):
+        await self.aacquire()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - t0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "active": self.active,
+                "waiting": len(self._waiters),
+                "max_queue": self.max_queue,
+                "queue_timeout": self.queue_timeout,
+                "served": self.served,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "avg_hold_seconds": round(self._hold_avg, 3) if self._hold_avg is not None else None,
+            }
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(True)
@@ -0,0 +1,241 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Any, AsyncIterator, Iterator
+import httpx
+from dotenv import load_dotenv
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field
+
+# این ماژول ممکن است قبل از load_dotenv سرور (یا از اسکریپت‌های بیرون webapp) import شود
+load_dotenv()
+
+# همهٔ تنظیمات مدل محلی در یک جا؛ هر مقدار را می‌توان در build_chat_model هم override کرد
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+LLM_MODEL = os.getenv("LLM_MODEL", "llama3.1:latest")
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "4096"))
+LLM_NUM_THREAD = int(os.getenv("LLM_NUM_THREAD", "8")) or None   # 0 = تصمیم با خود Ollama
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")               # مدت ماندن مدل در حافظهٔ Ollama
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))              # ثانیه؛ برای stream فاصلهٔ بین دو تکه
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "16"))
+
+_ROLES = {"human": "user", "ai": "assistant", "system": "system", "tool": "tool"}
+
+
+class OllamaClient:
+    """
+    کلاینت HTTP مشترک برای API Ollama با connection pool و keep-alive.
+    یک httpx.Client برای threadها و یک httpx.AsyncClient برای هر event loop.
+    """
+    def __init__(
+        self,
+        base_url: str = OLLAMA_BASE_URL,
+        timeout: float = LLM_TIMEOUT,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._client = httpx.Client(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+        self._async: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._lock = threading.Lock()
+
+    def _aclient(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async.get(loop)
+            if client is None:
+                # loopهای بسته‌شده (مثلاً asyncio.run در اسکریپت‌ها) را دور بریز
+                self._async = {lp: c for lp, c in self._async.items() if not lp.is_closed()}
+                client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+                self._async[loop] = client
+            return client
+
+    # ---------- sync ----------
+    def chat(self, payload: dict) -> dict:
+        r = self._client.post("/api/chat", json={**payload, "stream": False})
+        r.raise_for_status()
+        return r.json()
+
+    def chat_stream(self, payload: dict) -> Iterator[dict]:
+        with self._client.stream("POST", "/api/chat", json={**payload, "stream": True}) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def warmup(self, model: str, keep_alive: str | None = LLM_KEEP_ALIVE) -> float:
+        """
+        مدل را در Ollama بارگذاری می‌کند (generate با prompt خالی) تا اولین کاربر هزینهٔ load را ندهد.
+        خروجی: load_duration به ثانیه (طبق گزارش Ollama).
+        """
+        body: dict[str, Any] = {"model": model, "prompt": "", "stream": False}
+        if keep_alive is not None:
+            body["keep_alive"] = keep_alive
+        r = self._client.post("/api/generate", json=body)
+        r.raise_for_status()
+        return r.json().get("load_duration", 0) / 1e9
+
+    # ---------- async ----------
+    async def achat(self, payload: dict) -> dict:
+        r = await self._aclient().post("/api/chat", json={**payload, "stream": False})
+        r.raise_for_status()
+        return r.json()
+
+    async def achat_stream(self, payload: dict) -> AsyncIterator[dict]:
+        async with self._aclient().stream("POST", "/api/chat", json={**payload, "stream": True}) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def close(self) -> None:
+        self._client.close()
+
+
+_clients: dict[str, OllamaClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_ollama_client(base_url: str = OLLAMA_BASE_URL) -> OllamaClient:
+    """یک کلاینت (و یک pool اتصال) برای هر base_url در کل پروسه."""
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            client = OllamaClient(base_url)
+            _clients[base_url] = client
+        return client
+
+
+class PooledChatOllama(BaseChatModel):
+    """
+    جایگزین ChatOllama روی OllamaClient مشترک: اتصال‌ها بین همهٔ chainها و درخواست‌ها
+    دوباره استفاده می‌شوند، keep_alive با هر درخواست فرستاده می‌شود و timeout اعمال می‌شود.
+    """
+    model: str = LLM_MODEL
+    base_url: str = OLLAMA_BASE_URL
+    temperature: float | None = None
+    top_p: float | None = None
+    top_k: int | None = None
+    num_ctx: int | None = LLM_NUM_CTX
+    num_thread: int | None = LLM_NUM_THREAD
+    num_predict: int | None = None
+    keep_alive: str | None = LLM_KEEP_ALIVE
+    client: OllamaClient | None = Field(default=None, exclude=True)
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled-ollama"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model": self.model, "base_url": self.base_url, **self._options()}
+
+    def _client(self) -> OllamaClient:
+        return self.client or get_ollama_client(self.base_url)
+
+    def _options(self) -> dict:
+        opts = {
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+            "num_ctx": self.num_ctx,
+            "num_thread": self.num_thread,
+            "num_predict": self.num_predict,
+        }
+        return {k: v for k, v in opts.items() if v is not None}
+
+    def _payload(self, messages: list[BaseMessage], stop: list[str] | None) -> dict:
+        options = self._options()
+        if stop:
+            options["stop"] = stop
+        payload = {
+            "model": self.model,
+            "messages": [{"role": _ROLES.get(m.type, "user"), "content": m.content} for m in messages],
+            "options": options,
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    @staticmethod
+    def _result(data: dict) -> ChatResult:
+        info = {k: data[k] for k in ("total_duration", "load_duration", "prompt_eval_count", "eval_count") if k in data}
+        message = AIMessage(content=data.get("message", {}).get("content", ""), response_metadata=info)
+        return ChatResult(generations=[ChatGeneration(message=message, generation_info=info)])
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self._result(self._client().chat(self._payload(messages, stop)))
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self._result(await self._client().achat(self._payload(messages, stop)))
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for data in self._client().chat_stream(self._payload(messages, stop)):
+            text = data.get("message", {}).get("content", "")
+            if not text and not data.get("done"):
+                continue
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+            if run_manager and text:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async for data in self._client().achat_stream(self._payload(messages, stop)):
+            text = data.get("message", {}).get("content", "")
+            if not text and not data.get("done"):
+                continue
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+            if run_manager and text:
+                await run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+
+def build_chat_model(model: str | None = None, **options: Any) -> PooledChatOllama:
+    """مدل چت با پیش‌فرض‌های env (LLM_*)؛ options هر فیلد PooledChatOllama را override می‌کند."""
+    return PooledChatOllama(model=model or LLM_MODEL, **options)
+
+
+def warmup_models(models: list[str], base_url: str = OLLAMA_BASE_URL) -> dict[str, float | str]:
+    """
+    بارگذاری مدل‌ها در Ollama؛ خطا (مثلاً Ollama هنوز بالا نیامده) فقط گزارش می‌شود.
+    خروجی: model → load_duration یا متن خطا
+    """
+    client = get_ollama_client(base_url)
+    out: dict[str, float | str] = {}
+    for model in dict.fromkeys(m for m in models if m):
+        try:
+            out[model] = round(client.warmup(model), 3)
+        except httpx.HTTPError as e:
+            out[model] = f"error: {e}"
+    return out
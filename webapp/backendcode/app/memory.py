@@ -0,0 +1,146 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, get_buffer_string
+from langchain.memory.prompt import SUMMARY_PROMPT
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+class LocalTokenCounter:
+    """
+    شمارش توکن بدون رفت‌وبرگشت به LLM.
+    اگر tokenizer_name داده شود از tokenizer محلی HuggingFace استفاده می‌شود،
+    در غیر این صورت تخمین regex (کلمه + علامت) کافی است.
+    """
+    def __init__(self, tokenizer_name: str | None = None):
+        self.tokenizer_name = tokenizer_name or None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    from transformers import AutoTokenizer
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        return self._tokenizer
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.tokenizer_name:
+            return len(self._load().encode(text, add_special_tokens=False))
+        return len(_TOKEN_RE.findall(text))
+
+    def count_messages(self, messages: list[BaseMessage]) -> int:
+        return sum(self.count(m.content) + 4 for m in messages)  # +4 برای نقش و جداکننده‌ها
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(tokenizer_name: str | None = None) -> LocalTokenCounter:
+    return LocalTokenCounter(tokenizer_name)
+
+
+_summary_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _summary_executor
+    with _executor_lock:
+        if _summary_executor is None:
+            _summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+        return _summary_executor
+
+
+class BackgroundSummaryMemory:
+    """
+    جایگزین CombinedMemory(window + token + summary) که روی مسیر درخواست هیچ فراخوانی LLM ندارد:
+      - short_term_history: آخرین k نوبت
+      - token_history: پیام‌های اخیر تا سقف max_token_limit (شمارش با tokenizer محلی)
+      - summary_history: خلاصه + بافر؛ پیام‌های قدیمی‌تر در یک worker پس‌زمینه خلاصه می‌شوند
+    """
+    memory_variables = ["short_term_history", "token_history", "summary_history"]
+
+    def __init__(
+        self,
+        llm,
+        k: int = 6,
+        token_limit: int = 1500,
+        summary_token_limit: int = 2000,
+        counter: LocalTokenCounter | None = None,
+    ):
+        self.llm = llm
+        self.k = k
+        self.token_limit = token_limit
+        self.summary_token_limit = summary_token_limit
+        self.counter = counter or get_token_counter()
+        self.messages: list[BaseMessage] = []
+        self.summary = ""
+        self._pending: list[BaseMessage] = []     # پیام‌های بیرون‌افتاده که هنوز خلاصه نشده‌اند
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    # ---------- BaseMemory-like API ----------
+    def load_memory_variables(self, inputs: dict) -> dict:
+        with self._lock:
+            messages = list(self.messages)
+            summary = self.summary
+        token_history = self._tail_within(messages, self.token_limit)
+        buffer = get_buffer_string(messages)
+        summary_history = f"System: {summary}\n{buffer}" if summary else buffer
+        return {
+            "short_term_history": messages[-self.k * 2:] if self.k else [],
+            "token_history": token_history,
+            "summary_history": summary_history,
+        }
+
+    def save_context(self, inputs: dict, outputs: dict) -> None:
+        human = inputs.get("input", "")
+        ai = outputs.get("answer") or outputs.get("output", "")
+        with self._lock:
+            self.messages.extend([HumanMessage(content=human), AIMessage(content=ai)])
+            # فقط پیام‌هایی که از سقف خلاصه بیرون می‌افتند نگه داشته نمی‌شوند
+            while len(self.messages) > 2 and self.counter.count_messages(self.messages) > self.summary_token_limit:
+                self._pending.append(self.messages.pop(0))
+            schedule = bool(self._pending) and not self._scheduled
+            if schedule:
+                self._scheduled = True
+        if schedule:
+            _executor().submit(self._summarize)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.messages.clear()
+            self._pending.clear()
+            self.summary = ""
+
+    # ---------- internals ----------
+    def _tail_within(self, messages: list[BaseMessage], limit: int) -> list[BaseMessage]:
+        out, total = [], 0
+        for m in reversed(messages):
+            total += self.counter.count(m.content) + 4
+            if total > limit and out:
+                break
+            out.append(m)
+        return list(reversed(out))
+
+    def _summarize(self) -> None:
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                summary = self.summary
+                if not pending:
+                    self._scheduled = False
+                    return
+            try:
+                prompt = SUMMARY_PROMPT.format(summary=summary, new_lines=get_buffer_string(pending))
+                result = self.llm.invoke(prompt)
+                new_summary = getattr(result, "content", str(result)).strip()
+            except Exception:
+                # خلاصه‌سازی بهینه‌سازی است؛ در خطا همان خلاصهٔ قبلی باقی می‌ماند
+                new_summary = summary
+            with self._lock:
+                self.summary = new_summary
@@ -0,0 +1,249 @@
+"""
+اندازه‌گیری زمان مراحل (چت، ingest، درخواست HTTP) و خروجی Prometheus برای /metrics.
+
+  - observe_stages("chat", timings): زمان هر مرحله در histogram سراسری و trace درخواست جاری
+  - start_trace() / end_trace(): زمان مراحل یک درخواست برای header اشکال‌زدایی Server-Timing
+  - REGISTRY.register(prefix, fn): آمار کش‌ها و صف‌ها هنگام scrape به صورت gauge خوانده می‌شوند
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+# ثانیه؛ از lookup کش (میلی‌ثانیه) تا تولید کامل پاسخ یا ingest یک PDF بزرگ
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class StageStats:
+    """جمع زمان هر مرحلهٔ پاسخ‌گویی (rewrite / retrieve / generate / ...) برای /stats."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: dict[str, dict] = {}
+        self.rewrites = 0
+        self.rewrites_skipped = 0
+
+    def record(self, timings: dict[str, float], rewritten: bool | None = None) -> None:
+        with self._lock:
+            for name, seconds in timings.items():
+                st = self._stages.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+                st["count"] += 1
+                st["total"] += seconds
+                st["max"] = max(st["max"], seconds)
+            if rewritten is True:
+                self.rewrites += 1
+            elif rewritten is False:
+                self.rewrites_skipped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rewrites": self.rewrites,
+                "rewrites_skipped": self.rewrites_skipped,
+                "stages": {
+                    name: {
+                        "count": st["count"],
+                        "avg_seconds": round(st["total"] / st["count"], 4),
+                        "max_seconds": round(st["max"], 4),
+                        "total_seconds": round(st["total"], 3),
+                    }
+                    for name, st in self._stages.items()
+                },
+            }
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        out, acc = [], 0
+        for bound, n in zip(self.buckets, self.counts):
+            acc += n
+            out.append((_fmt(bound), acc))
+        out.append(("+Inf", self.count))
+        return out
+
+
+def _fmt(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: tuple[tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _flatten(prefix: str, data) -> Iterator[tuple[str, float]]:
+    """dict تو در تو → (نام, مقدار) برای مقادیر عددی؛ رشته‌ها و None نادیده گرفته می‌شوند."""
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from _flatten(f"{prefix}_{key}", value)
+    elif isinstance(data, (int, float)) and not (isinstance(data, float) and math.isnan(data)):
+        yield prefix, data
+
+
+class MetricsRegistry:
+    """
+    histogramها و counterهای درون‌پروسه‌ای با خروجی متنی Prometheus.
+    مقادیر هر worker جداست؛ در استقرار چندپروسه‌ای هر worker جداگانه scrape می‌شود.
+    """
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help: dict[str, tuple[str, str]] = {}     # name → (type, help)
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._collectors: list[tuple[str, str, Callable[[], dict | None]]] = []
+
+    def describe(self, name: str, kind: str, help: str) -> None:
+        self._help[name] = (kind, help)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = Histogram(self.buckets)
+            hist.observe(value)
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def register(self, prefix: str, fn: Callable[[], dict | None], help: str = "") -> None:
+        """fn هنگام هر scrape صدا زده می‌شود؛ مقادیر عددی آن gauge با نام prefix_<key> می‌شوند."""
+        self._collectors.append((prefix, help, fn))
+
+    def render(self) -> str:
+        lines: list[str] = []
+
+        def head(name: str, kind: str, help: str = ""):
+            kind, help = self._help.get(name, (kind, help))
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            histograms = {
+                n: {k: (h.cumulative(), h.sum, h.count) for k, h in s.items()}
+                for n, s in self._histograms.items()
+            }
+        for name, series in sorted(counters.items()):
+            head(name, "counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_labels(key)} {_fmt(value)}")
+        for name, series in sorted(histograms.items()):
+            head(name, "histogram")
+            for key, (buckets, total, count) in sorted(series.items()):
+                for le, n in buckets:
+                    bound = f'le="{le}"'
+                    lines.append(f"{name}_bucket{_labels(key, bound)} {n}")
+                lines.append(f"{name}_sum{_labels(key)} {_fmt(total)}")
+                lines.append(f"{name}_count{_labels(key)} {count}")
+        for prefix, help, fn in self._collectors:
+            try:
+                data = fn()
+            except Exception:
+                continue    # یک منبع خراب نباید کل scrape را از کار بیندازد
+            for name, value in _flatten(prefix, data or {}):
+                head(name, "gauge", help)
+                lines.append(f"{name} {_fmt(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.describe("roshd_stage_seconds", "histogram", "Time spent in each stage of a chat turn or an ingestion run.")
+REGISTRY.describe("roshd_http_request_seconds", "histogram", "HTTP request latency by route and status.")
+REGISTRY.describe("roshd_http_requests_total", "counter", "HTTP requests by route and status.")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ---------- per-request trace ----------
+class Trace:
+    """زمان مراحل یک درخواست؛ مرحلهٔ تکراری (مثلاً دو lookup) جمع زده می‌شود."""
+    def __init__(self):
+        self.t_start = time.perf_counter()
+        self.timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, timings: dict[str, float]) -> None:
+        with self._lock:
+            for name, seconds in timings.items():
+                self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """مقدار header استاندارد Server-Timing (میلی‌ثانیه)؛ در DevTools مرورگر هم نمایش داده می‌شود."""
+        with self._lock:
+            items = list(self.timings.items())
+        items.append(("app", time.perf_counter() - self.t_start))
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in items)
+
+
+_current: ContextVar[Trace | None] = ContextVar("roshd_trace", default=None)
+
+
+def current_trace() -> Trace | None:
+    return _current.get()
+
+
+def start_trace():
+    """شروع trace برای درخواست جاری؛ خروجی token برای end_trace است."""
+    return _current.set(Trace())
+
+
+def end_trace(token) -> None:
+    _current.reset(token)
+
+
+@contextmanager
+def span(name: str, timings: dict[str, float]):
+    """زمان بلوک را (به صورت جمعی) در timings[name] می‌نویسد."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - t0
+
+
+def observe_stages(flow: str, timings: dict[str, float]) -> None:
+    """ثبت زمان مراحل در histogram سراسری و در trace درخواست جاری (اگر باشد)."""
+    for stage, seconds in timings.items():
+        REGISTRY.observe("roshd_stage_seconds", seconds, flow=flow, stage=stage)
+    trace = _current.get()
+    if trace is not None:
+        trace.add(timings)
+
+
+def observe_request(method: str, route: str, status: int, seconds: float) -> None:
+    REGISTRY.observe("roshd_http_request_seconds", seconds, method=method, route=route, status=str(status))
+    REGISTRY.inc("roshd_http_requests_total", method=method, route=route, status=str(status))
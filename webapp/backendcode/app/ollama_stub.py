@@ -0,0 +1,179 @@
+"""
+سرور ساختگی با API Ollama برای تست و benchmark بدون مدل واقعی.
+    python -m app.ollama_stub --port 11435 --token-delay 0.02
+    OLLAMA_BASE_URL=http://localhost:11435 python -m app.server
+
+endpointها: POST /api/chat (stream و بدون stream)، POST /api/generate، GET /api/tags، GET /api/version
+و POST /v1/chat/completions (API سازگار با OpenAI که Ollama هم دارد، بدون stream)
+پاسخ چت: اگر --reply داده نشود، پیام آخر کاربر با پیشوند «پاسخ:» برگردانده می‌شود؛ {n} در --reply شمارهٔ درخواست است.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, reply: str | None = None, token_delay: float = 0.0, load_delay: float = 0.0):
+        self.reply = reply
+        self.token_delay = token_delay
+        self.load_delay = load_delay       # اولین درخواست هر مدل (شبیه load شدن مدل در Ollama)
+        self.loaded: set[str] = set()
+        self.requests: list[dict] = []     # بدنهٔ درخواست‌ها برای assert در تست
+        self.connections = 0               # تعداد اتصال‌های TCP پذیرفته‌شده
+        self.lock = threading.Lock()
+
+    def answer(self, body: dict) -> str:
+        if self.reply is not None:
+            with self.lock:
+                n = len(self.requests)
+            return self.reply.replace("{n}", str(n))
+        users = [m.get("content", "") for m in body.get("messages", []) if m.get("role") == "user"]
+        return "پاسخ: " + (users[-1] if users else "")
+
+    def load(self, model: str) -> float:
+        with self.lock:
+            first = model not in self.loaded
+            self.loaded.add(model)
+        if first and self.load_delay:
+            time.sleep(self.load_delay)
+            return self.load_delay
+        return 0.0
+
+
+def _handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive ؛ برای آزمودن pool اتصال لازم است
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.connections += 1
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, data: dict, status: int = 200):
+            raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def _body(self) -> dict:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            with state.lock:
+                state.requests.append({"path": self.path, **body})
+            return body
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                self._send_json({"models": [{"name": m} for m in sorted(state.loaded)]})
+            elif self.path == "/api/version":
+                self._send_json({"version": "stub"})
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            body = self._body()
+            model = body.get("model", "")
+            if self.path == "/api/generate":
+                load = state.load(model)
+                self._send_json({"model": model, "response": "", "done": True, "load_duration": int(load * 1e9)})
+            elif self.path == "/api/chat":
+                load = state.load(model)
+                text = state.answer(body)
+                if body.get("stream", True):
+                    self._stream(model, text, load)
+                else:
+                    time.sleep(state.token_delay * len(text.split()))
+                    self._send_json({
+                        "model": model,
+                        "message": {"role": "assistant", "content": text},
+                        "done": True,
+                        "load_duration": int(load * 1e9),
+                        "eval_count": len(text.split()),
+                    })
+            elif self.path == "/v1/chat/completions":
+                state.load(model)
+                text = state.answer(body)
+                time.sleep(state.token_delay * len(text.split()))
+                self._send_json({
+                    "object": "chat.completion",
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": {"completion_tokens": len(text.split())},
+                })
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def _stream(self, model: str, text: str, load: float):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def chunk(data: dict):
+                raw = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(raw):x}\r\n".encode() + raw + b"\r\n")
+                self.wfile.flush()
+
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                time.sleep(state.token_delay)
+                piece = word if i == 0 else " " + word
+                chunk({"model": model, "message": {"role": "assistant", "content": piece}, "done": False})
+            chunk({"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                   "load_duration": int(load * 1e9), "eval_count": len(words)})
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+class OllamaStub:
+    """سرور ساختگی در یک thread پس‌زمینه؛ url برای OLLAMA_BASE_URL یا PooledChatOllama(base_url=...)."""
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, **state_kwargs):
+        self.state = StubState(**state_kwargs)
+        self.server = ThreadingHTTPServer((host, port), _handler(self.state))
+        self.server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "OllamaStub":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Ollama API stub")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=11435)
+    ap.add_argument("--reply", default=None, help="fixed reply for every chat request; {n} = request number")
+    ap.add_argument("--token-delay", type=float, default=0.0, help="seconds per streamed word")
+    ap.add_argument("--load-delay", type=float, default=0.0, help="seconds for the first request of each model")
+    args = ap.parse_args()
+    stub = OllamaStub(args.host, args.port, reply=args.reply, token_delay=args.token_delay, load_delay=args.load_delay)
+    print(f"ollama stub listening on {stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
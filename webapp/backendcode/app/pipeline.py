@@ -1,14 +1,47 @@
+import hashlib
+import json
+import os
 import shutil
+import threading
+import time
 import uuid
+from contextlib import contextmanager
 from pathlib import Path
-from .converters import pdf_to_markdown
-from .indexing import build_faiss_index
+from typing import Callable
+from langchain_core.embeddings import Embeddings
+from .converters import pdf_to_markdown_pages
+from .indexing import sync_faiss_index
+from .metrics import observe_stages
+from .shared_index import SharedIndex
+
+MANIFEST = "manifest.json"
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
 
 class DocPipeline:
-    def __init__(self, docs_dir: str, embed_model: str):
+    def __init__(
+        self,
+        docs_dir: str,
+        embed_model: str,
+        embeddings: Embeddings | None = None,
+        convert_workers: int | None = None,
+        shared_index: SharedIndex | None = None,
+        compact_quantizer: str | None = None,
+    ):
         self.docs_dir = Path(docs_dir)
         self.docs_dir.mkdir(parents=True, exist_ok=True)
         self.embed_model = embed_model
+        self.embeddings = embeddings
+        self.convert_workers = convert_workers   # None = خودکار، 1 = بدون process جدا
+        self.shared_index = shared_index         # اگر داده شود بردارها به ایندکس سراسری هم منتقل می‌شوند
+        self.compact_quantizer = compact_quantizer  # sq8 / pq ؛ None = فقط فرمت FAISS معمولی
+        self._by_hash: dict[str, str] | None = None   # pdf_sha256 → doc_id (lazy)
+        self._hash_lock = threading.Lock()
 
     def create_workspace(self, doc_id: str | None = None) -> str:
         doc_id = doc_id or str(uuid.uuid4())
@@ -16,22 +49,183 @@ class DocPipeline:
         ws.mkdir(parents=True, exist_ok=True)
         return doc_id
 
-    def run_all(self, src_pdf_path: str, doc_id: str | None = None) -> dict:
-        """ایجاد (یا استفاده از) doc_id → کپی PDF → ساخت md → ساخت ایندکس"""
-        doc_id = self.create_workspace(doc_id)
+    def paths(self, doc_id: str) -> dict:
         ws = self.docs_dir / doc_id
-        pdf_path = ws / "source.pdf"
-        shutil.copy2(src_pdf_path, pdf_path)
+        return {
+            "ws": ws,
+            "pdf": ws / "source.pdf",
+            "md": ws / "skill.md",
+            "pages": ws / "pages.json",
+            "index": ws / "my_faiss_index",
+            "manifest": ws / MANIFEST,
+        }
+
+    def workspace_status(self, doc_id: str) -> dict:
+        """وضعیت فایل‌های workspace؛ بعد از هر ingest در جدول freelancers ثبت می‌شود."""
+        paths = self.paths(doc_id)
+        index_dir = paths["index"]
+        index_bytes = sum(p.stat().st_size for p in index_dir.rglob("*") if p.is_file()) if index_dir.exists() else 0
+        return {
+            "has_pdf": paths["pdf"].exists(),
+            "has_md": paths["md"].exists(),
+            "has_index": index_dir.exists(),
+            "chunks": (self.read_manifest(doc_id) or {}).get("chunks"),
+            "index_bytes": index_bytes,
+        }
+
+    # ---------- manifest / dedup ----------
+    @property
+    def _model_name(self) -> str:
+        return getattr(self.embeddings, "model_name", self.embed_model)
+
+    def read_manifest(self, doc_id: str) -> dict | None:
+        p = self.paths(doc_id)["manifest"]
+        if not p.exists():
+            return None
+        try:
+            return json.loads(p.read_text(encoding="utf-8"))
+        except ValueError:
+            return None
+
+    def _is_complete(self, doc_id: str, pdf_sha256: str) -> bool:
+        m = self.read_manifest(doc_id)
+        return bool(
+            m
+            and m.get("pdf_sha256") == pdf_sha256
+            and m.get("embed_model") == self._model_name
+            and (self.paths(doc_id)["index"] / "index.faiss").exists()
+        )
+
+    def _hash_map(self) -> dict[str, str]:
+        # قفل باید گرفته شده باشد
+        if self._by_hash is None:
+            self._by_hash = {}
+            for m_path in self.docs_dir.glob(f"*/{MANIFEST}"):
+                try:
+                    m = json.loads(m_path.read_text(encoding="utf-8"))
+                except ValueError:
+                    continue
+                if m.get("pdf_sha256"):
+                    self._by_hash.setdefault(m["pdf_sha256"], m_path.parent.name)
+        return self._by_hash
+
+    def find_by_hash(self, pdf_sha256: str) -> str | None:
+        """doc_id یک workspace کامل با همین PDF (و همین مدل embedding)، اگر وجود داشته باشد."""
+        with self._hash_lock:
+            doc_id = self._hash_map().get(pdf_sha256)
+        if doc_id and self._is_complete(doc_id, pdf_sha256):
+            return doc_id
+        return None
+
+    def _write_manifest(self, doc_id: str, pdf_sha256: str, extra: dict) -> None:
+        manifest = {"pdf_sha256": pdf_sha256, "embed_model": self._model_name, **extra}
+        # RAGManager در هر پروسه از امضای این فایل تازه بودن ایندکس کش‌شده را می‌فهمد؛ یک‌باره جایگزین می‌شود
+        path = self.paths(doc_id)["manifest"]
+        tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp.write_text(json.dumps(manifest), encoding="utf-8")
+        os.replace(tmp, path)
+        with self._hash_lock:
+            self._hash_map()[pdf_sha256] = doc_id
+
+    def _embeddings_for_load(self) -> Embeddings:
+        # load_local فقط یک شیء Embeddings می‌خواهد؛ برای انتقال بردارها مدل بارگذاری نمی‌شود
+        if self.embeddings is None:
+            from .embeddings import get_embedding_service
+            return get_embedding_service(self.embed_model)
+        return self.embeddings
+
+    def _copy_workspace(self, src_id: str, dst_id: str) -> None:
+        src, dst = self.paths(src_id), self.paths(dst_id)
+        shutil.copy2(src["pdf"], dst["pdf"])
+        shutil.copy2(src["md"], dst["md"])
+        if src["pages"].exists():
+            shutil.copy2(src["pages"], dst["pages"])
+        if dst["index"].exists():
+            shutil.rmtree(dst["index"])
+        shutil.copytree(src["index"], dst["index"])
+
+    # ---------- run ----------
+    @contextmanager
+    def _stage(self, name: str, timings: dict, on_stage: Callable[[str], None] | None):
+        if on_stage:
+            on_stage(name)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = round(time.perf_counter() - t0, 4)
+
+    def run_all(
+        self,
+        src_pdf_path: str,
+        doc_id: str | None = None,
+        on_stage: Callable[[str], None] | None = None,
+    ) -> dict:
+        """
+        ایجاد (یا استفاده از) doc_id → کپی PDF → ساخت md → ساخت ایندکس
+        on_stage قبل از شروع هر مرحله با نام آن صدا زده می‌شود؛ زمان هر مرحله در timings برمی‌گردد.
+
+        با hash فایل PDF:
+          - همان PDF برای همین doc_id → هیچ کاری انجام نمی‌شود (reused="same")
+          - همان PDF در workspace دیگری → فایل‌ها و ایندکس کپی می‌شوند (reused="copy")
+          - PDF تغییر کرده → فقط chunkهای جدید embed می‌شوند (reused=None)
+        """
+        timings: dict[str, float] = {}
+        t_start = time.perf_counter()
+        doc_id = self.create_workspace(doc_id)
+        paths = self.paths(doc_id)
+        pdf_path, md_path, index_dir = paths["pdf"], paths["md"], paths["index"]
+
+        with self._stage("hash", timings, on_stage):
+            pdf_sha256 = file_sha256(src_pdf_path)
+
+        reused = None
+        index_stats = {"added": 0, "removed": 0, "kept": 0}
+        if self._is_complete(doc_id, pdf_sha256):
+            reused = "same"
+        else:
+            # تا پایان موفق، این workspace نباید کامل به نظر برسد
+            paths["manifest"].unlink(missing_ok=True)
+            twin = self.find_by_hash(pdf_sha256)
+            if twin and twin != doc_id:
+                with self._stage("copy", timings, on_stage):
+                    self._copy_workspace(twin, doc_id)
+                reused = "copy"
+                index_stats = {**index_stats, "kept": (self.read_manifest(twin) or {}).get("chunks", 0)}
+
+        if reused is None:
+            with self._stage("copy", timings, on_stage):
+                shutil.copy2(src_pdf_path, pdf_path)
+
+            with self._stage("convert", timings, on_stage):
+                pages = pdf_to_markdown_pages(str(pdf_path), str(md_path), workers=self.convert_workers)
+                paths["pages"].write_text(json.dumps(pages), encoding="utf-8")
+
+            with self._stage("index", timings, on_stage):
+                index_stats = sync_faiss_index(
+                    str(md_path), str(index_dir), embed_model=self.embed_model,
+                    embeddings=self.embeddings, page_offsets=pages, compact=self.compact_quantizer,
+                    preprocess_workers=self.convert_workers,
+                )
 
-        md_path = ws / "skill.md"
-        pdf_to_markdown(str(pdf_path), str(md_path))
+        if self.shared_index is not None and (reused != "same" or doc_id not in self.shared_index):
+            with self._stage("publish", timings, on_stage):
+                self.shared_index.upsert_from_faiss(doc_id, str(index_dir), self._embeddings_for_load())
 
-        index_dir = ws / "my_faiss_index"
-        build_faiss_index(str(md_path), str(index_dir), embed_model=self.embed_model)
+        if reused != "same":
+            chunks = index_stats["added"] + index_stats["kept"]
+            self._write_manifest(doc_id, pdf_sha256, {"chunks": chunks})
+        observe_stages("ingest", {**timings, "total": time.perf_counter() - t_start})
 
         return {
             "doc_id": doc_id,
             "pdf_path": str(pdf_path),
             "md_path": str(md_path),
+            "pages_path": str(paths["pages"]),
             "index_dir": str(index_dir),
+            "pdf_sha256": pdf_sha256,
+            "reused": reused,
+            "index_stats": index_stats,
+            "timings": timings,
+            "workspace": self.workspace_status(doc_id),
         }
@@ -1,10 +1,15 @@
+import asyncio
+import re
+import sys
+import time
+from contextlib import nullcontext
 from pathlib import Path
 from functools import lru_cache
-from langchain_community.chat_models import ChatOllama
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from typing import AsyncIterator, Iterator
+from langchain_core.embeddings import Embeddings
 from langchain.vectorstores import FAISS
-from langchain.chains import create_retrieval_chain, create_history_aware_retriever
 from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.memory import (
     ConversationBufferWindowMemory,
@@ -12,7 +17,18 @@ from langchain.memory import (
     ConversationTokenBufferMemory,
     CombinedMemory,
 )
-import torch
+from .embeddings import get_embedding_service
+from .cache import LRUCache
+from .sessions import SessionStore
+from .memory import BackgroundSummaryMemory, get_token_counter
+from .shared_index import SharedIndex, SharedIndexRetriever
+from .compact_index import CompactIndex, CompactIndexRetriever, has_compact
+from .answer_cache import SemanticAnswerCache
+from .hybrid import BM25Index, CrossEncoderReranker, HybridRetriever
+from .limiter import ConcurrencyLimiter
+from .metrics import StageStats, observe_stages, span
+from .llm import build_chat_model
+from .textproc import chunk_hash, preprocess, tokenize
 
 SYSTEM_PROMPT = (
     "تو یک دستیار خوب برای مذاکره کردن هستی. "
@@ -26,55 +42,282 @@ SYSTEM_PROMPT = (
     "خیلی کوتاه جواب بده.\n\n{context}"
 )
 
-def _embeddings(model_name: str):
-    return HuggingFaceEmbeddings(
-        model_name=model_name,
-        model_kwargs={  # device باید اینجاست
-            "device": "cuda" if torch.cuda.is_available() else "cpu",
-        },
-        encode_kwargs={
-            "batch_size": 16,
-            "normalize_embeddings": True,
-        },
-    )
-
-def _build_chain(faiss_dir: str, embed_model: str):
-    emb = _embeddings(embed_model)
-    vs = FAISS.load_local(faiss_dir, embeddings=emb, allow_dangerous_deserialization=True)
-    retriever = vs.as_retriever(search_type="similarity", search_kwargs={"k": 10})
-
-    llm = ChatOllama(model="llama3.1:latest", temperature=0.1, top_p=0.9, top_k=40, num_ctx=4096, num_thread=8, streaming=False)
-    s_llm = ChatOllama(model="llama3.1:latest", temperature=0.0)
+MEMORY_MODES = ("async", "sync")
 
+def _build_memory(s_llm, mode: str = "async", drop_unused: bool = False, tokenizer_name: str | None = None):
+    """
+    حافظهٔ یک گفتگو؛ برای هر session جدا ساخته می‌شود.
+      - drop_unused: فقط short_term_history که promptها واقعاً مصرف می‌کنند
+      - async: خلاصه‌سازی در پس‌زمینه و شمارش توکن با tokenizer محلی
+      - sync: رفتار قبلی (CombinedMemory با فراخوانی هم‌زمان s_llm)
+    """
+    if drop_unused:
+        return ConversationBufferWindowMemory(k=6, return_messages=True, memory_key="short_term_history")
+    if mode == "async":
+        return BackgroundSummaryMemory(
+            s_llm, k=6, token_limit=1500, summary_token_limit=2000,
+            counter=get_token_counter(tokenizer_name),
+        )
     short = ConversationBufferWindowMemory(k=6, return_messages=True, memory_key="short_term_history")
     token = ConversationTokenBufferMemory(llm=s_llm, max_token_limit=1500, return_messages=True, memory_key="token_history")
     summ  = ConversationSummaryBufferMemory(llm=s_llm, max_token_limit=2000, return_messages=False, memory_key="summary_history")
-    memory = CombinedMemory(memories=[short, token, summ])
-
-    search_prompt = ChatPromptTemplate.from_messages([
-        ("system", "با توجه به تاریخچهٔ گفتگو و سؤال جدید، یک عبارت جستجوی کوتاه و دقیق بساز."),
-        (MessagesPlaceholder(variable_name="short_term_history")),
-        ("human", "{input}"),
-    ])
-    answer_prompt = ChatPromptTemplate.from_messages([
-        ("system", SYSTEM_PROMPT),
-        (MessagesPlaceholder(variable_name="short_term_history")),
-        ("human", "{input}"),
-    ])
-
-    history_aware = create_history_aware_retriever(llm=llm, retriever=retriever, prompt=search_prompt)
-    qa_chain = create_stuff_documents_chain(llm, answer_prompt)
-    rag_chain = create_retrieval_chain(history_aware, qa_chain)
-    return rag_chain, memory
+    return CombinedMemory(memories=[short, token, summ])
+
+REWRITE_MODES = ("auto", "always", "never")
+RETRIEVAL_MODES = ("hybrid", "vector")
+
+# فقط ضمیرها و اشاره‌های ارجاعی؛ سؤالی که یکی از این‌ها را دارد بدون تاریخچه معنا ندارد.
+# کلمات پرسشی عام (چطور، چرا، ...) ارجاعی نیستند و اینجا نمی‌آیند.
+_FOLLOWUP_WORDS = frozenset(
+    "این اون آن همین همون اینو اونو همینو همونو اینا اونا اینها آنها اونها همینا همونا قبلی".split()
+)
+_WORD_RE = re.compile(r"\w+")
+
+def is_followup(question: str, max_words: int = 2) -> bool:
+    """
+    سؤال ادامه‌دار (نیازمند بازنویسی با تاریخچه): یا خیلی کوتاه است («بیشتر بگو»، «قیمتش؟»)
+    یا ضمیر/اشارهٔ ارجاعی دارد («اون پروژه کی تموم شد؟»). سؤال کامل و مستقل مستقیم embed می‌شود.
+    """
+    words = _WORD_RE.findall(question)
+    return len(words) <= max_words or any(w in _FOLLOWUP_WORDS for w in words)
+
+class RAGChain:
+    """
+    rewrite (اختیاری) → retrieve → generate ، با زمان هر مرحله.
+    به جای create_history_aware_retriever: بازنویسی سؤال یک فراخوانی کامل LLM است و
+    فقط وقتی انجام می‌شود که تاریخچه وجود داشته باشد و سؤال به آن ارجاع بدهد:
+      - never: سؤال خام همیشه مستقیم embed می‌شود
+      - always: هر وقت تاریخچه هست بازنویسی می‌شود
+      - auto: فقط سؤال‌های خیلی کوتاه یا دارای ضمیر ارجاعی (مثل «این»، «همون») بازنویسی می‌شوند (is_followup)
+    """
+    def __init__(self, retriever, llm, rewriter=None, rewrite_mode: str = "auto", rewrite_max_words: int = 2):
+        if rewrite_mode not in REWRITE_MODES:
+            raise ValueError(f"rewrite_mode must be one of {REWRITE_MODES}")
+        self.retriever = retriever
+        self.rewrite_mode = rewrite_mode
+        self.rewrite_max_words = rewrite_max_words
+
+        search_prompt = ChatPromptTemplate.from_messages([
+            ("system", "با توجه به تاریخچهٔ گفتگو و سؤال جدید، یک عبارت جستجوی کوتاه و دقیق بساز."),
+            (MessagesPlaceholder(variable_name="short_term_history")),
+            ("human", "{input}"),
+        ])
+        answer_prompt = ChatPromptTemplate.from_messages([
+            ("system", SYSTEM_PROMPT),
+            (MessagesPlaceholder(variable_name="short_term_history")),
+            ("human", "{input}"),
+        ])
+        self.search_chain = search_prompt | (rewriter or llm) | StrOutputParser()
+        self.qa_chain = create_stuff_documents_chain(llm, answer_prompt)
+
+    def needs_rewrite(self, inputs: dict) -> bool:
+        if self.rewrite_mode == "never" or not inputs.get("short_term_history"):
+            return False
+        if self.rewrite_mode == "always":
+            return True
+        return is_followup(inputs["input"], self.rewrite_max_words)
+
+    def _retrieve(self, inputs: dict, timings: dict) -> tuple[str, list]:
+        search_query = inputs["input"]
+        if self.needs_rewrite(inputs):
+            t0 = time.perf_counter()
+            search_query = self.search_chain.invoke(inputs).strip() or inputs["input"]
+            timings["rewrite"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        # chunkها با preprocess ایندکس شده‌اند؛ سؤال هم همان‌طور نرمال می‌شود
+        docs = self.retriever.invoke(preprocess(search_query) or search_query)
+        timings["retrieve"] = time.perf_counter() - t0
+        return search_query, docs
+
+    async def _aretrieve(self, inputs: dict, timings: dict) -> tuple[str, list]:
+        search_query = inputs["input"]
+        if self.needs_rewrite(inputs):
+            t0 = time.perf_counter()
+            search_query = (await self.search_chain.ainvoke(inputs)).strip() or inputs["input"]
+            timings["rewrite"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        docs = await self.retriever.ainvoke(preprocess(search_query) or search_query)
+        timings["retrieve"] = time.perf_counter() - t0
+        return search_query, docs
+
+    def invoke(self, inputs: dict) -> dict:
+        timings: dict[str, float] = {}
+        search_query, docs = self._retrieve(inputs, timings)
+        t0 = time.perf_counter()
+        answer = self.qa_chain.invoke({**inputs, "context": docs})
+        timings["generate"] = time.perf_counter() - t0
+        return {**inputs, "search_query": search_query, "context": docs, "answer": answer, "timings": timings}
+
+    async def ainvoke(self, inputs: dict) -> dict:
+        timings: dict[str, float] = {}
+        search_query, docs = await self._aretrieve(inputs, timings)
+        t0 = time.perf_counter()
+        answer = await self.qa_chain.ainvoke({**inputs, "context": docs})
+        timings["generate"] = time.perf_counter() - t0
+        return {**inputs, "search_query": search_query, "context": docs, "answer": answer, "timings": timings}
+
+    def stream(self, inputs: dict) -> Iterator[dict]:
+        """تکه‌های {"answer": ...} و در پایان یک {"timings": ...} (شامل first_token)."""
+        timings: dict[str, float] = {}
+        _search_query, docs = self._retrieve(inputs, timings)
+        t0 = time.perf_counter()
+        for piece in self.qa_chain.stream({**inputs, "context": docs}):
+            if "first_token" not in timings:
+                timings["first_token"] = time.perf_counter() - t0
+            yield {"answer": piece}
+        timings["generate"] = time.perf_counter() - t0
+        yield {"timings": timings}
+
+    async def astream(self, inputs: dict) -> AsyncIterator[dict]:
+        timings: dict[str, float] = {}
+        _search_query, docs = await self._aretrieve(inputs, timings)
+        t0 = time.perf_counter()
+        async for piece in self.qa_chain.astream({**inputs, "context": docs}):
+            if "first_token" not in timings:
+                timings["first_token"] = time.perf_counter() - t0
+            yield {"answer": piece}
+        timings["generate"] = time.perf_counter() - t0
+        yield {"timings": timings}
+
+def _answer_llm():
+    return build_chat_model(temperature=0.1, top_p=0.9, top_k=40)
+
+def _rewrite_llm(rewrite_model: str | None):
+    # بازنویسی فقط یک عبارت کوتاه می‌سازد؛ یک مدل کوچک‌تر و context کوتاه‌تر کافی است
+    return build_chat_model(rewrite_model, temperature=0.0, num_ctx=2048, num_predict=48) if rewrite_model else None
+
+def _build_chain(retriever, llm=None, rewriter=None, rewrite_mode: str = "auto") -> RAGChain:
+    return RAGChain(retriever, llm or _answer_llm(), rewriter=rewriter, rewrite_mode=rewrite_mode)
+
+def _doc_hash(doc) -> str:
+    return doc.metadata.get("hash") or chunk_hash(doc.page_content)
+
+class _LazyDocs:
+    """نگاشت hash → شمارهٔ ردیف در CompactIndex؛ متن فقط برای chunkهای انتخاب‌شده از mmap خوانده می‌شود."""
+    def __init__(self, index: CompactIndex):
+        self.index = index
+        self.positions = {index.metadata(i).get("hash"): i for i in range(len(index))}
+
+    def all(self):
+        return (self.index.document(i) for i in range(len(self.index)))
+
+    def fetch(self, h: str):
+        i = self.positions.get(h)
+        return self.index.document(i) if i is not None else None
+
+    def nbytes(self) -> int:
+        """dict ، کلیدهای hash و شماره‌های ردیف"""
+        return sys.getsizeof(self.positions) + sum(sys.getsizeof(h) + 28 for h in self.positions)
+
+# سربار تقریبی chain و LLM client برای هر doc_id
+_ENTRY_OVERHEAD_BYTES = 256 * 1024
+
+def _retriever_bytes(retriever) -> int:
+    """ساختارهای hybrid: postingهای BM25 و نگاشت hash → chunk (dict یا _LazyDocs)"""
+    if not isinstance(retriever, HybridRetriever):
+        return 0
+    size = retriever.bm25.nbytes() if retriever.bm25 is not None else 0
+    lookup = getattr(retriever.fetch, "__self__", None)
+    if isinstance(lookup, _LazyDocs):
+        size += lookup.nbytes()
+    elif isinstance(lookup, dict):
+        size += sys.getsizeof(lookup)          # Documentها در docstore شمرده می‌شوند
+    return size
+
+def _estimate_bytes(entry) -> int:
+    """تخمین حجم یک ورودی کش: بردارهای float32 ایندکس + متن chunkها + BM25 و نگاشت‌های hybrid."""
+    chain, vs, _version = entry       # در backend اشتراکی vs برابر None است
+    size = _ENTRY_OVERHEAD_BYTES + _retriever_bytes(getattr(chain, "retriever", None))
+    if isinstance(vs, CompactIndex):
+        return size + vs.resident_bytes()
+    index = getattr(vs, "index", None)
+    if index is not None:
+        size += index.ntotal * index.d * 4
+    docstore = getattr(getattr(vs, "docstore", None), "_dict", {})
+    for doc in docstore.values():
+        size += len(doc.page_content.encode("utf-8")) + 256
+    return size
+
+
+def _close_entry(_doc_id, entry) -> None:
+    """on_evict کش: فایل‌های mmap نسخهٔ فشرده بسته می‌شوند (FAISS و اشتراکی چیزی برای بستن ندارند)."""
+    _chain, vs, _version = entry
+    if isinstance(vs, CompactIndex):
+        vs.close()
 
 class RAGManager:
     """
-    یک کش ساده برای چندین doc_id
+    کش LRU محدود برای چندین doc_id (تعداد، حجم تخمینی و TTL بیکاری).
+    chain و ایندکس بین همهٔ گفتگوهای یک doc_id مشترک است و تاریخچه برای هر session جداست.
+    هر ورودی نسخهٔ manifest.json workspace را هنگام بارگذاری نگه می‌دارد تا ingest دوباره در پروسهٔ دیگری
+    هم در get دیده شود.
     """
-    def __init__(self, docs_dir: str, embed_model: str):
+    def __init__(
+        self,
+        docs_dir: str,
+        embed_model: str,
+        embeddings: Embeddings | None = None,
+        max_entries: int | None = 64,
+        max_bytes: int | None = None,
+        ttl: float | None = 1800,
+        max_sessions: int | None = 10000,
+        session_ttl: float | None = 3600,
+        memory_mode: str = "async",
+        drop_unused_memory: bool = False,
+        tokenizer_name: str | None = None,
+        shared_index: SharedIndex | None = None,
+        prefer_compact: bool = True,
+        answer_cache: SemanticAnswerCache | None = None,
+        answer_cache_first_turn_only: bool = True,
+        rewrite_model: str | None = None,
+        rewrite_mode: str = "auto",
+        retrieval: str = "hybrid",
+        rerank_model: str | None = None,
+        max_k: int = 6,
+        context_token_budget: int = 1800,
+        limiter: ConcurrencyLimiter | None = None,
+    ):
+        if rewrite_mode not in REWRITE_MODES:
+            raise ValueError(f"rewrite_mode must be one of {REWRITE_MODES}")
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"retrieval must be one of {RETRIEVAL_MODES}")
+        if memory_mode not in MEMORY_MODES:
+            raise ValueError(f"memory_mode must be one of {MEMORY_MODES}")
         self.docs_dir = Path(docs_dir)
         self.embed_model = embed_model
-        self._cache = {}
+        self.embeddings = embeddings or get_embedding_service(embed_model)
+        self._cache = LRUCache(
+            max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, sizeof=_estimate_bytes, on_evict=_close_entry,
+        )
+        # مدل‌ها فقط تنظیمات‌اند و کلاینت HTTP (pool اتصال) بین همه مشترک است؛ برای هر doc_id ساخته نمی‌شوند
+        self.llm = _answer_llm()
+        self.rewriter = _rewrite_llm(rewrite_model)
+        self.s_llm = build_chat_model(temperature=0.0)
+        self.memory_mode = memory_mode
+        self.drop_unused_memory = drop_unused_memory
+        self.tokenizer_name = tokenizer_name
+        self.sessions = SessionStore(self._new_memory, max_sessions=max_sessions, ttl=session_ttl)
+        # اگر داده شود همهٔ جستجوها روی ایندکس سراسری با فیلتر doc_id انجام می‌شود
+        self.shared_index = shared_index
+        # اگر نسخهٔ فشرده (mmap) کنار ایندکس باشد به جای load_local از آن استفاده می‌شود
+        self.prefer_compact = prefer_compact
+        # کش معنایی پاسخ (اختیاری)؛ پاسخ‌ها به تاریخچه وابسته‌اند، پس پیش‌فرض فقط نوبت اول
+        self.answer_cache = answer_cache
+        self.answer_cache_first_turn_only = answer_cache_first_turn_only
+        # مدل جدا (و معمولاً کوچک‌تر) برای بازنویسی سؤال؛ None = همان مدل پاسخ
+        self.rewrite_model = rewrite_model
+        self.rewrite_mode = rewrite_mode
+        self.stages = StageStats()
+        # hybrid: BM25 + بردار، rerank و k تطبیقی با بودجهٔ توکن ؛ vector: رفتار قبلی (k=10)
+        self.retrieval = retrieval
+        self.reranker = CrossEncoderReranker(rerank_model) if rerank_model else None
+        self.max_k = max_k
+        self.context_token_budget = context_token_budget
+        # سقف فراخوانی‌های هم‌زمان LLM (مشترک بین sync و async)
+        self.limiter = limiter
+
+    def _new_memory(self):
+        return _build_memory(self.s_llm, self.memory_mode, self.drop_unused_memory, self.tokenizer_name)
 
     def _paths(self, doc_id: str):
         base = self.docs_dir / doc_id
@@ -83,23 +326,274 @@ class RAGManager:
             "pdf": base / "source.pdf",
             "md": base / "skill.md",
             "index": base / "my_faiss_index",
+            "manifest": base / "manifest.json",
         }
 
-    def get(self, doc_id: str):
-        if doc_id in self._cache:
-            return self._cache[doc_id]
+    def _version(self, doc_id: str) -> tuple | None:
+        """
+        امضای manifest.json؛ pipeline آن را در پایان هر ingest (در هر پروسه‌ای) بعد از ایندکس از نو می‌نویسد.
+        None: ingest در جریان است (manifest پاک شده) یا workspace قدیمی بدون manifest.
+        """
+        try:
+            st = self._paths(doc_id)["manifest"].stat()
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _load(self, doc_id: str):
         paths = self._paths(doc_id)
+        if self.shared_index is not None:
+            # thread پس‌زمینهٔ SharedIndex تغییرات بقیهٔ پروسه‌ها را می‌خواند؛ doc ناشناخته (تازه ingest شده
+            # در worker دیگر) بدون انتظار برای آن
+            if doc_id not in self.shared_index:
+                self.shared_index.reload_if_changed()
+            if doc_id not in self.shared_index:
+                # workspaceهای قدیمی: یک بار به ایندکس سراسری منتقل می‌شوند
+                if not paths["index"].exists():
+                    raise FileNotFoundError("FAISS index not found for this doc_id.")
+                self.shared_index.upsert_from_faiss(doc_id, str(paths["index"]), self.embeddings)
+            if self.retrieval == "hybrid":
+                shared = self.shared_index
+                retriever = self._hybrid(
+                    paths["index"],
+                    lambda q, k: shared.search(doc_id, self.embeddings.embed_query(q), k),
+                    shared.documents(doc_id),
+                )
+            else:
+                retriever = SharedIndexRetriever(index=self.shared_index, doc_id=doc_id, embeddings=self.embeddings, k=10)
+            return self._chain(retriever), None
+
         if not paths["index"].exists():
             raise FileNotFoundError("FAISS index not found for this doc_id.")
-        chain, memory = _build_chain(str(paths["index"]), self.embed_model)
-        self._cache[doc_id] = (chain, memory)
-        return self._cache[doc_id]
-
-    def ask(self, doc_id: str, query: str) -> str:
-        chain, memory = self.get(doc_id)
-        mem_vars = memory.load_memory_variables({"input": query})
-        inputs = {"input": query, **mem_vars}
-        result = chain.invoke(inputs)
-        answer = result.get("answer") or result.get("output_text") or str(result)
-        memory.save_context({"input": query}, {"answer": answer})
-        return answer
+        if self.prefer_compact and has_compact(str(paths["index"])):
+            index = CompactIndex.open(str(paths["index"]))
+            if self.retrieval == "hybrid":
+                retriever = self._hybrid(
+                    paths["index"],
+                    lambda q, k: index.search(self.embeddings.embed_query(q), k),
+                    _LazyDocs(index),
+                )
+            else:
+                retriever = CompactIndexRetriever(index=index, embeddings=self.embeddings, k=10)
+            return self._chain(retriever), index
+        vs = FAISS.load_local(str(paths["index"]), embeddings=self.embeddings, allow_dangerous_deserialization=True)
+        if self.retrieval == "hybrid":
+            retriever = self._hybrid(paths["index"], vs.similarity_search_with_score, list(vs.docstore._dict.values()))
+        else:
+            retriever = vs.as_retriever(search_type="similarity", search_kwargs={"k": 10})
+        return self._chain(retriever), vs
+
+    def _hybrid(self, index_dir: Path, vector_search, docs) -> HybridRetriever:
+        """
+        docs: chunkهای همین doc_id (یا _LazyDocs برای ایندکس فشرده) برای پیدا کردن نتایج BM25 از روی hash.
+        ایندکس‌های قدیمی که bm25.json ندارند، BM25 را یک بار در حافظه از همین chunkها می‌سازند.
+        """
+        bm25 = BM25Index.load(str(index_dir))
+        if isinstance(docs, _LazyDocs):
+            if bm25 is None:
+                bm25 = BM25Index.build({_doc_hash(d): d.page_content.split() for d in docs.all()})
+            fetch = docs.fetch
+        else:
+            by_hash = {_doc_hash(d): d for d in docs}
+            if bm25 is None:
+                bm25 = BM25Index.build({h: d.page_content.split() for h, d in by_hash.items()})
+            fetch = by_hash.get
+        counter = get_token_counter(self.tokenizer_name)
+        return HybridRetriever(
+            vector_search=vector_search,
+            bm25=bm25,
+            fetch=fetch,
+            tokenize=tokenize,
+            count_tokens=counter.count,
+            reranker=self.reranker,
+            max_k=self.max_k,
+            token_budget=self.context_token_budget,
+        )
+
+    def _chain(self, retriever) -> RAGChain:
+        return _build_chain(retriever, llm=self.llm, rewriter=self.rewriter, rewrite_mode=self.rewrite_mode)
+
+    def get(self, doc_id: str):
+        chain, vs, _version = self._get(doc_id)
+        return chain, vs
+
+    def _get(self, doc_id: str):
+        """
+        (chain, vs, version)؛ اگر manifest از زمان بارگذاری عوض شده باشد (مثلاً PUT در worker دیگر)، ورودی کش و
+        پاسخ‌های کش‌شدهٔ این doc_id دور ریخته و ایندکس تازه بارگذاری می‌شود. وسط ingest نسخهٔ قبلی سرو می‌شود.
+        version همان نسخهٔ ایندکسی است که chain از آن ساخته شده و همراه پاسخ‌ها در کش پاسخ ذخیره می‌شود.
+        """
+        version = self._version(doc_id)
+
+        def load():
+            return (*self._load(doc_id), version)
+
+        chain, vs, loaded = self._cache.get_or_load(doc_id, load)
+        if version is not None and loaded != version:
+            self.invalidate(doc_id)
+            chain, vs, loaded = self._cache.get_or_load(doc_id, load)
+        return chain, vs, loaded
+
+    def invalidate(self, doc_id: str) -> bool:
+        """بعد از بازسازی ایندکس، نسخهٔ کش‌شده (و پاسخ‌های کش‌شده) را دور بریز."""
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(doc_id)
+        return self._cache.invalidate(doc_id)
+
+    def cache_stats(self, per_entry: bool = True) -> dict:
+        return self._cache.stats(per_entry=per_entry)
+
+    def session_stats(self) -> dict:
+        return self.sessions.stats()
+
+    def llm_models(self) -> list[str]:
+        """مدل‌هایی که باید در Ollama گرم نگه داشته شوند."""
+        return [m.model for m in (self.llm, self.rewriter, self.s_llm) if m is not None]
+
+    def stage_stats(self) -> dict:
+        return self.stages.stats()
+
+    def answer_cache_stats(self) -> dict | None:
+        return self.answer_cache.stats() if self.answer_cache is not None else None
+
+    def _session(self, doc_id: str, session_id: str | None):
+        """(memory, lock) گفتگو؛ بدون session_id یک حافظهٔ یک‌بارمصرف و بدون قفل."""
+        if session_id is None:
+            return self._new_memory(), nullcontext()
+        session = self.sessions.get(doc_id, session_id)
+        return session.memory, session.lock
+
+    def _cacheable(self, mem_vars: dict) -> bool:
+        if self.answer_cache is None:
+            return False
+        return not (self.answer_cache_first_turn_only and mem_vars.get("short_term_history"))
+
+    def _begin(self, doc_id: str, query: str, memory, timings: dict, t_start: float, version=None) -> dict:
+        """
+        بخش‌های بدون LLM قبل از chain: خواندن حافظه و جستجو در کش پاسخ.
+        timings زمان‌های قبلی همین نوبت (get) را دارد و t_start شروع کل نوبت است.
+        version نسخهٔ ایندکس chain این نوبت است؛ پاسخ کش‌شده از نسخهٔ دیگر miss حساب می‌شود.
+        """
+        turn = {
+            "doc_id": doc_id, "query": query, "memory": memory, "t_start": t_start, "timings": timings,
+            "version": version,
+        }
+        with span("memory", timings):
+            turn["mem_vars"] = memory.load_memory_variables({"input": query})
+        turn["cached"], turn["qvec"] = None, None
+        if self._cacheable(turn["mem_vars"]):
+            with span("answer_cache", timings):
+                turn["cached"], turn["qvec"] = self.answer_cache.lookup(doc_id, query, version)
+        return turn
+
+    def _end(self, turn: dict, answer: str, chain_timings: dict | None = None, chain_seconds: float = 0.0) -> None:
+        timings = turn["timings"]
+        if chain_timings is not None:
+            timings.update(chain_timings)
+            if turn["qvec"] is not None:
+                self.answer_cache.store(turn["doc_id"], turn["qvec"], answer, chain_seconds, turn["version"])
+        # در حالت sync خلاصه‌سازی تاریخچه هم داخل همین مرحله است
+        with span("memory_save", timings):
+            turn["memory"].save_context({"input": turn["query"]}, {"answer": answer})
+        timings["total"] = time.perf_counter() - turn["t_start"]
+        self.stages.record(timings, ("rewrite" in timings) if chain_timings is not None else None)
+        observe_stages("chat", timings)
+
+    def _slot(self):
+        return self.limiter.slot() if self.limiter is not None else nullcontext()
+
+    def _aslot(self):
+        return self.limiter.aslot() if self.limiter is not None else nullcontext()
+
+    def ask(self, doc_id: str, query: str, session_id: str | None = None) -> str:
+        """
+        اگر session_id داده نشود، سؤال بدون تاریخچه جواب داده می‌شود و چیزی ذخیره نمی‌شود.
+        اگر limiter پر باشد Overloaded بالا می‌رود (پاسخ‌های کش‌شده منتظر limiter نمی‌مانند).
+        """
+        t_start, timings = time.perf_counter(), {}
+        with span("get", timings):
+            chain, _vs, version = self._get(doc_id)
+        memory, lock = self._session(doc_id, session_id)
+        with lock:
+            turn = self._begin(doc_id, query, memory, timings, t_start, version)
+            if turn["cached"] is not None:
+                self._end(turn, turn["cached"])
+                return turn["cached"]
+            with self._slot():
+                t0 = time.perf_counter()
+                result = chain.invoke({"input": query, **turn["mem_vars"]})
+            answer = result.get("answer") or result.get("output_text") or str(result)
+            self._end(turn, answer, result.get("timings", {}), time.perf_counter() - t0)
+            return answer
+
+    def stream(self, doc_id: str, query: str, session_id: str | None = None) -> Iterator[str]:
+        """
+        مثل ask ولی تکه‌های پاسخ را به محض تولید توسط LLM yield می‌کند.
+        پاسخ کامل فقط وقتی stream تا آخر خوانده شود در حافظه ذخیره می‌شود.
+        """
+        t_start, timings = time.perf_counter(), {}
+        with span("get", timings):
+            chain, _vs, version = self._get(doc_id)
+        memory, lock = self._session(doc_id, session_id)
+        with lock:
+            turn = self._begin(doc_id, query, memory, timings, t_start, version)
+            if turn["cached"] is not None:
+                yield turn["cached"]
+                self._end(turn, turn["cached"])
+                return
+            chain_timings: dict = {}
+            parts = []
+            with self._slot():
+                t0 = time.perf_counter()
+                for chunk in chain.stream({"input": query, **turn["mem_vars"]}):
+                    piece = chunk.get("answer")
+                    if piece:
+                        parts.append(piece)
+                        yield piece
+                    chain_timings.update(chunk.get("timings", {}))
+            self._end(turn, "".join(parts), chain_timings, time.perf_counter() - t0)
+
+    # ---------- async (app.async_server) ----------
+    async def aask(self, doc_id: str, query: str, session_id: str | None = None) -> str:
+        """
+        نسخهٔ async ؛ فراخوانی‌های LLM روی event loop و کارهای CPU/دیسک
+        (بارگذاری ایندکس، embedding، حافظه) در thread جدا انجام می‌شوند.
+        """
+        t_start, timings = time.perf_counter(), {}
+        with span("get", timings):
+            chain, _vs, version = await asyncio.to_thread(self._get, doc_id)
+        memory, lock = self._session(doc_id, session_id)
+        async with lock:
+            turn = await asyncio.to_thread(self._begin, doc_id, query, memory, timings, t_start, version)
+            if turn["cached"] is not None:
+                await asyncio.to_thread(self._end, turn, turn["cached"])
+                return turn["cached"]
+            async with self._aslot():
+                t0 = time.perf_counter()
+                result = await chain.ainvoke({"input": query, **turn["mem_vars"]})
+            answer = result.get("answer") or result.get("output_text") or str(result)
+            await asyncio.to_thread(self._end, turn, answer, result.get("timings", {}), time.perf_counter() - t0)
+            return answer
+
+    async def astream(self, doc_id: str, query: str, session_id: str | None = None) -> AsyncIterator[str]:
+        t_start, timings = time.perf_counter(), {}
+        with span("get", timings):
+            chain, _vs, version = await asyncio.to_thread(self._get, doc_id)
+        memory, lock = self._session(doc_id, session_id)
+        async with lock:
+            turn = await asyncio.to_thread(self._begin, doc_id, query, memory, timings, t_start, version)
+            if turn["cached"] is not None:
+                yield turn["cached"]
+                await asyncio.to_thread(self._end, turn, turn["cached"])
+                return
+            chain_timings: dict = {}
+            parts = []
+            async with self._aslot():
+                t0 = time.perf_counter()
+                async for chunk in chain.astream({"input": query, **turn["mem_vars"]}):
+                    piece = chunk.get("answer")
+                    if piece:
+                        parts.append(piece)
+                        yield piece
+                    chain_timings.update(chunk.get("timings", {}))
+            await asyncio.to_thread(self._end, turn, "".join(parts), chain_timings, time.perf_counter() - t0)
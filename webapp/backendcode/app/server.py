@@ -1,21 +1,84 @@
+import logging
 import os
+import threading
+import time
 from pathlib import Path
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 from pydantic import BaseModel, ValidationError
-import tempfile
+import json
+import base64
+from datetime import datetime
+from sqlalchemy import and_, or_
 
 from app.pipeline import DocPipeline
 from app.rag import RAGManager
-from app.db import SessionLocal, init_db, Freelancer
+from app.embeddings import get_embedding_service
+from app.shared_index import SharedIndex
+from app.skill_search import SkillSearchIndex
+from app.textproc import preprocess
+from app.answer_cache import SemanticAnswerCache
+from app.limiter import ConcurrencyLimiter, Overloaded
+from app.llm import warmup_models
+from app.metrics import REGISTRY, CONTENT_TYPE, current_trace, end_trace, observe_request, observe_stages, span, start_trace
+from app.db import FreelancerCache, session_scope, init_db, Freelancer, IngestJob
+from app.jobs import IngestQueue, QueueFull
 
 load_dotenv()
+log = logging.getLogger(__name__)
 
 BASE_DIR = Path(os.getenv("BASE_DIR", "app/storage"))
 UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "app/storage/uploads"))
 DOCS_DIR = Path(os.getenv("DOCS_DIR", "app/storage/docs"))
 EMBED_MODEL = os.getenv("EMBED_MODEL", "Msobhi/Persian_Sentence_Embedding_v3")
+EMBED_DEVICE = os.getenv("EMBED_DEVICE") or None          # cpu / cuda / mps ؛ خالی = تشخیص خودکار
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0")) or None
+EMBED_WARMUP = os.getenv("EMBED_WARMUP", "0") == "1"
+RAG_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "64")) or None
+RAG_CACHE_MAX_MB = int(os.getenv("RAG_CACHE_MAX_MB", "0")) or None
+RAG_CACHE_TTL = float(os.getenv("RAG_CACHE_TTL", "1800")) or None   # ثانیه؛ 0 = بدون TTL
+CONVERT_WORKERS = int(os.getenv("CONVERT_WORKERS", "0")) or None   # processهای استخراج PDF؛ 0 = خودکار
+STORE_BACKEND = os.getenv("STORE_BACKEND", "per_doc")                 # per_doc / shared
+SHARED_INDEX_DIR = Path(os.getenv("SHARED_INDEX_DIR", "app/storage/shared_index"))
+SHARED_INDEX_KIND = os.getenv("SHARED_INDEX_KIND", "flat")             # flat / hnsw
+SHARED_INDEX_CHECK = float(os.getenv("SHARED_INDEX_CHECK", "2"))       # ثانیه بین بررسی تغییرات دیسک در thread پس‌زمینه
+INDEX_QUANTIZER = os.getenv("INDEX_QUANTIZER") or None                # sq8 / pq ؛ خالی = فقط فرمت FAISS
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "0") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.92"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400")) or None
+ANSWER_CACHE_MAX_DOCS = int(os.getenv("ANSWER_CACHE_MAX_DOCS", "1000")) or None
+ANSWER_CACHE_MAX_PER_DOC = int(os.getenv("ANSWER_CACHE_MAX_PER_DOC", "200"))
+ANSWER_CACHE_FIRST_TURN_ONLY = os.getenv("ANSWER_CACHE_FIRST_TURN_ONLY", "1") == "1"
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "100"))
+INGEST_HEARTBEAT = float(os.getenv("INGEST_HEARTBEAT", "15"))           # ثانیه بین heartbeatهای job در حال اجرا
+INGEST_STALE_AFTER = float(os.getenv("INGEST_STALE_AFTER", "90"))       # بدون heartbeat → job رهاشده
+INGEST_FAILED_RETENTION = float(os.getenv("INGEST_FAILED_RETENTION", str(7 * 86400)))  # نگه‌داری آپلود job ناموفق برای retry
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "10000")) or None
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", "3600")) or None
+CHAT_MEMORY_MODE = os.getenv("CHAT_MEMORY_MODE", "async")              # async / sync
+CHAT_MEMORY_DROP_UNUSED = os.getenv("CHAT_MEMORY_DROP_UNUSED", "0") == "1"
+CHAT_TOKENIZER = os.getenv("CHAT_TOKENIZER") or None                     # نام tokenizer محلی HF؛ خالی = تخمین
+REWRITE_MODEL = os.getenv("REWRITE_MODEL") or None                       # مدل بازنویسی سؤال؛ خالی = همان مدل پاسخ
+REWRITE_MODE = os.getenv("REWRITE_MODE", "auto")                         # auto / always / never
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")                   # hybrid / vector
+RERANK_MODEL = os.getenv("RERANK_MODEL") or None                         # cross-encoder محلی؛ خالی = reranker لغوی
+RETRIEVAL_MAX_K = int(os.getenv("RETRIEVAL_MAX_K", "6"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1800"))     # سقف توکن chunkها در prompt
+LLM_WARMUP = os.getenv("LLM_WARMUP", "1") == "1"                         # بارگذاری مدل‌ها در Ollama هنگام شروع
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "2"))                 # فراخوانی هم‌زمان مدل محلی
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))                    # بیشتر از این → 429
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))          # ثانیه انتظار در صف → 429
+FREELANCER_CACHE_SIZE = int(os.getenv("FREELANCER_CACHE_SIZE", "10000")) or None
+FREELANCER_CACHE_TTL = float(os.getenv("FREELANCER_CACHE_TTL", "300")) or None   # ثانیه بیکاری
+DEBUG_TIMINGS = os.getenv("DEBUG_TIMINGS", "0") == "1"                   # با 1: header «X-Debug-Timings: 1» → Server-Timing در پاسخ
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "100"))           # فریلنسرهای پیش‌فیلتر centroid برای rerank دقیق
+SEARCH_MAX_K = int(os.getenv("SEARCH_MAX_K", "50"))
+SEARCH_CACHE_MB = int(os.getenv("SEARCH_CACHE_MB", "256")) or None       # بردارهای chunk در حافظه برای rerank
+SEARCH_REFRESH = float(os.getenv("SEARCH_REFRESH", "30"))                # ثانیه؛ دیدن ingest پروسه‌های دیگر
+SEARCH_WARMUP = os.getenv("SEARCH_WARMUP", "1") == "1"                   # خواندن centroidها هنگام شروع
 
 BASE_DIR.mkdir(parents=True, exist_ok=True)
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
@@ -24,16 +87,129 @@ DOCS_DIR.mkdir(parents=True, exist_ok=True)
 init_db()
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["Server-Timing"])
 
-pipeline = DocPipeline(docs_dir=str(DOCS_DIR), embed_model=EMBED_MODEL)
-rag_manager = RAGManager(docs_dir=str(DOCS_DIR), embed_model=EMBED_MODEL)
+# یک مدل embedding برای کل پروسه؛ pipeline و RAG هر دو از همین استفاده می‌کنند
+embeddings = get_embedding_service(
+    EMBED_MODEL,
+    device=EMBED_DEVICE,
+    batch_size=EMBED_BATCH_SIZE,
+    num_threads=EMBED_THREADS,
+)
+if EMBED_WARMUP:
+    embeddings.warmup()
+
+shared_index = SharedIndex(str(SHARED_INDEX_DIR), kind=SHARED_INDEX_KIND, check_interval=SHARED_INDEX_CHECK) if STORE_BACKEND == "shared" else None
+
+pipeline = DocPipeline(
+    docs_dir=str(DOCS_DIR),
+    embed_model=EMBED_MODEL,
+    embeddings=embeddings,
+    convert_workers=CONVERT_WORKERS,
+    shared_index=shared_index,
+    compact_quantizer=INDEX_QUANTIZER,
+)
+# جستجوی پروژه بین همهٔ فریلنسرها (/search) روی بردارهای ذخیره‌شده کنار هر ایندکس
+skill_search = SkillSearchIndex(
+    str(DOCS_DIR),
+    embeddings,
+    candidates=SEARCH_CANDIDATES,
+    max_cache_bytes=SEARCH_CACHE_MB * 1024 * 1024 if SEARCH_CACHE_MB else None,
+    refresh_interval=SEARCH_REFRESH,
+)
+if SEARCH_WARMUP:
+    threading.Thread(target=lambda: skill_search.refresh(force=True), name="search-warmup", daemon=True).start()
+
+answer_cache = SemanticAnswerCache(
+    embeddings,
+    threshold=ANSWER_CACHE_THRESHOLD,
+    ttl=ANSWER_CACHE_TTL,
+    max_docs=ANSWER_CACHE_MAX_DOCS,
+    max_per_doc=ANSWER_CACHE_MAX_PER_DOC,
+) if ANSWER_CACHE else None
+
+llm_limiter = ConcurrencyLimiter(LLM_CONCURRENCY, max_queue=LLM_MAX_QUEUE, queue_timeout=LLM_QUEUE_TIMEOUT)
+
+rag_manager = RAGManager(
+    docs_dir=str(DOCS_DIR),
+    embed_model=EMBED_MODEL,
+    embeddings=embeddings,
+    max_entries=RAG_CACHE_MAX_ENTRIES,
+    max_bytes=RAG_CACHE_MAX_MB * 1024 * 1024 if RAG_CACHE_MAX_MB else None,
+    ttl=RAG_CACHE_TTL,
+    max_sessions=CHAT_MAX_SESSIONS,
+    session_ttl=CHAT_SESSION_TTL,
+    memory_mode=CHAT_MEMORY_MODE,
+    drop_unused_memory=CHAT_MEMORY_DROP_UNUSED,
+    tokenizer_name=CHAT_TOKENIZER,
+    shared_index=shared_index,
+    answer_cache=answer_cache,
+    answer_cache_first_turn_only=ANSWER_CACHE_FIRST_TURN_ONLY,
+    rewrite_model=REWRITE_MODEL,
+    rewrite_mode=REWRITE_MODE,
+    retrieval=RETRIEVAL_MODE,
+    rerank_model=RERANK_MODEL,
+    max_k=RETRIEVAL_MAX_K,
+    context_token_budget=CONTEXT_TOKEN_BUDGET,
+    limiter=llm_limiter,
+)
+
+def _warmup_llm() -> None:
+    result = warmup_models(rag_manager.llm_models())
+    failed = {m: v for m, v in result.items() if isinstance(v, str)}
+    if failed:
+        log.warning("llm warmup failed: %s", failed)
+    else:
+        log.info("llm warmup: %s", result)
+
+if LLM_WARMUP:
+    # در پس‌زمینه تا بالا آمدن سرور منتظر Ollama نماند
+    threading.Thread(
+        target=_warmup_llm,
+        name="llm-warmup",
+        daemon=True,
+    ).start()
+
+# /chat با freelancer_id در حالت معمول بدون رفتن به DB جواب داده می‌شود
+freelancer_cache = FreelancerCache(lambda f: to_dict(f), max_entries=FREELANCER_CACHE_SIZE, ttl=FREELANCER_CACHE_TTL)
+
+def _ingest_done(freelancer_id: str) -> None:
+    rag_manager.invalidate(freelancer_id)
+    freelancer_cache.invalidate(freelancer_id)
+    skill_search.upsert(freelancer_id)
+
+ingest_queue = IngestQueue(
+    pipeline,
+    workers=INGEST_WORKERS,
+    max_pending=INGEST_MAX_PENDING,
+    on_done=_ingest_done,
+    heartbeat=INGEST_HEARTBEAT,
+    stale_after=INGEST_STALE_AFTER,
+    failed_retention=INGEST_FAILED_RETENTION,
+)
+# فقط jobهای رهاشده؛ jobهای worker زندهٔ دیگر با claim اتمیک دوباره اجرا نمی‌شوند
+ingest_queue.recover()
+
+# آمار کش‌ها و صف مدل هنگام هر scrape در /metrics
+REGISTRY.register("roshd_rag_cache", lambda: rag_manager.cache_stats(per_entry=False))
+REGISTRY.register("roshd_sessions", rag_manager.session_stats)
+REGISTRY.register("roshd_answer_cache", rag_manager.answer_cache_stats)
+REGISTRY.register("roshd_llm", llm_limiter.stats)
+REGISTRY.register("roshd_freelancer_cache", freelancer_cache.stats)
+REGISTRY.register("roshd_shared_index", lambda: shared_index.stats() if shared_index else None)
+REGISTRY.register("roshd_skill_search", skill_search.stats)
 
 # ---------- Schemas ----------
 class ChatBody(BaseModel):
     query: str
     doc_id: str | None = None
     freelancer_id: str | None = None
+    session_id: str | None = None   # اگر خالی باشد یک گفتگوی جدید ساخته می‌شود
+
+class SearchBody(BaseModel):
+    description: str                # توضیح پروژه
+    k: int = 10
+    snippets: int = 2               # تعداد chunkهای مرتبط هر فریلنسر در پاسخ
 
 # ---------- Utils ----------
 def to_dict(f: Freelancer):
@@ -47,24 +223,214 @@ def to_dict(f: Freelancer):
         "created_at": f.created_at.isoformat()
     }
 
+def _iso(dt):
+    return dt.isoformat() if dt else None
+
+def job_to_dict(j: IngestJob):
+    return {
+        "id": j.id,
+        "freelancer_id": j.freelancer_id,
+        "status": j.status,
+        "stage": j.stage,
+        "error": j.error,
+        "timings": json.loads(j.timings) if j.timings else {},
+        "created_at": _iso(j.created_at),
+        "started_at": _iso(j.started_at),
+        "finished_at": _iso(j.finished_at),
+    }
+
+# ---------- Pagination ----------
+PAGE_DEFAULT_LIMIT = 50
+PAGE_MAX_LIMIT = 200
+
+def encode_cursor(f: Freelancer) -> str:
+    raw = f"{f.created_at.isoformat()}|{f.id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    """ValueError برای cursor نامعتبر"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, freelancer_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), freelancer_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+
+def page_params(args) -> tuple[int, str | None]:
+    """limit و cursor از query string؛ ValueError برای مقادیر نامعتبر"""
+    try:
+        limit = int(args.get("limit", PAGE_DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    cursor = args.get("cursor") or None
+    if cursor:
+        decode_cursor(cursor)
+    return min(limit, PAGE_MAX_LIMIT), cursor
+
+def _page(db, limit: int, cursor: str | None) -> tuple[list[Freelancer], str | None]:
+    """صفحه‌بندی keyset روی (created_at, id) نزولی با ایندکس ix_freelancers_created_at_id"""
+    q = db.query(Freelancer)
+    if cursor:
+        created_at, freelancer_id = decode_cursor(cursor)
+        q = q.filter(or_(
+            Freelancer.created_at < created_at,
+            and_(Freelancer.created_at == created_at, Freelancer.id < freelancer_id),
+        ))
+    rows = q.order_by(Freelancer.created_at.desc(), Freelancer.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def doc_to_dict(f: Freelancer):
+    return {
+        "doc_id": f.id,
+        "pdf": bool(f.has_pdf),
+        "md": bool(f.has_md),
+        "index": bool(f.has_index),
+        "chunks": f.chunks,
+        "index_bytes": f.index_bytes,
+    }
+
+# ---------- Sync DB/storage helpers (shared with app.async_server) ----------
+def doc_items(limit: int = PAGE_DEFAULT_LIMIT, cursor: str | None = None) -> tuple[list[dict], str | None]:
+    """وضعیت workspaceها از جدول freelancers (که pipeline بعد از هر ingest به‌روز می‌کند)"""
+    with session_scope() as db:
+        rows, next_cursor = _page(db, limit, cursor)
+        return [doc_to_dict(r) for r in rows], next_cursor
+
+def freelancer_dict(freelancer_id: str) -> dict | None:
+    return freelancer_cache.get(freelancer_id)
+
+def upload_path(freelancer_id: str, job_id: str) -> Path:
+    """فایل آپلود هر job جداست تا آپلودهای هم‌زمان یک فریلنسر هم را بازنویسی نکنند"""
+    return UPLOAD_DIR / f"{freelancer_id}.{job_id}.pdf"
+
+def freelancer_items(limit: int = PAGE_DEFAULT_LIMIT, cursor: str | None = None) -> tuple[list[dict], str | None]:
+    with session_scope() as db:
+        rows, next_cursor = _page(db, limit, cursor)
+        return [to_dict(r) for r in rows], next_cursor
+
+def backfill_workspace_status() -> int:
+    """ردیف‌های قبل از ستون‌های وضعیت workspace: یک بار از روی دیسک پر می‌شوند."""
+    with session_scope() as db:
+        rows = db.query(Freelancer).filter(Freelancer.has_index.is_(None)).all()
+        for fr in rows:
+            for key, value in pipeline.workspace_status(fr.id).items():
+                setattr(fr, key, value)
+        return len(rows)
+
+backfill_workspace_status()
+
+def job_payload(job_id: str) -> dict | None:
+    with session_scope() as db:
+        job = db.query(IngestJob).filter(IngestJob.id == job_id).first()
+        if not job:
+            return None
+        out = job_to_dict(job)
+        if job.status == "done":
+            fr = db.query(Freelancer).filter(Freelancer.id == job.freelancer_id).first()
+            if fr:
+                out["freelancer"] = to_dict(fr)
+        return out
+
+def search_error(body: SearchBody) -> str | None:
+    if not body.description.strip():
+        return "description is required"
+    if not 1 <= body.k <= SEARCH_MAX_K:
+        return f"k must be between 1 and {SEARCH_MAX_K}"
+    if not 0 <= body.snippets <= 5:
+        return "snippets must be between 0 and 5"
+    return None
+
+def search_freelancers(body: SearchBody) -> list[dict]:
+    """یک embed برای توضیح پروژه، جستجو بین همهٔ فریلنسرها و نام آن‌ها از freelancer_cache (بدون LLM)"""
+    timings = {}
+    with span("embed", timings):
+        # chunkها با preprocess ایندکس شده‌اند؛ توضیح پروژه هم همان‌طور نرمال می‌شود
+        vector = embeddings.embed_query(preprocess(body.description) or body.description)
+    with span("search", timings):
+        results = skill_search.search(vector, k=body.k, snippets=body.snippets)
+    with span("db", timings):
+        for r in results:
+            fr = freelancer_dict(r["freelancer_id"])
+            r["name"] = fr["name"] if fr else None
+    observe_stages("search", timings)
+    return results
+
+def resolve_doc_id(body: ChatBody) -> tuple[str | None, tuple[str, int] | None]:
+    """freelancer_id را (از freelancer_cache) به doc_id تبدیل می‌کند: (doc_id, (error, status))"""
+    doc_id = body.doc_id
+    if not doc_id and body.freelancer_id:
+        fr = freelancer_dict(body.freelancer_id)
+        if not fr:
+            return None, ("freelancer not found", 404)
+        doc_id = fr["id"]
+    if not doc_id:
+        return None, ("doc_id or freelancer_id is required", 400)
+    return doc_id, None
+
+# ---------- Request tracing ----------
+def wants_timings(headers) -> bool:
+    return DEBUG_TIMINGS and headers.get("X-Debug-Timings") == "1"
+
+@app.before_request
+def _start_trace():
+    g.trace_token = start_trace()
+
+@app.after_request
+def _finish_trace(resp):
+    trace = current_trace()
+    if trace is None:
+        return resp
+    # برای stream زمان تا اولین تکه است
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    observe_request(request.method, route, resp.status_code, time.perf_counter() - trace.t_start)
+    if wants_timings(request.headers):
+        resp.headers["Server-Timing"] = trace.server_timing()
+    return resp
+
+@app.teardown_request
+def _end_trace(_exc):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        end_trace(token)
+
 # ---------- Health ----------
 @app.get("/health")
 def health():
     return jsonify(status="ok")
 
+# ---------- Prometheus ----------
+@app.get("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+# ---------- Cache stats ----------
+@app.get("/stats/cache")
+def cache_stats():
+    per_entry = request.args.get("items", "1") != "0"
+    return jsonify(
+        rag=rag_manager.cache_stats(per_entry=per_entry),
+        sessions=rag_manager.session_stats(),
+        answers=rag_manager.answer_cache_stats(),
+        chat=rag_manager.stage_stats(),
+        llm=llm_limiter.stats(),
+        freelancers=freelancer_cache.stats(),
+        shared_index=shared_index.stats() if shared_index else None,
+        search=skill_search.stats(),
+    )
+
 # ---------- Legacy list of workspaces ----------
 @app.get("/docs")
 def list_docs():
-    items = []
-    for d in DOCS_DIR.iterdir():
-        if d.is_dir():
-            items.append({
-                "doc_id": d.name,
-                "pdf": (d / "source.pdf").exists(),
-                "md": (d / "skill.md").exists(),
-                "index": (d / "my_faiss_index").exists(),
-            })
-    return jsonify(items=items)
+    """?limit=50&cursor=... ؛ next_cursor برای صفحهٔ بعد (null = صفحهٔ آخر)"""
+    try:
+        limit, cursor = page_params(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    items, next_cursor = doc_items(limit, cursor)
+    return jsonify(items=items, next_cursor=next_cursor)
 
 # ---------- New: create freelancer (upload + metadata + DB) ----------
 @app.post("/freelancers")
@@ -74,7 +440,7 @@ def create_freelancer():
       - name (string, required)
       - description (string, optional)
       - file (pdf, required)
-    خروجی: مشخصات فریلنسر + مسیرها
+    خروجی: 202 + job_id ؛ وضعیت و مشخصات فریلنسر از GET /jobs/<job_id>
     """
     name = request.form.get("name", "").strip()
     description = request.form.get("description", "").strip()
@@ -85,83 +451,212 @@ def create_freelancer():
     if not f or not f.filename.lower().endswith(".pdf"):
         return jsonify(error="file (.pdf) is required"), 400
 
-    # پردازش PDF → MD → Index با یک GUID (همان id فریلنسر)
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-        f.save(tmp.name)
-        # doc_id همان id فریلنسر می‌شود
-        from uuid import uuid4
-        freelancer_id = str(uuid4())
-        result = pipeline.run_all(tmp.name, doc_id=freelancer_id)
+    # doc_id همان id فریلنسر می‌شود؛ فایل خام (یکتا برای هر job) در uploads می‌ماند تا job آن را پردازش کند
+    from uuid import uuid4
+    freelancer_id = str(uuid4())
+    job_id = ingest_queue.new_job_id()
+    src_path = upload_path(freelancer_id, job_id)
+    f.save(str(src_path))
+
+    # پردازش PDF → MD → Index در پس‌زمینه
+    try:
+        ingest_queue.submit(freelancer_id, name, description, str(src_path), job_id=job_id)
+    except QueueFull:
+        src_path.unlink(missing_ok=True)
+        return jsonify(error="ingestion queue is full, try again later"), 503, {"Retry-After": "30"}
+
+    return jsonify(
+        message="queued",
+        job_id=job_id,
+        freelancer_id=freelancer_id,
+        status_url=f"/jobs/{job_id}",
+    ), 202, {"Location": f"/jobs/{job_id}"}
+
+# ---------- Re-upload a freelancer's PDF (incremental re-index) ----------
+@app.put("/freelancers/<freelancer_id>/file")
+def replace_freelancer_file(freelancer_id: str):
+    """
+    multipart/form-data:
+      - file (pdf, required)
+    فقط chunkهای تغییرکرده دوباره embed می‌شوند؛ PDF یکسان تقریباً هزینه‌ای ندارد.
+    """
+    f = request.files.get("file")
+    if not f or not f.filename.lower().endswith(".pdf"):
+        return jsonify(error="file (.pdf) is required"), 400
+
+    fr = freelancer_dict(freelancer_id)
+    if not fr:
+        return jsonify(error="freelancer not found"), 404
+    name, description = fr["name"], fr["description"]
 
-    # ذخیره فایل خام در uploads (اختیاری)
+    # PUTهای هم‌زمان فایل هم را بازنویسی نمی‌کنند؛ jobها در _run برای هر فریلنسر یکی‌یکی اجرا می‌شوند
+    job_id = ingest_queue.new_job_id()
+    src_path = upload_path(freelancer_id, job_id)
+    f.save(str(src_path))
     try:
-        dst = UPLOAD_DIR / f"{freelancer_id}.pdf"
-        Path(tmp.name).replace(dst)
-    except Exception:
-        pass
+        ingest_queue.submit(freelancer_id, name, description, str(src_path), job_id=job_id)
+    except QueueFull:
+        src_path.unlink(missing_ok=True)
+        return jsonify(error="ingestion queue is full, try again later"), 503, {"Retry-After": "30"}
+
+    return jsonify(
+        message="queued",
+        job_id=job_id,
+        freelancer_id=freelancer_id,
+        status_url=f"/jobs/{job_id}",
+    ), 202, {"Location": f"/jobs/{job_id}"}
 
-    # ذخیره در DB
-    db = SessionLocal()
+# ---------- Ingestion job status ----------
+@app.get("/jobs/<job_id>")
+def get_job(job_id: str):
+    out = job_payload(job_id)
+    if out is None:
+        return jsonify(error="job not found"), 404
+    return jsonify(job=out)
+
+@app.post("/jobs/<job_id>/retry")
+def retry_job(job_id: str):
+    """job ناموفق را با همان فایل آپلود دوباره در صف می‌گذارد؛ 409 اگر failed نباشد یا فایل پاک شده باشد"""
     try:
-        fr = Freelancer(
-            id=freelancer_id,
-            name=name,
-            description=description,
-            pdf_path=result["pdf_path"],
-            md_path=result["md_path"],
-            index_dir=result["index_dir"],
-        )
-        db.add(fr)
-        db.commit()
-        db.refresh(fr)
-        return jsonify(message="ok", freelancer=to_dict(fr)), 201
-    finally:
-        db.close()
+        ok = ingest_queue.retry(job_id)
+    except QueueFull:
+        return jsonify(error="ingestion queue is full, try again later"), 503, {"Retry-After": "30"}
+    if ok is None:
+        return jsonify(error="job not found"), 404
+    if not ok:
+        return jsonify(error="job is not failed or its upload is no longer available"), 409
+    return jsonify(message="queued", job_id=job_id, status_url=f"/jobs/{job_id}"), 202, {"Location": f"/jobs/{job_id}"}
 
 # ---------- New: list freelancers ----------
 @app.get("/freelancers")
 def list_freelancers():
-    db = SessionLocal()
+    """?limit=50&cursor=... ؛ جدیدترین‌ها اول، next_cursor برای صفحهٔ بعد (null = صفحهٔ آخر)"""
     try:
-        rows = db.query(Freelancer).order_by(Freelancer.created_at.desc()).all()
-        return jsonify(items=[to_dict(r) for r in rows])
-    finally:
-        db.close()
+        limit, cursor = page_params(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    items, next_cursor = freelancer_items(limit, cursor)
+    return jsonify(items=items, next_cursor=next_cursor)
+
+# ---------- Search: match a project to freelancers ----------
+@app.post("/search")
+def search():
+    """
+    بدنه: { "description": "توضیح پروژه", "k": 10, "snippets": 2 }
+    خروجی: فریلنسرها به ترتیب شباهت با freelancer_id، name، score و snippets (chunkهای مرتبط)؛ بدون فراخوانی LLM.
+    """
+    try:
+        body = SearchBody(**(request.get_json() or {}))
+    except ValidationError as e:
+        return jsonify(error=e.errors()), 400
+    err = search_error(body)
+    if err:
+        return jsonify(error=err), 400
+    try:
+        return jsonify(results=search_freelancers(body))
+    except Exception as e:
+        return jsonify(error=str(e)), 500
 
 # ---------- Chat: accept doc_id OR freelancer_id ----------
+def _parse_chat():
+    """بدنهٔ چت را اعتبارسنجی و freelancer_id را به doc_id تبدیل می‌کند: (body, doc_id, error_response)"""
+    try:
+        body = ChatBody(**(request.get_json() or {}))
+    except ValidationError as e:
+        return None, None, (jsonify(error=e.errors()), 400)
+
+    # map freelancer_id -> doc_id
+    timings = {}
+    with span("db", timings):
+        doc_id, err = resolve_doc_id(body)
+    observe_stages("chat", timings)
+    if err:
+        return body, None, (jsonify(error=err[0]), err[1])
+    return body, doc_id, None
+
+def _overloaded(e: Overloaded):
+    return jsonify(error=e.reason, retry_after=e.retry_after), 429, {"Retry-After": str(e.retry_after)}
+
 @app.post("/chat")
 def chat():
     """
     بدنه:
       { "query": "...", "freelancer_id": "..." }  یا  { "query": "...", "doc_id": "..." }
+      session_id اختیاری است؛ در پاسخ برگردانده می‌شود تا نوبت‌های بعدی همان گفتگو را ادامه دهند.
     """
+    body, doc_id, err = _parse_chat()
+    if err:
+        return err
+
+    from uuid import uuid4
+    session_id = body.session_id or str(uuid4())
+
     try:
-        body = ChatBody(**(request.get_json() or {}))
-    except ValidationError as e:
-        return jsonify(error=e.errors()), 400
+        answer = rag_manager.ask(doc_id, body.query, session_id=session_id)
+        return jsonify(answer=answer, session_id=session_id)
+    except Overloaded as e:
+        return _overloaded(e)
+    except FileNotFoundError:
+        return jsonify(error="index not found for this id. create freelancer first."), 404
+    except Exception as e:
+        return jsonify(error=str(e)), 500
 
-    # map freelancer_id -> doc_id
-    doc_id = body.doc_id
-    if not doc_id and body.freelancer_id:
-        db = SessionLocal()
-        try:
-            fr = db.query(Freelancer).filter(Freelancer.id == body.freelancer_id).first()
-            if not fr:
-                return jsonify(error="freelancer not found"), 404
-            doc_id = fr.id
-        finally:
-            db.close()
+def _sse(data: dict, event: str | None = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    if not doc_id:
-        return jsonify(error="doc_id or freelancer_id is required"), 400
+@app.post("/chat/stream")
+def chat_stream():
+    """
+    همان بدنهٔ /chat ؛ پاسخ به صورت Server-Sent Events:
+      data: {"token": "..."}                       برای هر تکه از پاسخ
+      event: done   data: {"answer", "session_id"} در پایان
+      event: error  data: {"error"}                اگر وسط تولید خطا رخ دهد
+    اگر صف مدل پر باشد، قبل از شروع stream پاسخ 429 با Retry-After برمی‌گردد.
+    """
+    body, doc_id, err = _parse_chat()
+    if err:
+        return err
+
+    from uuid import uuid4
+    session_id = body.session_id or str(uuid4())
 
+    # تا اولین تکه جلو برو تا 404 و 429 قبل از شروع stream به شکل JSON برگردند
+    pieces = rag_manager.stream(doc_id, body.query, session_id=session_id)
     try:
-        answer = rag_manager.ask(doc_id, body.query)
-        return jsonify(answer=answer)
+        first = next(pieces, None)
+    except Overloaded as e:
+        return _overloaded(e)
     except FileNotFoundError:
         return jsonify(error="index not found for this id. create freelancer first."), 404
     except Exception as e:
         return jsonify(error=str(e)), 500
 
+    def generate():
+        parts = []
+        try:
+            if first is not None:
+                parts.append(first)
+                yield _sse({"token": first})
+            for piece in pieces:
+                parts.append(piece)
+                yield _sse({"token": piece})
+            yield _sse({"answer": "".join(parts), "session_id": session_id}, event="done")
+        except Exception as e:
+            yield _sse({"error": str(e)}, event="error")
+        finally:
+            # کلاینت وسط stream قطع شد: قفل گفتگو و slot مدل آزاد شوند
+            pieces.close()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # pieces از next بالا قفل گفتگو و slot مدل را گرفته است؛ اگر کلاینت پیش از شروع stream قطع شود generate
+    # هرگز اجرا نمی‌شود، ولی سرور WSGI close پاسخ را همیشه صدا می‌زند (close دوباره بی‌اثر است)
+    response.call_on_close(pieces.close)
+    return response
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from typing import Any, Callable
+from .cache import LRUCache
+
+
+class SessionLock:
+    """
+    قفل یک گفتگو که هم با with (Flask، threadها) و هم با async with (aiohttp) کار می‌کند.
+    در مسیر async هیچ thread ای برای انتظار اشغال نمی‌شود: coroutineها پشت یک asyncio.Lock صف می‌کشند
+    و فقط اولی قفل thread را غیرمسدود (با backoff کوتاه) می‌گیرد؛ لغو شدن در هر نقطه قفلی باقی نمی‌گذارد.
+    """
+    __slots__ = ("_lock", "_queue")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = asyncio.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+    async def __aenter__(self):
+        await self._queue.acquire()
+        try:
+            delay = 0.001
+            while not self._lock.acquire(blocking=False):
+                await asyncio.sleep(delay)      # فقط وقتی یک درخواست sync همین گفتگو را گرفته باشد
+                delay = min(delay * 2, 0.05)
+        except BaseException:
+            self._queue.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self._lock.release()
+        self._queue.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+
+class _Session:
+    __slots__ = ("memory", "lock")
+
+    def __init__(self, memory: Any):
+        self.memory = memory
+        # دو درخواست هم‌زمان در یک گفتگو نباید تاریخچه را درهم کنند
+        self.lock = SessionLock()
+
+
+class SessionStore:
+    """
+    حافظهٔ گفتگو به ازای هر (doc_id, session_id).
+    تعداد sessionها محدود است (LRU) و sessionهای بیکار بعد از ttl ثانیه حذف می‌شوند؛
+    سقف طول هر تاریخچه را خود memory (پنجره/توکن) تعیین می‌کند.
+    """
+    def __init__(
+        self,
+        memory_factory: Callable[[], Any],
+        max_sessions: int | None = 10000,
+        ttl: float | None = 3600,
+    ):
+        self.memory_factory = memory_factory
+        self._sessions = LRUCache(max_entries=max_sessions, ttl=ttl)
+
+    def get(self, doc_id: str, session_id: str) -> _Session:
+        return self._sessions.get_or_load(
+            (doc_id, session_id), lambda: _Session(self.memory_factory())
+        )
+
+    def drop(self, doc_id: str, session_id: str) -> bool:
+        return self._sessions.invalidate((doc_id, session_id))
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> dict:
+        return self._sessions.stats(per_entry=False)
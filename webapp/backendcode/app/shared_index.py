@@ -0,0 +1,370 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain.vectorstores import FAISS
+from .locks import file_lock
+
+log = logging.getLogger(__name__)
+
+# هر doc_id یک بلوک id اختصاصی دارد: [block * BLOCK, block * BLOCK + count)
+BLOCK = 1 << 20
+INDEX_KINDS = ("flat", "hnsw")
+
+
+class SharedIndex:
+    """
+    یک ایندکس FAISS سراسری برای همهٔ فریلنسرها.
+    جستجو با IDSelectorRange روی بلوک همان doc_id فیلتر می‌شود، پس هر پروسه فقط
+    یک ایندکس گرم دارد و هیچ load_local جداگانه‌ای برای هر فریلنسر لازم نیست.
+
+    با هر upsert یک بلوک تازه گرفته می‌شود؛ بلوک قبلی در flat حذف می‌شود و در hnsw
+    (که remove_ids ندارد) فقط از نگاشت بیرون می‌رود تا در compact() پاک شود.
+
+    چند پروسه یک پوشه را به اشتراک می‌گذارند: هر تغییر داخل transaction() انجام می‌شود که
+    قفل فایلی می‌گیرد، اگر پروسهٔ دیگری نوشته باشد اول نسخهٔ دیسک را می‌خواند و در پایان ذخیره می‌کند؛
+    پس هیچ پروسه‌ای docs.json و next_block دیگری را با نسخهٔ کهنه بازنویسی نمی‌کند.
+    هر save فایل‌های index-<v>.faiss و docstore-<v>.jsonl تازه می‌نویسد و docs.json (manifest که نام
+    آن‌ها را دارد) آخر از همه با os.replace جایگزین می‌شود؛ خواننده هرگز ایندکس یک نسخه را با نگاشت نسخهٔ
+    دیگر جفت نمی‌کند. نسخه‌های قبلی بعد از grace ثانیه پاک می‌شوند (نسخهٔ قبلی همیشه می‌ماند).
+    یک thread پس‌زمینه هر check_interval ثانیه docs.json را stat می‌کند و نسخهٔ تازه را بیرون از قفل
+    می‌خواند و یک‌جا جایگزین می‌کند؛ search/documents فقط وضعیت فعلی حافظه را می‌خوانند.
+    """
+    def __init__(
+        self,
+        root_dir: str,
+        kind: str = "flat",
+        hnsw_m: int = 32,
+        ef_search: int = 64,
+        check_interval: float = 2.0,
+        grace: float = 600.0,
+    ):
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"kind must be one of {INDEX_KINDS}")
+        self.root = Path(root_dir)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.kind = kind
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.check_interval = check_interval
+        self.grace = grace
+        self._lock = threading.RLock()
+        self._local = threading.local()            # in_tx: این thread قفل فایلی را دارد
+        self.index = None
+        self.docs: dict[str, dict] = {}            # doc_id → {"block", "count"}
+        self.texts: dict[int, tuple[str, dict]] = {}  # faiss id → (text, metadata)
+        self.next_block = 1
+        self.orphans = 0                           # بردارهای بلوک‌های رهاشده (فقط hnsw)
+        self.version = 0                           # با هر save یکی زیاد می‌شود
+        self._files = None                         # (index, docstore) نسخهٔ حافظه روی دیسک
+        self._stamp = None                         # (mtime_ns, size, inode) docs.json که در حافظه است
+        self.reloads = 0
+        self.load()
+        self._stop = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, name="shared-index-reload", daemon=True)
+        self._watcher.start()
+
+    # ---------- persistence ----------
+    @property
+    def _manifest(self) -> Path:
+        return self.root / "docs.json"
+
+    @staticmethod
+    def _files_of(meta: dict) -> tuple[str, str]:
+        """نام فایل‌های ایندکس و docstore یک manifest؛ manifestهای قدیمی نام ثابت داشتند."""
+        return meta.get("index", "index.faiss"), meta.get("docstore", "docstore.jsonl")
+
+    def _new_index(self, dim: int):
+        if self.kind == "hnsw":
+            base = faiss.IndexHNSWFlat(dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        else:
+            base = faiss.IndexFlatIP(dim)
+        return faiss.IndexIDMap2(base)
+
+    def _disk_stamp(self):
+        try:
+            st = self._manifest.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _read_meta(self) -> dict | None:
+        try:
+            return json.loads(self._manifest.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+
+    def load(self) -> bool:
+        """
+        فایل‌هایی را که docs.json نام برده بیرون از قفل می‌خواند و وضعیت را یک‌جا جایگزین می‌کند.
+        نسخهٔ قدیمی‌تر از حافظه (مثلاً load کندی که بعد از transaction تمام شده) جایگزین نمی‌شود.
+        """
+        for _ in range(3):
+            stamp = self._disk_stamp()     # قبل از خواندن: اگر بعدش عوض شود، بررسی بعدی دوباره می‌خواند
+            try:
+                meta = self._read_meta()
+                if meta is None:
+                    return False
+                files = self._files_of(meta)
+                index_p, store_p = self.root / files[0], self.root / files[1]
+                index = faiss.read_index(str(index_p)) if index_p.exists() else None
+                texts = {}
+                with store_p.open(encoding="utf-8") as f:
+                    for line in f:
+                        fid, text, metadata = json.loads(line)
+                        texts[fid] = (text, metadata)
+                break
+            except (OSError, ValueError, RuntimeError):
+                continue      # manifest عوض شد و فایل‌های نسخهٔ خوانده‌شده پاک شدند؛ دوباره
+        else:
+            return False
+        version = meta.get("version", 0)
+        with self._lock:
+            if self._stamp is not None and version <= self.version:
+                if version == self.version:
+                    self._stamp = stamp      # همان نسخهٔ حافظه؛ دوباره خوانده نشود
+                return False
+            self.docs = meta["docs"]
+            self.next_block = meta["next_block"]
+            self.orphans = meta.get("orphans", 0)
+            self.version = version
+            self.index = index
+            self.texts = texts
+            self._files = files
+            self._stamp = stamp
+            self.reloads += 1
+        return True
+
+    def reload_if_changed(self) -> bool:
+        """اگر پروسهٔ دیگری ایندکس را به‌روز کرده باشد نسخهٔ دیسک را بخوان (یک stat اگر عوض نشده باشد)."""
+        stamp = self._disk_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        return self.load()
+
+    def _watch(self) -> None:
+        while not self._stop.wait(max(self.check_interval, 0.05)):
+            try:
+                self.reload_if_changed()
+            except Exception:
+                log.exception("shared index reload failed")
+
+    def close(self) -> None:
+        """توقف thread بررسی تغییرات دیسک"""
+        self._stop.set()
+
+    @contextmanager
+    def transaction(self):
+        """
+        تغییرات یک پروسه/thread در هر لحظه: قفل فایلی + خواندن نسخهٔ تازهٔ دیسک + save در پایان.
+        upsert/remove/compact با save=True خودشان از آن استفاده می‌کنند؛ برای چند تغییر با یک save
+        آن‌ها را با save=False داخل یک transaction صدا بزنید.
+        """
+        if getattr(self._local, "in_tx", False):
+            yield
+            return
+        with file_lock(self.root / ".write.lock"):
+            self._local.in_tx = True
+            try:
+                self.reload_if_changed()
+                yield
+                self.save()
+            finally:
+                self._local.in_tx = False
+
+    def save(self) -> None:
+        """
+        وضعیت زیر RLock فقط کپی می‌شود (serialize_index)؛ نوشتن روی دیسک بیرون از آن است
+        تا searchها پشت I/O نمانند. بیرون از transaction خودش قفل فایلی را می‌گیرد.
+        فایل‌های نسخهٔ تازه کنار نسخهٔ فعلی نوشته می‌شوند و docs.json آخر از همه جایگزین می‌شود.
+        """
+        if not getattr(self._local, "in_tx", False):
+            with file_lock(self.root / ".write.lock"):
+                self._local.in_tx = True
+                try:
+                    return self.save()
+                finally:
+                    self._local.in_tx = False
+
+        on_disk = self._read_meta() or {}
+        with self._lock:
+            index_bytes = faiss.serialize_index(self.index) if self.index is not None else None
+            texts = list(self.texts.items())
+            previous = self._files
+            # زیر قفل فایلی نسخهٔ دیسک آخرین نسخه است؛ نام فایل‌ها هرگز با نسخهٔ قبلی یکی نمی‌شود
+            version = max(self.version, on_disk.get("version", 0)) + 1
+            meta = {
+                "docs": dict(self.docs), "next_block": self.next_block, "orphans": self.orphans,
+                "kind": self.kind, "version": version,
+                "index": f"index-{version}.faiss", "docstore": f"docstore-{version}.jsonl",
+            }
+        index_p, store_p = self.root / meta["index"], self.root / meta["docstore"]
+        if index_bytes is not None:
+            with open(str(index_p) + ".tmp", "wb") as f:
+                f.write(index_bytes.tobytes())
+            os.replace(str(index_p) + ".tmp", index_p)
+        with open(str(store_p) + ".tmp", "w", encoding="utf-8") as f:
+            for fid, (text, metadata) in texts:
+                f.write(json.dumps([fid, text, metadata], ensure_ascii=False) + "\n")
+        os.replace(str(store_p) + ".tmp", store_p)
+        # docs.json آخر نوشته می‌شود؛ از این لحظه بقیهٔ پروسه‌ها نسخهٔ تازه را می‌بینند
+        tmp = self._manifest.with_suffix(".tmp")
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, self._manifest)
+        files = self._files_of(meta)
+        with self._lock:
+            self.version = version
+            self._files = files
+            self._stamp = self._disk_stamp()
+        self._remove_stale(keep={*files, *(previous or ()), *self._files_of(on_disk)})
+
+    def _remove_stale(self, keep: set[str]) -> None:
+        """
+        فایل‌های نسخه‌های قدیمی (و tmpهای نیمه‌کارهٔ نویسندهٔ کرش‌کرده) که بیش از grace ثانیه از نوشتنشان گذشته.
+        نسخهٔ فعلی و قبلی همیشه می‌مانند تا خواننده‌ای که manifest قبلی را خوانده فایل‌هایش را پیدا کند.
+        """
+        cutoff = time.time() - self.grace
+        for pattern in ("index*.faiss", "docstore*.jsonl", "*.tmp"):
+            for p in self.root.glob(pattern):
+                if p.name in keep:
+                    continue
+                try:
+                    if p.stat().st_mtime < cutoff:
+                        p.unlink()
+                except FileNotFoundError:
+                    pass
+
+    # ---------- write ----------
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.docs
+
+    def _drop_block(self, doc_id: str) -> None:
+        info = self.docs.pop(doc_id, None)
+        if info is None:
+            return
+        lo = info["block"] * BLOCK
+        for fid in range(lo, lo + info["count"]):
+            self.texts.pop(fid, None)
+        if self.kind == "flat":
+            self.index.remove_ids(faiss.IDSelectorRange(lo, lo + info["count"]))
+        else:
+            self.orphans += info["count"]
+
+    def upsert(self, doc_id: str, texts: list[str], metadatas: list[dict], vectors: np.ndarray, save: bool = True) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        if len(texts) > BLOCK:
+            raise ValueError(f"a document may hold at most {BLOCK} chunks")
+        if save:
+            with self.transaction():
+                return self.upsert(doc_id, texts, metadatas, vectors, save=False)
+        with self._lock:
+            if self.index is None:
+                self.index = self._new_index(vectors.shape[1])
+            self._drop_block(doc_id)
+            block = self.next_block
+            self.next_block += 1
+            ids = np.arange(block * BLOCK, block * BLOCK + len(texts), dtype="int64")
+            if len(texts):
+                self.index.add_with_ids(vectors, ids)
+            for fid, text, metadata in zip(ids.tolist(), texts, metadatas):
+                self.texts[fid] = (text, {**metadata, "doc_id": doc_id})
+            self.docs[doc_id] = {"block": block, "count": len(texts)}
+
+    def upsert_from_faiss(self, doc_id: str, faiss_dir: str, embeddings: Embeddings, save: bool = True) -> int:
+        """بردارهای ایندکس per-doc را بدون embed دوباره به ایندکس سراسری منتقل می‌کند."""
+        vs = FAISS.load_local(faiss_dir, embeddings=embeddings, allow_dangerous_deserialization=True)
+        n = vs.index.ntotal
+        vectors = vs.index.reconstruct_n(0, n) if n else np.zeros((0, vs.index.d), dtype="float32")
+        faiss.normalize_L2(vectors)
+        docs = [vs.docstore.search(vs.index_to_docstore_id[i]) for i in range(n)]
+        self.upsert(doc_id, [d.page_content for d in docs], [dict(d.metadata) for d in docs], vectors, save=save)
+        return n
+
+    def remove(self, doc_id: str, save: bool = True) -> None:
+        if save:
+            with self.transaction():
+                return self.remove(doc_id, save=False)
+        with self._lock:
+            self._drop_block(doc_id)
+
+    def compact(self) -> None:
+        """بازسازی hnsw بدون بردارهای بلوک‌های رهاشده."""
+        with self.transaction(), self._lock:
+            if self.index is None or not self.orphans:
+                return
+            fresh = self._new_index(self.index.d)
+            for info in self.docs.values():
+                lo = info["block"] * BLOCK
+                ids = np.arange(lo, lo + info["count"], dtype="int64")
+                if len(ids):
+                    vecs = np.vstack([self.index.reconstruct(int(i)) for i in ids])
+                    fresh.add_with_ids(vecs, ids)
+            self.index = fresh
+            self.orphans = 0
+
+    # ---------- read ----------
+    def search(self, doc_id: str, vector: list[float], k: int = 10) -> list[tuple[Document, float]]:
+        with self._lock:
+            info = self.docs.get(doc_id)
+            if info is None or self.index is None or not info["count"]:
+                return []
+            lo = info["block"] * BLOCK
+            sel = faiss.IDSelectorRange(lo, lo + info["count"])
+            if self.kind == "hnsw":
+                params = faiss.SearchParametersHNSW(sel=sel, efSearch=max(self.ef_search, k))
+            else:
+                params = faiss.SearchParameters(sel=sel)
+            q = np.asarray([vector], dtype="float32")
+            faiss.normalize_L2(q)
+            scores, ids = self.index.search(q, min(k, info["count"]), params=params)
+            out = []
+            for score, fid in zip(scores[0].tolist(), ids[0].tolist()):
+                if fid < 0 or fid not in self.texts:
+                    continue
+                text, metadata = self.texts[fid]
+                out.append((Document(page_content=text, metadata=metadata), float(score)))
+            return out
+
+    def documents(self, doc_id: str) -> list[Document]:
+        with self._lock:
+            info = self.docs.get(doc_id)
+            if info is None:
+                return []
+            lo = info["block"] * BLOCK
+            return [
+                Document(page_content=self.texts[fid][0], metadata=self.texts[fid][1])
+                for fid in range(lo, lo + info["count"])
+                if fid in self.texts
+            ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "kind": self.kind,
+                "docs": len(self.docs),
+                "vectors": self.index.ntotal if self.index is not None else 0,
+                "orphans": self.orphans,
+                "version": self.version,
+                "reloads": self.reloads,
+            }
+
+
+class SharedIndexRetriever(BaseRetriever):
+    """retriever یک doc_id روی SharedIndex."""
+    index: SharedIndex
+    doc_id: str
+    embeddings: Embeddings
+    k: int = 10
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        vector = self.embeddings.embed_query(query)
+        return [doc for doc, _score in self.index.search(self.doc_id, vector, self.k)]
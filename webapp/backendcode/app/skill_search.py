@@ -0,0 +1,352 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from .cache import LRUCache
+from .compact_index import remove_stale_versions
+from .locks import file_lock
+
+SEARCH_DIR = "search"
+FORMAT_VERSION = 1
+_LEGACY_FILES = ("vectors.npy", "centroid.npy", "chunks.json")
+
+log = logging.getLogger(__name__)
+
+
+def _save_atomic(path: Path, write) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def data_dir(root: Path, info: dict) -> Path:
+    """پوشهٔ داده‌های نسخه‌ای که search.json به آن اشاره می‌کند؛ فرمت قدیمی فایل‌ها را مستقیم در root داشت"""
+    return root / info.get("data", "")
+
+
+def write_search_data(vs, out_dir: str, embed_model: str | None = None) -> dict:
+    """
+    داده‌های جستجوی بین فریلنسرها از یک FAISS vectorstore (langchain):
+      vectors.npy   بردارهای نرمال‌شدهٔ chunkها (float32)
+      centroid.npy  میانگین نرمال‌شدهٔ همان بردارها (برای پیش‌فیلتر)
+      chunks.json   متن و صفحهٔ هر chunk به همان ترتیب (برای snippet)
+      search.json   مشخصات و نام پوشهٔ داده؛ آخر و با os.replace نوشته می‌شود و نشانهٔ کامل بودن است
+    مثل compact_index سه فایل داده در زیرپوشهٔ تازهٔ data-<id> نوشته می‌شوند، پس خواننده هرگز vectors.npy
+    یک نسخه را با chunks.json نسخهٔ دیگر نمی‌بیند. نسخهٔ قبلی می‌ماند و قدیمی‌ترها بعد از grace پاک می‌شوند.
+    نویسنده باید قفل فایلی doc_id را داشته باشد (ingest و backfill).
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    try:
+        previous = json.loads((out / "search.json").read_text(encoding="utf-8")).get("data")
+    except (OSError, ValueError):
+        previous = None
+    data = f"data-{uuid.uuid4().hex[:12]}"
+    (out / data).mkdir()
+    n = vs.index.ntotal
+    vectors = vs.index.reconstruct_n(0, n) if n else np.zeros((0, vs.index.d), dtype="float32")
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors /= np.maximum(norms, 1e-12)
+    centroid = vectors.mean(axis=0) if n else np.zeros(vs.index.d, dtype="float32")
+    centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+
+    chunks = []
+    for i in range(n):
+        doc = vs.docstore.search(vs.index_to_docstore_id[i])
+        chunks.append({"text": doc.page_content, "page": doc.metadata.get("page")})
+
+    np.save(out / data / "vectors.npy", vectors)
+    np.save(out / data / "centroid.npy", centroid.astype("float32"))
+    (out / data / "chunks.json").write_text(json.dumps(chunks, ensure_ascii=False), encoding="utf-8")
+    info = {"format": FORMAT_VERSION, "dim": int(vs.index.d), "count": int(n), "embed_model": embed_model, "data": data}
+    _save_atomic(out / "search.json", lambda f: f.write(json.dumps(info).encode("utf-8")))
+    remove_stale_versions(out, keep={"search.json", data, *([previous] if previous else _LEGACY_FILES)})
+    return info
+
+
+class SkillSearchIndex:
+    """
+    جستجوی یک پروژه بین همهٔ فریلنسرها بدون LLM و بدون بارگذاری ایندکس FAISS هر نفر:
+      1) ماتریس centroidهای همهٔ فریلنسرها در حافظه؛ یک ضرب ماتریس-بردار → candidates نفر اول
+      2) rerank دقیق: بیشترین شباهت سؤال با بردار chunkهای همان candidateها (vectors.npy ، در LRU محدود به حجم)
+    امتیاز هر فریلنسر بهترین chunk اوست و بهترین chunkها به عنوان snippet برمی‌گردند.
+    workspaceهای جدید (از pipeline همین پروسه با upsert ، از پروسه‌های دیگر با refresh دوره‌ای) دیده می‌شوند.
+    refresh دوره‌ای در thread پس‌زمینه اجرا می‌شود و snapshot جدید یک‌جا جایگزین می‌شود؛ search فقط
+    بار اول (تا خوانده شدن داده‌های موجود، بدون backfill) منتظر می‌ماند.
+    """
+    def __init__(
+        self,
+        docs_dir: str,
+        embeddings: Embeddings | None = None,
+        candidates: int = 100,
+        max_cache_bytes: int | None = 256 * 1024 * 1024,
+        refresh_interval: float = 30.0,
+        snippet_chars: int = 300,
+        snippet_cache: int = 256,
+    ):
+        self.docs_dir = Path(docs_dir)
+        self.embeddings = embeddings
+        self.candidates = candidates
+        self.refresh_interval = refresh_interval
+        self.snippet_chars = snippet_chars
+        self._lock = threading.Lock()               # فقط برای اعمال تغییرات؛ I/O بیرون از آن است
+        self._refresh_lock = threading.Lock()       # یک refresh در هر لحظه
+        self._refresh_thread: threading.Thread | None = None
+        self._loaded = threading.Event()            # اولین snapshot منتشر شده
+        self._mtimes: dict[str, float] = {}         # doc_id → mtime فایل search.json
+        self._data: dict[str, Path] = {}            # doc_id → پوشهٔ داده‌های همان نسخه
+        self._centroids: dict[str, np.ndarray] = {}
+        self._snapshot: tuple[list[str], np.ndarray] = ([], np.zeros((0, 0), dtype="float32"))
+        self._refreshed: float | None = None
+        self._vectors = LRUCache(max_bytes=max_cache_bytes, sizeof=lambda v: v.nbytes)
+        self._chunks = LRUCache(max_entries=snippet_cache)   # پوشهٔ داده → chunks.json
+        self.searches = 0
+        self.backfilled = 0
+        self.refresh_errors = 0
+
+    def _dir(self, doc_id: str) -> Path:
+        return self.docs_dir / doc_id / "my_faiss_index" / SEARCH_DIR
+
+    # ---------- load ----------
+    def _backfill(self, index_dir: Path) -> bool:
+        """
+        workspaceهای قبل از این قابلیت: یک بار از روی ایندکس FAISS ساخته می‌شوند (بدون embed دوباره).
+        زیر همان قفل فایلی per-doc_id که job ingest می‌گیرد؛ اگر ingest هم‌زمان داده را نوشته باشد کاری نمی‌کند.
+        """
+        from langchain.vectorstores import FAISS
+        from langchain_community.embeddings import FakeEmbeddings
+
+        with file_lock(self.docs_dir / ".locks" / f"{index_dir.parent.name}.lock"):
+            if (index_dir / SEARCH_DIR / "search.json").exists() or not (index_dir / "index.faiss").exists():
+                return False
+            # load_local فقط برای query به embeddings نیاز دارد
+            vs = FAISS.load_local(
+                str(index_dir), embeddings=self.embeddings or FakeEmbeddings(size=1), allow_dangerous_deserialization=True
+            )
+            write_search_data(vs, str(index_dir / SEARCH_DIR))
+        self.backfilled += 1
+        return True
+
+    def _read_doc(self, doc_id: str) -> tuple[float, np.ndarray | None, Path] | None:
+        """(mtime، centroid، پوشهٔ داده) اگر search.json از نسخهٔ در حافظه تازه‌تر باشد؛ بدون قفل"""
+        root = self._dir(doc_id)
+        try:
+            mtime = (root / "search.json").stat().st_mtime
+            if self._mtimes.get(doc_id) == mtime:
+                return None
+            info = json.loads((root / "search.json").read_text(encoding="utf-8"))
+            data = data_dir(root, info)
+            centroid = np.load(data / "centroid.npy").astype("float32") if info.get("count") else None
+        except (OSError, ValueError):
+            return None
+        return mtime, centroid, data
+
+    # ---------- apply (قفل باید گرفته شده باشد) ----------
+    def _apply(self, doc_id: str, mtime: float, centroid: np.ndarray | None, data: Path) -> bool:
+        if self._mtimes.get(doc_id, -1.0) >= mtime:
+            return False          # upsert هم‌زمان نسخهٔ تازه‌تری گذاشته است
+        self._mtimes[doc_id] = mtime
+        old = self._data.get(doc_id)
+        if old is not None:
+            self._vectors.invalidate(old)
+        self._data[doc_id] = data
+        if centroid is None:
+            self._centroids.pop(doc_id, None)
+        else:
+            self._centroids[doc_id] = centroid
+        return True
+
+    def _drop_doc(self, doc_id: str) -> None:
+        self._mtimes.pop(doc_id, None)
+        self._centroids.pop(doc_id, None)
+        old = self._data.pop(doc_id, None)
+        if old is not None:
+            self._vectors.invalidate(old)
+
+    def _rebuild(self) -> None:
+        doc_ids = list(self._centroids)
+        matrix = np.vstack([self._centroids[d] for d in doc_ids]) if doc_ids else np.zeros((0, 0), dtype="float32")
+        self._snapshot = (doc_ids, matrix)      # جایگزینی اتمیک؛ search بدون قفل می‌خواند
+
+    def _publish(self, updates: dict, dropped: set[str] = frozenset()) -> int:
+        with self._lock:
+            changed = sum(self._apply(doc_id, *u) for doc_id, u in updates.items())
+            for doc_id in dropped:
+                # upsert بعد از scan ممکن است doc تازه‌ای گذاشته باشد
+                if doc_id in self._mtimes and not (self._dir(doc_id) / "search.json").exists():
+                    self._drop_doc(doc_id)
+                    changed += 1
+            if changed or not self._loaded.is_set():
+                self._rebuild()
+        self._loaded.set()
+        return changed
+
+    def refresh(self, force: bool = False) -> int:
+        """
+        workspaceهای جدید/تغییرکرده/حذف‌شده را از دیسک می‌خواند؛ خروجی: تعداد تغییرات.
+        دو مرحله: داده‌های جستجوی موجود منتشر می‌شوند، بعد workspaceهای قدیمی backfill و منتشر می‌شوند.
+        """
+        now = time.monotonic()
+        if not force and self._refreshed is not None and now - self._refreshed < self.refresh_interval:
+            return 0
+        with self._refresh_lock:
+            try:
+                updates, seen, missing = {}, set(), []
+                for index_dir in self.docs_dir.glob("*/my_faiss_index"):
+                    doc_id = index_dir.parent.name
+                    seen.add(doc_id)
+                    if not (index_dir / SEARCH_DIR / "search.json").exists():
+                        if (index_dir / "index.faiss").exists():
+                            missing.append(index_dir)
+                        continue
+                    u = self._read_doc(doc_id)
+                    if u is not None:
+                        updates[doc_id] = u
+                changed = self._publish(updates, set(self._mtimes) - seen)
+
+                updates = {}
+                for index_dir in missing:
+                    doc_id = index_dir.parent.name
+                    try:
+                        self._backfill(index_dir)      # False: ingest هم‌زمان نوشت؛ همان خوانده می‌شود
+                    except Exception as e:
+                        log.warning("skill search backfill failed for %s: %s", doc_id, e)
+                        continue
+                    u = self._read_doc(doc_id)
+                    if u is not None:
+                        updates[doc_id] = u
+                if updates:
+                    changed += self._publish(updates)
+                return changed
+            finally:
+                self._loaded.set()          # خطا هم searchهای منتظر را آزاد می‌کند
+                self._refreshed = time.monotonic()
+
+    def _refresh_background(self) -> None:
+        try:
+            self.refresh(force=True)
+        except Exception:
+            self.refresh_errors += 1
+            log.exception("skill search refresh failed")
+
+    def _schedule_refresh(self) -> None:
+        """اگر refresh_interval گذشته باشد یک refresh پس‌زمینه (حداکثر یکی در هر لحظه)."""
+        if self._refreshed is not None and time.monotonic() - self._refreshed < self.refresh_interval:
+            return
+        with self._lock:
+            if self._refresh_thread is None or not self._refresh_thread.is_alive():
+                self._refresh_thread = threading.Thread(
+                    target=self._refresh_background, name="skill-search-refresh", daemon=True
+                )
+                self._refresh_thread.start()
+
+    def upsert(self, doc_id: str) -> None:
+        """بعد از ingest همین پروسه؛ بقیهٔ پروسه‌ها در refresh بعدی می‌بینند."""
+        u = self._read_doc(doc_id)
+        if u is not None:
+            with self._lock:
+                if self._apply(doc_id, *u):
+                    self._rebuild()
+
+    # ---------- search ----------
+    def _doc_vectors(self, doc_id: str) -> np.ndarray:
+        # پوشهٔ داده برای هر نسخه یکتاست، پس کش هرگز بردارهای نسخهٔ قبلی را به جای نسخهٔ جدید برنمی‌گرداند
+        data = self._data[doc_id]
+        return self._vectors.get_or_load(data, lambda: np.load(data / "vectors.npy"))
+
+    def _doc_chunks(self, doc_id: str) -> list[dict]:
+        path = self._data[doc_id] / "chunks.json"
+        return self._chunks.get_or_load(path, lambda: json.loads(path.read_text(encoding="utf-8")))
+
+    def _snippets(self, doc_id: str, rows: list[int], scores: list[float]) -> list[dict]:
+        try:
+            chunks = self._doc_chunks(doc_id)
+        except (OSError, ValueError, KeyError):
+            return []
+        return [
+            {"text": chunks[r]["text"][:self.snippet_chars], "page": chunks[r].get("page"), "score": round(s, 4)}
+            for r, s in zip(rows, scores)
+            if r < len(chunks)
+        ]
+
+    def search(self, vector: list[float], k: int = 10, snippets: int = 2) -> list[dict]:
+        """
+        k فریلنسر با بیشترین شباهت؛ هر نتیجه: freelancer_id، score (بهترین chunk)،
+        centroid_score و snippets (بهترین chunkها با متن و صفحه).
+        """
+        self._schedule_refresh()
+        self._loaded.wait()
+        self.searches += 1
+        doc_ids, centroids = self._snapshot
+        if not doc_ids:
+            return []
+        q = np.asarray(vector, dtype="float32")
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        if q.shape[0] != centroids.shape[1]:
+            raise ValueError(f"query dimension {q.shape[0]} does not match index dimension {centroids.shape[1]}")
+
+        centroid_scores = centroids @ q
+        n = min(len(doc_ids), max(self.candidates, k))
+        candidates = np.argpartition(-centroid_scores, n - 1)[:n] if n < len(doc_ids) else range(len(doc_ids))
+
+        ranked = []
+        for i in candidates:
+            doc_id = doc_ids[i]
+            try:
+                scores = self._doc_vectors(doc_id) @ q
+            except (OSError, ValueError, KeyError):
+                continue          # workspace حذف شده
+            if not scores.size:
+                continue
+            m = min(max(snippets, 1), scores.size)
+            top = np.argpartition(-scores, m - 1)[:m]
+            top = top[np.argsort(-scores[top])]
+            ranked.append((float(scores[top[0]]), doc_id, float(centroid_scores[i]), top, scores[top]))
+        ranked.sort(key=lambda r: r[0], reverse=True)
+
+        return [
+            {
+                "freelancer_id": doc_id,
+                "score": round(score, 4),
+                "centroid_score": round(centroid_score, 4),
+                "snippets": self._snippets(doc_id, rows[:snippets].tolist(), row_scores[:snippets].tolist()) if snippets else [],
+            }
+            for score, doc_id, centroid_score, rows, row_scores in ranked[:k]
+        ]
+
+    def stats(self) -> dict:
+        doc_ids, centroids = self._snapshot
+        cache = self._vectors.stats(per_entry=False)
+        return {
+            "docs": len(doc_ids),
+            "dim": int(centroids.shape[1]) if doc_ids else 0,
+            "candidates": self.candidates,
+            "searches": self.searches,
+            "backfilled": self.backfilled,
+            "refreshing": bool(self._refresh_thread and self._refresh_thread.is_alive()),
+            "refresh_errors": self.refresh_errors,
+            "snippet_cache_entries": len(self._chunks),
+            "vector_cache_entries": cache["entries"],
+            "vector_cache_bytes": cache["bytes"],
+            "vector_cache_hits": cache["hits"],
+            "vector_cache_misses": cache["misses"],
+        }
+
+
+if __name__ == "__main__":
+    # ساخت داده‌های جستجو برای workspaceهای موجود: python -m app.skill_search app/storage/docs
+    import argparse
+
+    ap = argparse.ArgumentParser(description="write search data (vectors, centroid, snippets) next to existing FAISS indexes")
+    ap.add_argument("docs_dir")
+    args = ap.parse_args()
+    index = SkillSearchIndex(args.docs_dir)
+    index.refresh(force=True)
+    print(index.stats())
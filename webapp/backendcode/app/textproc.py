@@ -0,0 +1,63 @@
+import hashlib
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from hazm import Normalizer, word_tokenize
+
+# همان فیلتر قبلی (c.isalnum() or c.isspace()) ؛ \w در re همان isalnum به‌علاوهٔ «_» است
+_STRIP_RE = re.compile(r"[^\w\s]|_")
+_normalizer = Normalizer()
+
+
+def _preprocess(text: str) -> str:
+    text = _normalizer.normalize(text.lower())
+    text = _STRIP_RE.sub("", text)
+    return " ".join(word_tokenize(text))
+
+
+@lru_cache(maxsize=4096)
+def preprocess(text: str) -> str:
+    """
+    نرمال‌سازی مشترک ایندکس و جستجو: حروف کوچک، Normalizer هضم، حذف علائم و توکن‌سازی.
+    خروجی توکن‌هایی است که با یک فاصله از هم جدا شده‌اند.
+    برای رشته‌های کوتاه و تکراری (سؤال‌ها) کش دارد؛ متن‌های حجیم را با preprocess_many بدهید.
+    """
+    return _preprocess(text)
+
+
+def tokenize(text: str) -> list[str]:
+    return preprocess(text).split()
+
+
+def chunk_hash(text: str) -> str:
+    """شناسهٔ محتوای یک chunk؛ کلید مشترک ایندکس افزایشی، BM25 و ادغام نتایج hybrid"""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _auto_workers() -> int:
+    return max(1, min(4, os.cpu_count() or 1))
+
+
+def preprocess_many(
+    texts: list[str],
+    workers: int | None = 1,
+    chunksize: int = 64,
+    min_parallel: int = 2000,
+) -> list[str]:
+    """
+    نسخهٔ دسته‌ای preprocess برای chunkها و پیکره‌ها؛ رشته‌های تکراری داخل دسته فقط یک بار
+    پردازش می‌شوند ولی (برخلاف preprocess) چیزی در کش سراسری نگه داشته نمی‌شود.
+    با workers > 1 (یا None = خودکار) و حداقل min_parallel رشتهٔ یکتا، کار بین چند process پخش می‌شود.
+    """
+    unique = list(dict.fromkeys(texts))
+    workers = workers or _auto_workers()
+    if workers <= 1 or len(unique) < min_parallel:
+        done = {t: _preprocess(t) for t in unique}
+    else:
+        # spawn: مثل converters، ممکن است از threadهای صف ingest صدا زده شود
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as ex:
+            done = dict(zip(unique, ex.map(_preprocess, unique, chunksize=chunksize)))
+    return [done[t] for t in texts]
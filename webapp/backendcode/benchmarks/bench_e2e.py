@@ -0,0 +1,318 @@
+"""
+benchmark سرتاسری ingest و چت بدون مدل واقعی: LLM با app.ollama_stub و embedding با
+hashing trick (یا یک مدل محلی کوچک با --embed-model) شبیه‌سازی می‌شوند.
+
+    cd webapp/backendcode
+    python benchmarks/bench_e2e.py --pages 10,50,200 --requests 200 --concurrency 1,4,16 --out bench.json
+
+مراحل:
+  ingest  DocPipeline.run_all روی PDFهای فارسی مصنوعی با اندازه‌های مختلف (و اجرای دوباره با همان PDF)
+  rag     RAGManager.ask مستقیم با concurrency داده‌شده
+  http    POST /chat روی سرور Flask واقعی (werkzeug، threaded)
+خروجی JSON: throughput، p50/p95/p99، زمان هر مرحله و بیشینهٔ RSS.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+SENTENCES = [
+    "من برنامه‌نویس پایتون هستم و پنج سال سابقهٔ کار با جنگو و فلسک دارم.",
+    "طراحی رابط کاربری و تجربهٔ کاربری برای اپلیکیشن‌های موبایل را انجام می‌دهم.",
+    "در پروژهٔ فروشگاه اینترنتی، سیستم پرداخت و مدیریت سفارش را پیاده‌سازی کردم.",
+    "با پایگاه‌دادهٔ PostgreSQL و Redis و صف‌های پیام کار کرده‌ام.",
+    "تولید محتوای سئو شده و ترجمهٔ متون انگلیسی به فارسی از دیگر مهارت‌های من است.",
+    "زمان تحویل پروژه‌های کوچک معمولاً یک هفته و پروژه‌های بزرگ یک ماه است.",
+    "برای یادگیری ماشین از کتابخانه‌های scikit-learn و PyTorch استفاده می‌کنم.",
+    "قیمت هر پروژه بسته به حجم کار و زمان تحویل توافقی تعیین می‌شود.",
+]
+QUERIES = [
+    "سلام، با جنگو کار کرده‌اید؟",
+    "سابقهٔ طراحی رابط کاربری دارید؟",
+    "قیمت یک فروشگاه اینترنتی چقدر است؟",
+    "زمان تحویل پروژه چقدر طول می‌کشد؟",
+    "با PostgreSQL آشنا هستید؟",
+    "ترجمه هم انجام می‌دهید؟",
+]
+# سؤال‌های ادامه‌دار که در حالت auto باید بازنویسی شوند (QUERIES همه مستقل‌اند و نباید)
+FOLLOWUPS = [
+    "بیشتر بگو",
+    "قیمتش چقدر؟",
+    "اون پروژه کی تموم شد؟",
+    "برای همین کار چه ابزاری استفاده کردید؟",
+]
+
+
+class HashingEmbeddings(Embeddings):
+    """embedding قطعی و بدون مدل (hashing trick روی کلمات)؛ هزینهٔ CPU ناچیز و بازیابی معنادار لغوی."""
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self.model_name = f"hashing-{dim}"
+
+    def _vec(self, text: str) -> list[float]:
+        v = np.zeros(self.dim, dtype="float32")
+        for word in text.split():
+            v[zlib.crc32(word.encode("utf-8")) % self.dim] += 1.0
+        n = np.linalg.norm(v)
+        return (v / n if n else v).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._vec(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._vec(text)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss در لینوکس کیلوبایت و در macOS بایت است
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(latencies: list[float]) -> dict:
+    if not latencies:
+        return {}
+    xs = np.asarray(latencies)
+    return {
+        "count": len(xs),
+        "mean": round(float(xs.mean()), 4),
+        "p50": round(float(np.percentile(xs, 50)), 4),
+        "p95": round(float(np.percentile(xs, 95)), 4),
+        "p99": round(float(np.percentile(xs, 99)), 4),
+        "max": round(float(xs.max()), 4),
+    }
+
+
+def make_pdf(path: Path, pages: int, seed: int = 0) -> Path:
+    """PDF فارسی مصنوعی؛ متن با فونت fallback داخلی PyMuPDF نوشته می‌شود تا قابل استخراج باشد."""
+    import fitz
+    rnd = random.Random(seed)
+    doc = fitz.open()
+    for _ in range(pages):
+        text = " ".join(rnd.choice(SENTENCES) for _ in range(30))
+        page = doc.new_page()
+        page.insert_htmlbox(fitz.Rect(40, 40, 555, 800), f'<p dir="rtl">{text}</p>')
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+def run_load(fn, n: int, concurrency: int) -> dict:
+    """fn(i) را n بار با concurrency thread اجرا می‌کند؛ fn باید (ok, error_label) برگرداند."""
+    latencies: list[float] = []
+    errors: dict[str, int] = {}
+    lock = threading.Lock()
+
+    def one(i: int):
+        t0 = time.perf_counter()
+        ok, label = fn(i)
+        dt = time.perf_counter() - t0
+        with lock:
+            if ok:
+                latencies.append(dt)
+            else:
+                errors[label] = errors.get(label, 0) + 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(one, range(n)))
+    wall = time.perf_counter() - t0
+    return {
+        "concurrency": concurrency,
+        "requests": n,
+        "ok": len(latencies),
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "latency": summarize(latencies),
+    }
+
+
+def check_rewrite_policy() -> dict:
+    """بازنویسی سؤال یک فراخوانی LLM اضافه است؛ سؤال مستقل نباید آن را بپردازد."""
+    from app.rag import is_followup
+    out = {
+        "self_contained_rewritten": [q for q in QUERIES if is_followup(q)],
+        "followups_missed": [q for q in FOLLOWUPS if not is_followup(q)],
+    }
+    if out["self_contained_rewritten"] or out["followups_missed"]:
+        raise SystemExit(f"rewrite policy check failed: {json.dumps(out, ensure_ascii=False)}")
+    return out
+
+
+def bench_ingest(srv, workdir: Path, sizes: list[int]) -> tuple[list[dict], list[str]]:
+    results, doc_ids = [], []
+    for pages in sizes:
+        pdf = make_pdf(workdir / f"synthetic_{pages}.pdf", pages, seed=pages)
+        t0 = time.perf_counter()
+        out = srv.pipeline.run_all(str(pdf))
+        first = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        again = srv.pipeline.run_all(str(pdf), doc_id=out["doc_id"])
+        second = time.perf_counter() - t0
+        doc_ids.append(out["doc_id"])
+        results.append({
+            "pages": pages,
+            "pdf_bytes": pdf.stat().st_size,
+            "chunks": out["index_stats"]["added"] + out["index_stats"]["kept"],
+            "seconds": round(first, 3),
+            "pages_per_second": round(pages / first, 2),
+            "stages": out["timings"],
+            "rerun_same_pdf_seconds": round(second, 4),
+            "rerun_reused": again["reused"],
+            "peak_rss_mb": peak_rss_mb(),
+        })
+    return results, doc_ids
+
+
+def register_freelancers(doc_ids: list[str]) -> None:
+    from app.db import session_scope, Freelancer
+    with session_scope() as db:
+        for doc_id in doc_ids:
+            if not db.get(Freelancer, doc_id):
+                db.add(Freelancer(id=doc_id, name=f"bench {doc_id[:8]}", description="", pdf_path="", md_path="", index_dir=""))
+
+
+def bench_rag(srv, doc_ids: list[str], n: int, concurrency: int, turns: int) -> dict:
+    from app.rag import StageStats
+    srv.rag_manager.stages = StageStats()
+    sessions = max(1, n // turns)
+
+    def ask(i: int):
+        doc_id = doc_ids[i % len(doc_ids)]
+        try:
+            srv.rag_manager.ask(doc_id, QUERIES[i % len(QUERIES)], session_id=f"bench-{i % sessions}")
+            return True, None
+        except Exception as e:
+            return False, type(e).__name__
+
+    out = run_load(ask, n, concurrency)
+    out["stages"] = srv.rag_manager.stage_stats()
+    out["peak_rss_mb"] = peak_rss_mb()
+    return out
+
+
+def bench_http(srv, doc_ids: list[str], n: int, concurrency: int, turns: int) -> dict:
+    import httpx
+    from werkzeug.serving import make_server
+    from app.rag import StageStats
+
+    server = make_server("127.0.0.1", 0, srv.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    srv.rag_manager.stages = StageStats()
+    sessions = max(1, n // turns)
+    client = httpx.Client(base_url=base, timeout=300, limits=httpx.Limits(max_connections=concurrency))
+
+    def chat(i: int):
+        body = {
+            "freelancer_id": doc_ids[i % len(doc_ids)],
+            "query": QUERIES[i % len(QUERIES)],
+            "session_id": f"http-{i % sessions}",
+        }
+        r = client.post("/chat", json=body)
+        return r.status_code == 200, str(r.status_code)
+
+    try:
+        out = run_load(chat, n, concurrency)
+    finally:
+        client.close()
+        server.shutdown()
+    out["stages"] = srv.rag_manager.stage_stats()
+    out["llm"] = srv.llm_limiter.stats()
+    out["peak_rss_mb"] = peak_rss_mb()
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--pages", default="10,50,200", help="comma-separated synthetic PDF sizes")
+    ap.add_argument("--requests", type=int, default=100, help="chat requests per concurrency level")
+    ap.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    ap.add_argument("--turns", type=int, default=3, help="average turns per chat session")
+    ap.add_argument("--token-delay", type=float, default=0.005, help="stub LLM seconds per streamed word")
+    ap.add_argument("--llm-concurrency", type=int, default=2)
+    ap.add_argument("--embed-model", default=None, help="local HF embedding model; default = hashing embeddings")
+    ap.add_argument("--phases", default="ingest,rag,http")
+    ap.add_argument("--workdir", default=None)
+    ap.add_argument("--out", default=None, help="write the JSON report here as well as stdout")
+    args = ap.parse_args()
+
+    sizes = [int(x) for x in args.pages.split(",") if x]
+    levels = [int(x) for x in args.concurrency.split(",") if x]
+    phases = set(args.phases.split(","))
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="roshd-bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    # تنظیمات باید قبل از import ماژول‌های app اعمال شوند
+    from app.ollama_stub import OllamaStub
+    stub = OllamaStub(token_delay=args.token_delay).start()
+    os.environ.update({
+        "OLLAMA_BASE_URL": stub.url,
+        "LLM_WARMUP": "0",
+        "LLM_CONCURRENCY": str(args.llm_concurrency),
+        "LLM_MAX_QUEUE": str(max(levels) * 4),
+        "LLM_QUEUE_TIMEOUT": "300",
+        "DB_URL": f"sqlite:///{workdir / 'bench.db'}",
+        "BASE_DIR": str(workdir),
+        "UPLOAD_DIR": str(workdir / "uploads"),
+        "DOCS_DIR": str(workdir / "docs"),
+        "INGEST_WORKERS": "1",
+    })
+    if args.embed_model:
+        os.environ["EMBED_MODEL"] = args.embed_model
+
+    from app import server as srv
+    if not args.embed_model:
+        embeddings = HashingEmbeddings()
+        srv.pipeline.embeddings = embeddings
+        srv.rag_manager.embeddings = embeddings
+
+    report = {
+        "config": {
+            "pages": sizes,
+            "requests": args.requests,
+            "concurrency": levels,
+            "turns": args.turns,
+            "token_delay": args.token_delay,
+            "llm_concurrency": args.llm_concurrency,
+            "embeddings": args.embed_model or "hashing-384",
+            "workdir": str(workdir),
+        },
+    }
+    try:
+        report["rewrite_check"] = check_rewrite_policy()
+        report["ingest"], doc_ids = bench_ingest(srv, workdir, sizes)
+        register_freelancers(doc_ids)
+        if "rag" in phases:
+            report["rag"] = [bench_rag(srv, doc_ids, args.requests, c, args.turns) for c in levels]
+        if "http" in phases:
+            report["http"] = [bench_http(srv, doc_ids, args.requests, c, args.turns) for c in levels]
+        report["cache"] = srv.rag_manager.cache_stats(per_entry=False)
+    finally:
+        stub.stop()
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
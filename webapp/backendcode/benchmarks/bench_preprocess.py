@@ -0,0 +1,89 @@
+"""
+مقایسهٔ indexing._preprocess قدیمی با app.textproc روی متن فارسی مصنوعی.
+
+    cd webapp/backendcode
+    python benchmarks/bench_preprocess.py --chunks 2000 --workers 4
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hazm import Normalizer, word_tokenize  # noqa: E402
+from app.textproc import _preprocess, preprocess, preprocess_many  # noqa: E402
+
+_normalizer = Normalizer()
+
+WORDS = (
+    "من برنامه‌نویس پایتون هستم و با جنگو، فلسک و FastAPI کار کرده‌ام. "
+    "طراحی رابط کاربری، سئو، تولید محتوا، ترجمه‌ی متون انگليسي و عربي؛ "
+    "پروژه‌های قبلی: فروشگاه اینترنتی (۱۴۰۲)، اپلیکیشن موبایل – React Native! "
+    "آیا می‌توانید این کار را تا هفته‌ی آینده تحویل بدهید؟ قیمت شما چقدر است؟"
+).split()
+
+
+def legacy_preprocess(text: str) -> str:
+    """نسخهٔ قبلی indexing._preprocess برای مقایسه."""
+    try:
+        text = text.lower()
+        text = _normalizer.normalize(text)
+        text = ''.join(c for c in text if c.isalnum() or c.isspace())
+        return ' '.join(word_tokenize(text))
+    except Exception:
+        return text
+
+
+def make_chunks(n: int, words: int, seed: int = 0) -> list[str]:
+    rnd = random.Random(seed)
+    return [" ".join(rnd.choice(WORDS) for _ in range(words)) for _ in range(n)]
+
+
+def timed(fn, *args) -> tuple[float, object]:
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - t0, out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--chunks", type=int, default=2000)
+    ap.add_argument("--words", type=int, default=500)
+    ap.add_argument("--queries", type=int, default=5000)
+    ap.add_argument("--workers", type=int, default=4)
+    args = ap.parse_args()
+
+    chunks = make_chunks(args.chunks, args.words)
+    # سؤال‌های کوتاه با تکرار زیاد، مثل ترافیک واقعی چت
+    query_pool = make_chunks(200, 12, seed=1)
+    rnd = random.Random(2)
+    queries = [rnd.choice(query_pool) for _ in range(args.queries)]
+
+    t_legacy, legacy = timed(lambda xs: [legacy_preprocess(x) for x in xs], chunks)
+    t_new, new = timed(lambda xs: [_preprocess(x) for x in xs], chunks)
+    t_par, par = timed(lambda xs: preprocess_many(xs, workers=args.workers, min_parallel=0), chunks)
+    t_q_legacy, _ = timed(lambda xs: [legacy_preprocess(x) for x in xs], queries)
+    preprocess.cache_clear()
+    t_q_new, _ = timed(lambda xs: [preprocess(x) for x in xs], queries)
+
+    report = {
+        "chunks": args.chunks,
+        "words_per_chunk": args.words,
+        "identical_output": legacy == new == par,
+        "chunks_seconds": {
+            "legacy": round(t_legacy, 4),
+            "textproc": round(t_new, 4),
+            f"textproc_{args.workers}_procs": round(t_par, 4),
+        },
+        "queries": args.queries,
+        "queries_seconds": {"legacy": round(t_q_legacy, 4), "textproc_cached": round(t_q_new, 4)},
+        "query_cache": preprocess.cache_info()._asdict(),
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
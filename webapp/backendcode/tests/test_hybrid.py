@@ -0,0 +1,42 @@
+from langchain_core.documents import Document
+from app.hybrid import BM25Index, HybridRetriever
+from app.textproc import chunk_hash
+
+
+def _retriever(docs: list[Document]) -> HybridRetriever:
+    # مثل RAGManager._hybrid برای ایندکس‌های قدیمی: کلید BM25 و fetch همان chunk_hash متن است
+    by_hash = {d.metadata.get("hash") or chunk_hash(d.page_content): d for d in docs}
+    bm25 = BM25Index.build({h: d.page_content.split() for h, d in by_hash.items()})
+    return HybridRetriever(
+        vector_search=lambda q, k: [(d, 1.0 - 0.1 * i) for i, d in enumerate(docs)][:k],
+        bm25=bm25,
+        fetch=by_hash.get,
+        tokenize=str.split,
+        count_tokens=lambda s: len(s.split()),
+        min_k=1,
+        max_k=len(docs),
+        margin=0.0,
+    )
+
+
+def test_legacy_docs_without_hash_are_fused_once():
+    # chunkهای ایندکس‌های قدیمی hash در metadata ندارند
+    docs = [
+        Document(page_content="react native mobile", metadata={"source": "chunk_0"}),
+        Document(page_content="python django flask", metadata={"source": "chunk_1"}),
+        Document(page_content="seo content writing", metadata={"source": "chunk_2"}),
+    ]
+    out = _retriever(docs).invoke("python django")
+    texts = [d.page_content for d in out]
+    assert len(texts) == len(set(texts))
+    # نتیجهٔ مشترک بردار و BM25 امتیاز هر دو را با هم می‌گیرد
+    assert texts[0] == "python django flask"
+
+
+def test_hashed_docs_keep_their_metadata_hash():
+    docs = [
+        Document(page_content="python django flask", metadata={"hash": "h1"}),
+        Document(page_content="react native mobile", metadata={"hash": "h2"}),
+    ]
+    out = _retriever(docs).invoke("python")
+    assert [d.metadata["hash"] for d in out].count("h1") == 1
@@ -12,11 +12,14 @@ export default function App() {
   const [file, setFile] = useState(null);
   const [creating, setCreating] = useState(false);
   const [loadingList, setLoadingList] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null); // صفحهٔ بعدی لیست (null = تمام شد)
+  const [loadingMore, setLoadingMore] = useState(false);
 
   // --- chat ---
   const [messages, setMessages] = useState([]); // {role:'user'|'assistant', text}
   const [input, setInput] = useState("");
   const [sending, setSending] = useState(false);
+  const [sessionId, setSessionId] = useState(""); // گفتگوی جاری با فریلنسر انتخاب‌شده
   const scrollRef = useRef(null);
 
   // load selectedId from storage
@@ -35,7 +38,7 @@ export default function App() {
     }
   }, [messages]);
 
-  // fetch list
+  // fetch list (صفحهٔ اول؛ صفحه‌های بعدی با loadMoreFreelancers و next_cursor)
   const fetchFreelancers = async () => {
     setLoadingList(true);
     try {
@@ -43,6 +46,7 @@ export default function App() {
       const data = await res.json();
       if (!res.ok) throw new Error(data.error || "failed to fetch freelancers");
       setFreelancers(data.items || []);
+      setNextCursor(data.next_cursor || null);
     } catch (e) {
       console.error(e);
       alert(e.message);
@@ -51,10 +55,49 @@ export default function App() {
     }
   };
 
+  const loadMoreFreelancers = async () => {
+    if (!nextCursor || loadingMore) return;
+    setLoadingMore(true);
+    try {
+      const res = await fetch(`${API_BASE}/freelancers?cursor=${encodeURIComponent(nextCursor)}`);
+      const data = await res.json();
+      if (!res.ok) throw new Error(data.error || "failed to fetch freelancers");
+      setFreelancers((prev) => {
+        const seen = new Set(prev.map((f) => f.id));
+        return [...prev, ...(data.items || []).filter((f) => !seen.has(f.id))];
+      });
+      setNextCursor(data.next_cursor || null);
+    } catch (e) {
+      console.error(e);
+      alert(e.message);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  // نزدیک انتهای لیست → صفحهٔ بعد
+  const onListScroll = (e) => {
+    const el = e.currentTarget;
+    if (el.scrollTop + el.clientHeight >= el.scrollHeight - 40) loadMoreFreelancers();
+  };
+
   useEffect(() => {
     fetchFreelancers();
   }, []);
 
+  // poll ingestion job until done/failed
+  const waitForJob = async (jobId) => {
+    for (;;) {
+      const res = await fetch(`${API_BASE}/jobs/${jobId}`);
+      const data = await res.json();
+      if (!res.ok) throw new Error(data.error || "job status error");
+      const job = data.job;
+      if (job.status === "done") return job.freelancer;
+      if (job.status === "failed") throw new Error(job.error || "ساخت فریلنسر ناموفق بود");
+      await new Promise((r) => setTimeout(r, 1500));
+    }
+  };
+
   // create freelancer (name + description + pdf)
   const createFreelancer = async () => {
     if (!name.trim()) return alert("نام فریلنسر را وارد کن");
@@ -74,7 +117,8 @@ export default function App() {
       const data = await res.json();
       if (!res.ok) throw new Error(data.error || "ساخت فریلنسر ناموفق بود");
 
-      const fr = data.freelancer;
+      // ایندکس‌سازی در پس‌زمینه انجام می‌شود؛ تا پایان job صبر کن
+      const fr = await waitForJob(data.job_id);
       // به لیست اضافه کن و انتخابش کن
       setFreelancers((curr) => [fr, ...curr]);
       setSelectedId(fr.id);
@@ -99,6 +143,7 @@ export default function App() {
   const selectFreelancer = (id) => {
     setSelectedId(id);
     setMessages([]); // چت جدید
+    setSessionId("");
   };
 
   const sendMessage = async () => {
@@ -108,14 +153,50 @@ export default function App() {
     setMessages((m) => [...m, { role: "user", text: userText }]);
     setSending(true);
     try {
-      const res = await fetch(`${API_BASE}/chat`, {
+      const res = await fetch(`${API_BASE}/chat/stream`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ freelancer_id: selectedId, query: userText }),
+        body: JSON.stringify({
+          freelancer_id: selectedId,
+          query: userText,
+          session_id: sessionId || undefined,
+        }),
       });
-      const data = await res.json();
-      if (!res.ok) throw new Error(data.error || "Chat error");
-      setMessages((m) => [...m, { role: "assistant", text: data.answer }]);
+      if (!res.ok) {
+        const data = await res.json();
+        throw new Error(data.error || "Chat error");
+      }
+
+      // پیام خالی دستیار؛ تکه‌های پاسخ به محض رسیدن به آن اضافه می‌شوند
+      setMessages((m) => [...m, { role: "assistant", text: "" }]);
+      const appendToLast = (piece) =>
+        setMessages((m) => {
+          const last = m[m.length - 1];
+          return [...m.slice(0, -1), { ...last, text: last.text + piece }];
+        });
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split("\n\n");
+        buffer = events.pop();
+        for (const evt of events) {
+          const event = (evt.match(/^event: (.*)$/m) || [])[1];
+          const dataLine = (evt.match(/^data: (.*)$/m) || [])[1];
+          if (!dataLine) continue;
+          const data = JSON.parse(dataLine);
+          if (event === "error") throw new Error(data.error);
+          if (event === "done") {
+            if (data.session_id) setSessionId(data.session_id);
+          } else if (data.token) {
+            appendToLast(data.token);
+          }
+        }
+      }
     } catch (e) {
       setMessages((m) => [
         ...m,
@@ -137,6 +218,7 @@ export default function App() {
     setSelectedId("");
     localStorage.removeItem("skillbot_freelancer_id");
     setMessages([]);
+    setSessionId("");
   };
 
   const selected = freelancers.find((f) => f.id === selectedId);
@@ -242,7 +324,7 @@ export default function App() {
             ) : freelancers.length === 0 ? (
               <div className="text-sm text-gray-400">هنوز فریلنسری ثبت نشده.</div>
             ) : (
-              <ul className="space-y-2 max-h-[260px] overflow-y-auto">
+              <ul className="space-y-2 max-h-[260px] overflow-y-auto" onScroll={onListScroll}>
                 {freelancers.map((f) => (
                   <li
                     key={f.id}
@@ -258,6 +340,17 @@ export default function App() {
                     )}
                   </li>
                 ))}
+                {nextCursor && (
+                  <li>
+                    <button
+                      onClick={loadMoreFreelancers}
+                      disabled={loadingMore}
+                      className="w-full text-xs px-2 py-2 rounded-lg bg-gray-100 hover:bg-gray-200 disabled:text-gray-400"
+                    >
+                      {loadingMore ? "در حال دریافت..." : "نمایش بیشتر"}
+                    </button>
+                  </li>
+                )}
               </ul>
             )}
           </div>